@@ -6,9 +6,35 @@ Version 2.0 with DALL-E 3 Integration (Codename: PICASSO)
 """
 
 import os
+import re
+import json
+import time
+import gzip
+import fcntl
+import copy
+import base64
+import sqlite3
+import hashlib
+import html
+import uuid
+import zlib
+import unicodedata
+import codecs
+import queue
+import atexit
+import asyncio
 import logging
-from datetime import datetime
-from flask import Flask, request, jsonify
+import bisect
+import tempfile
+import threading
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta, timezone
+from email import message_from_bytes, policy as email_policy
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
 
 # ============================================================================
 # CONFIGURAZIONE AYROHUB AI 2.0
@@ -22,243 +48,4895 @@ logger = logging.getLogger(__name__)
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+# Endpoint alternativi dei provider (proxy, stub locali per benchmark).
+# OpenAI legge direttamente OPENAI_API_BASE dall'ambiente.
+ANTHROPIC_BASE_URL = os.getenv('ANTHROPIC_BASE_URL')
+GOOGLE_API_ENDPOINT = os.getenv('GOOGLE_API_ENDPOINT')
 SLACK_BOT_TOKEN = os.getenv('SLACK_BOT_TOKEN')
 
-# Status degli agenti AYROHUB 2.0
-lana_active = False
-claude_active = False
-gemini_active = False
-picasso_active = False
+# Deadline (secondi) del fan-out multi-agente
+AGENT_TIMEOUT = float(os.getenv('AGENT_TIMEOUT', '30'))
+PICASSO_TIMEOUT = float(os.getenv('PICASSO_TIMEOUT', '60'))
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', '60'))
+# Timeout minimo (secondi) della chiamata al provider per un passo avviato a ridosso della deadline
+STEP_MIN_TIMEOUT = float(os.getenv('STEP_MIN_TIMEOUT', '1'))
+AGENT_POOL_SIZE = int(os.getenv('AGENT_POOL_SIZE', '16'))
+
+# Cache risposte agenti: "memory" (per processo), "disk" (SQLite condiviso dai worker) o "off"
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'memory')
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_MAX_MB = float(os.getenv('RESPONSE_CACHE_MAX_MB', '64'))
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', '/tmp/ayrohub-cache.sqlite3')
+
+# Coalescing chiamate identiche in volo: "thread" (nel worker), "host" (tra worker, richiede
+# RESPONSE_CACHE=disk per passare il risultato) o "off"
+SINGLE_FLIGHT = os.getenv('SINGLE_FLIGHT', 'thread')
+SINGLE_FLIGHT_DIR = os.getenv('SINGLE_FLIGHT_DIR', '/tmp/ayrohub-flight')
+
+# Coda job asincroni per /n8n-webhook ({"async": true} o header Prefer: respond-async)
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', '/tmp/ayrohub-jobs.sqlite3')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_QUEUE_MAX = int(os.getenv('JOB_QUEUE_MAX', '500'))
+JOB_CALLBACK_RETRIES = int(os.getenv('JOB_CALLBACK_RETRIES', '5'))
+JOB_CALLBACK_BACKOFF = float(os.getenv('JOB_CALLBACK_BACKOFF', '2'))
+JOB_CALLBACK_TIMEOUT = float(os.getenv('JOB_CALLBACK_TIMEOUT', '10'))
+# I job conclusi (con callback consegnato o fallito) restano su /jobs/<id> per JOB_RETENTION secondi
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', '86400'))
+# callback_url: solo http(s). Il server fa POST verso l'URL indicato dal chiamante, quindi senza
+# allowlist chi può chiamare /n8n-webhook raggiunge qualunque host visibile dal server (anche
+# servizi interni): in produzione elencare gli host ammessi in JOB_CALLBACK_HOSTS (es. n8n.example.com)
+JOB_CALLBACK_HOSTS = {host.strip().lower() for host in os.getenv('JOB_CALLBACK_HOSTS', '').split(',') if host.strip()}
+
+# Limiti per provider (0 = illimitato): concorrenza massima, richieste e token al minuto.
+# LANA e PICASSO condividono i limiti OpenAI.
+PROVIDER_LIMITS = {
+    provider: {
+        "max_concurrency": int(os.getenv(f'{prefix}_MAX_CONCURRENCY', '16')),
+        "rpm": float(os.getenv(f'{prefix}_RPM', '0')),
+        "tpm": float(os.getenv(f'{prefix}_TPM', '0'))
+    }
+    for provider, prefix in (("openai", "OPENAI"), ("anthropic", "ANTHROPIC"), ("google", "GOOGLE"))
+}
+RATE_LIMIT_BACKOFF = float(os.getenv('RATE_LIMIT_BACKOFF', '1'))
+
+# Circuit breaker per agente: si apre dopo N errori consecutivi o troppe chiamate lente
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_SLOW_CALL = float(os.getenv('BREAKER_SLOW_CALL', '20'))
+BREAKER_SLOW_RATIO = float(os.getenv('BREAKER_SLOW_RATIO', '0.5'))
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '20'))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '30'))
+# Hedging: seconda chiamata se la prima supera il percentile di latenza (solo agenti elencati)
+HEDGE_AGENTS = {name.strip().upper() for name in os.getenv('HEDGE_AGENTS', '').split(',') if name.strip()}
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+
+# PICASSO: "background" genera le immagini su un pool dedicato e risponde subito con un
+# segnaposto (stato su /images/<key>), "inline" attende l'immagine nella richiesta.
+# In entrambi i casi le immagini finiscono nello store locale (prompt normalizzato + dimensione).
+PICASSO_MODE = os.getenv('PICASSO_MODE', 'background')
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+IMAGE_STORE_DIR = os.getenv('IMAGE_STORE_DIR', '/tmp/ayrohub-images')
+# Prefisso degli URL immagine nelle risposte (es. https://ayrohub.example.com), vuoto = path relativi
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', '').rstrip('/')
+
+# Prompt shaping: i briefing oltre il budget di input dell'agente vengono ridotti con un riassunto
+# estrattivo ("summary"), tenendo inizio e fine ("truncate") o lasciati interi ("off")
+PROMPT_SHAPING = os.getenv('PROMPT_SHAPING', 'summary')
+# max_tokens di output per tipo di richiesta (mai oltre il max_tokens dell'agente)
+OUTPUT_TOKENS = {
+    kind: int(os.getenv(f'OUTPUT_TOKENS_{kind.upper()}', default))
+    for kind, default in (("briefing", "1000"), ("webhook", "600"), ("batch", "400"))
+}
+
+# Memoria conversazioni: con session_id/thread_id nel payload (o header X-Session-Id) i turni
+# precedenti più rilevanti entrano nel prompt di ogni agente entro CONVERSATION_CONTEXT_TOKENS.
+# CONVERSATION_RECALL_TURNS = turni recenti tra cui scegliere; "off" = briefing senza memoria
+CONVERSATION_MEMORY = os.getenv('CONVERSATION_MEMORY', 'on')
+CONVERSATION_DB_PATH = os.getenv('CONVERSATION_DB_PATH', '/tmp/ayrohub-conversations.sqlite3')
+CONVERSATION_CONTEXT_TOKENS = int(os.getenv('CONVERSATION_CONTEXT_TOKENS', '600'))
+CONVERSATION_RECALL_TURNS = int(os.getenv('CONVERSATION_RECALL_TURNS', '20'))
+
+# Knowledge base (/kb/*, /demo/file, sorgente n8n "file"): documenti a chunk di KB_CHUNK_CHARS
+# caratteri (con KB_CHUNK_OVERLAP ripetuti) e indice full-text SQLite FTS5. KB_VECTORS aggiunge un
+# indice vettoriale in memoria (richiede numpy, KB_VECTOR_DIM float32 per chunk): "hash" (feature
+# hashing locale, nessuna chiamata API), "openai" (embeddings del provider) o "off".
+# KB_MIN_SIMILARITY = similarità coseno minima di un risultato solo vettoriale.
+# Gli agenti ricevono i KB_TOP_K chunk più rilevanti entro KB_CONTEXT_TOKENS (0 = mai).
+KB_DB_PATH = os.getenv('KB_DB_PATH', '/tmp/ayrohub-kb.sqlite3')
+KB_CHUNK_CHARS = int(os.getenv('KB_CHUNK_CHARS', '1000'))
+KB_CHUNK_OVERLAP = int(os.getenv('KB_CHUNK_OVERLAP', '150'))
+KB_VECTORS = os.getenv('KB_VECTORS', 'off')
+KB_VECTOR_DIM = int(os.getenv('KB_VECTOR_DIM', '256'))
+KB_EMBEDDING_MODEL = os.getenv('KB_EMBEDDING_MODEL', 'text-embedding-3-small')
+KB_MIN_SIMILARITY = float(os.getenv('KB_MIN_SIMILARITY', '0.2'))
+KB_TOP_K = int(os.getenv('KB_TOP_K', '4'))
+KB_CONTEXT_TOKENS = int(os.getenv('KB_CONTEXT_TOKENS', '500'))
+
+# Email -> task (/emails, /tasks, /demo/email, sorgente n8n "email"): ogni email (hash del Message-ID,
+# altrimenti di mittente + oggetto + corpo) viene elaborata una volta sola. EMAIL_TASK_EXTRACTION="agent"
+# fa estrarre i task (JSON) a EMAIL_TASK_AGENT, con le regole locali come ripiego se l'agente non è
+# attivo o non risponde in JSON; "rules" non chiama i provider (sincronizzazioni di caselle grandi).
+TASK_DB_PATH = os.getenv('TASK_DB_PATH', '/tmp/ayrohub-tasks.sqlite3')
+EMAIL_TASK_EXTRACTION = os.getenv('EMAIL_TASK_EXTRACTION', 'agent')
+EMAIL_TASK_AGENT = os.getenv('EMAIL_TASK_AGENT', 'CLAUDE').upper()
+EMAIL_MAX_TASKS = int(os.getenv('EMAIL_MAX_TASKS', '10'))
+EMAIL_SYNC_MAX_ITEMS = int(os.getenv('EMAIL_SYNC_MAX_ITEMS', '5000'))
+
+# Serializzazione risposte: "auto" usa orjson se installato (requirements.txt), "std" il modulo json.
+# Le risposte JSON oltre RESPONSE_COMPRESS_MIN_BYTES vanno in gzip se il client lo accetta (0 = mai).
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'auto')
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESS_MIN_BYTES', '2048'))
+RESPONSE_COMPRESS_LEVEL = int(os.getenv('RESPONSE_COMPRESS_LEVEL', '1'))
+
+# Batch n8n (/n8n-webhook/batch): elementi in volo per batch (0 = dai limiti dei provider) e dimensione massima
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '0'))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '500'))
+
+# Metriche /metrics: ogni worker scrive uno snapshot in METRICS_DIR, /metrics somma i worker vivi
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), f'ayrohub-metrics-{os.getppid()}'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+# Pipeline agenti (opt-in): "on" fa partire gli agenti che dipendono da altri (LANA sintetizza
+# CLAUDE e GEMINI) appena i loro input sono pronti, quindi la richiesta dura la somma dei passi
+# invece del più lento; "off" (default) esegue tutti gli agenti sul briefing originale in parallelo.
+# Per richiesta: {"pipeline": true}
+TEAM_PIPELINE = os.getenv('TEAM_PIPELINE', 'off')
+
+# Startup: "lazy" (default) non contatta i provider all'import, "eager" blocca finché i probe non finiscono
+STARTUP_MODE = os.getenv('STARTUP_MODE', 'lazy')
+PROBE_INTERVAL = float(os.getenv('PROBE_INTERVAL', '300'))
+PROBE_TIMEOUT = float(os.getenv('PROBE_TIMEOUT', '10'))
+
+# Health: /health, /health/ready e /ayroctopus-status servono uno snapshot già serializzato, ricostruito
+# in background ogni HEALTH_REFRESH_INTERVAL secondi (probe dei provider, circuit breaker, code e pool).
+# /health/live fallisce se lo snapshot non si aggiorna da HEALTH_STALE_AFTER secondi (worker bloccato);
+# /health/ready fallisce se nessun provider configurato è raggiungibile.
+HEALTH_REFRESH_INTERVAL = float(os.getenv('HEALTH_REFRESH_INTERVAL', '5'))
+HEALTH_STALE_AFTER = float(os.getenv('HEALTH_STALE_AFTER', '60'))
+
+# Status dei provider (e quindi degli agenti che li usano): dalla configurazione, poi aggiornato dai probe
+provider_active = {
+    "openai": bool(OPENAI_API_KEY),
+    "anthropic": bool(ANTHROPIC_API_KEY),
+    "google": bool(GOOGLE_API_KEY)
+}
+
+# Ultimo esito dei probe per provider (openai, anthropic, google)
+provider_status = {}
 
-# Test delle API keys
 logger.info("🚀 Starting AYROHUB AI 2.0 initialization...")
 
+# Configurazione SDK (nessuna chiamata di rete)
 if OPENAI_API_KEY:
     try:
         import openai
         openai.api_key = OPENAI_API_KEY
-        # Test LANA (GPT)
-        test = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": "hi"}],
-            max_tokens=3
-        )
-        lana_active = True
-        logger.info("✅ LANA (OpenAI) attiva")
+    except Exception as e:
+        logger.error(f"❌ LANA/PICASSO: {e}")
+        provider_active["openai"] = False
+
+if ANTHROPIC_API_KEY:
+    try:
+        import anthropic
+    except Exception as e:
+        logger.error(f"❌ CLAUDE: {e}")
+        provider_active["anthropic"] = False
+
+if GOOGLE_API_KEY:
+    try:
+        import google.generativeai as genai
+        if GOOGLE_API_ENDPOINT:
+            genai.configure(api_key=GOOGLE_API_KEY, transport="rest",
+                            client_options={"api_endpoint": GOOGLE_API_ENDPOINT})
+        else:
+            genai.configure(api_key=GOOGLE_API_KEY)
+    except Exception as e:
+        logger.error(f"❌ GEMINI: {e}")
+        provider_active["google"] = False
+
+def provider_summary():
+    return ", ".join(f"{name}={active}" for name, active in provider_active.items())
+
+def probe_openai():
+    """LANA/PICASSO: lista modelli, non consuma token né genera immagini"""
+    import openai
+    openai.Model.list(request_timeout=PROBE_TIMEOUT)
+
+def probe_anthropic():
+    """CLAUDE: messaggio da un token"""
+    import anthropic
+    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, base_url=ANTHROPIC_BASE_URL, timeout=PROBE_TIMEOUT)
+    client.messages.create(
+        model="claude-3-haiku-20240307",
+        max_tokens=1,
+        messages=[{"role": "user", "content": "hi"}]
+    )
+
+def probe_google():
+    """GEMINI: metadati del modello"""
+    import google.generativeai as genai
+    genai.get_model('models/gemini-1.5-flash')
+
+PROVIDER_PROBES = [
+    ("openai", OPENAI_API_KEY, probe_openai),
+    ("anthropic", ANTHROPIC_API_KEY, probe_anthropic),
+    ("google", GOOGLE_API_KEY, probe_google),
+]
+
+# Fine dell'ultimo giro di probe (monotonic): i worker nati da fork (gunicorn --preload) ereditano
+# l'esito del master e non ripetono i probe finché non scade PROBE_INTERVAL
+probed_at = None
+
+def probe_providers():
+    """Verifica la raggiungibilità dei provider configurati e aggiorna gli agenti"""
+    global probed_at
+    for name, api_key, probe in PROVIDER_PROBES:
+        if not api_key:
+            continue
+        start = time.monotonic()
+        try:
+            probe()
+            reachable, error = True, None
+        except Exception as e:
+            reachable, error = False, str(e)
+            logger.error(f"❌ Probe {name}: {e}")
+        provider_status[name] = {
+            "reachable": reachable,
+            "latency_ms": round((time.monotonic() - start) * 1000, 1),
+            "checked_at": datetime.now().isoformat(),
+            "error": error
+        }
+    
+    for name, status in provider_status.items():
+        provider_active[name] = status["reachable"]
+    probed_at = time.monotonic()
+    
+    logger.info(f"🎯 AYROHUB AI 2.0 Status: {provider_summary()}")
+
+def provider_probe_loop():
+    """Probe in background, ripetuti ogni PROBE_INTERVAL secondi dall'ultimo giro (anche ereditato)"""
+    while True:
+        if probed_at is not None:
+            time.sleep(max(0.0, probed_at + PROBE_INTERVAL - time.monotonic()))
+        try:
+            probe_providers()
+        except Exception as e:
+            logger.error(f"❌ Probe loop: {e}")
+            time.sleep(PROBE_INTERVAL)
+
+def wait_provider_probes(timeout):
+    """Attende il primo giro di probe (al massimo `timeout` secondi); True se è concluso"""
+    deadline = time.monotonic() + timeout
+    while probed_at is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return probed_at is not None
+
+def start_provider_probes():
+    """Avvia il thread dei probe (anche nei worker creati da fork)"""
+    threading.Thread(target=provider_probe_loop, name="ayrohub-probes", daemon=True).start()
+
+if STARTUP_MODE == 'eager':
+    probe_providers()
+else:
+    logger.info(f"🎯 AYROHUB AI 2.0 Status (config): {provider_summary()}")
+    if OPENAI_API_KEY or ANTHROPIC_API_KEY or GOOGLE_API_KEY:
+        start_provider_probes()
+        # I thread non sopravvivono al fork (gunicorn --preload): ogni worker riavvia il proprio loop,
+        # che parte dall'esito ereditato dal master (vedi gunicorn.conf.py)
+        os.register_at_fork(after_in_child=start_provider_probes)
+
+# ============================================================================
+# CLIENT PROVIDER CONDIVISI
+# ============================================================================
+
+class ProviderClients:
+    """Registry dei client provider: creati una volta per worker, condivisi dai call_*
+
+    I client sono costruiti al primo uso sotto lock e riusano un pool di
+    connessioni HTTP keep-alive (dimensione, keep-alive e timeout configurabili).
+    """
+    
+    def __init__(self, pool_size, keepalive, connect_timeout, read_timeout):
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.timeout = (connect_timeout, read_timeout)
+        self._lock = threading.Lock()
+        self._clients = {}
+    
+    def _get(self, key, factory):
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self._clients[key] = factory()
+        return client
+    
+    def openai_session(self):
+        """Sessione requests condivisa da LANA e PICASSO (openai 0.28)"""
+        def build():
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size, max_retries=2)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            return session
+        return self._get("openai", build)
+    
+    def openai_aiosession(self):
+        """Sessione aiohttp per le chiamate async, legata all'event loop corrente"""
+        loop = asyncio.get_running_loop()
+        def build():
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive)
+            return aiohttp.ClientSession(connector=connector)
+        return self._get(("openai-async", loop), build)
+    
+    def request_timeout(self, seconds):
+        """(connect, read) per una chiamata: la lettura non supera il timeout dell'agente o del passo"""
+        return self.timeout[0], min(self.timeout[1], seconds)
+    
+    def _httpx_options(self):
+        import httpx
+        return {
+            "limits": httpx.Limits(max_connections=self.pool_size,
+                                   max_keepalive_connections=self.pool_size,
+                                   keepalive_expiry=self.keepalive),
+            "timeout": httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+        }
+    
+    def anthropic(self):
+        """Client Anthropic sync (CLAUDE)"""
+        def build():
+            import httpx
+            import anthropic
+            return anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, base_url=ANTHROPIC_BASE_URL,
+                                       http_client=httpx.Client(**self._httpx_options()))
+        return self._get("anthropic", build)
+    
+    def async_anthropic(self):
+        """Client Anthropic async (CLAUDE, modalità ASGI)"""
+        loop = asyncio.get_running_loop()
+        def build():
+            import httpx
+            import anthropic
+            return anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, base_url=ANTHROPIC_BASE_URL,
+                                            http_client=httpx.AsyncClient(**self._httpx_options()))
+        return self._get(("anthropic-async", loop), build)
+    
+    def gemini(self, model_name):
+        """Modello Gemini riusato tra le richieste (GEMINI)"""
+        def build():
+            import google.generativeai as genai
+            return genai.GenerativeModel(model_name)
+        return self._get(("gemini", model_name), build)
+    
+    def reset(self):
+        """Dimentica i client: le connessioni non vanno condivise tra processi dopo un fork"""
+        self._lock = threading.Lock()
+        self._clients = {}
+        if OPENAI_API_KEY:
+            # openai 0.28 tiene in cache la sessione per thread, compreso il thread che ha fatto fork
+            from openai import api_requestor
+            api_requestor._thread_context.__dict__.pop("session", None)
+
+provider_clients = ProviderClients(
+    pool_size=int(os.getenv('PROVIDER_POOL_SIZE', '32')),
+    keepalive=float(os.getenv('PROVIDER_KEEPALIVE', '60')),
+    connect_timeout=float(os.getenv('PROVIDER_CONNECT_TIMEOUT', '5')),
+    read_timeout=float(os.getenv('PROVIDER_READ_TIMEOUT', '60')),
+)
+os.register_at_fork(after_in_child=provider_clients.reset)
+
+if OPENAI_API_KEY and provider_active["openai"]:
+    # openai 0.28 usa questa sessione per tutte le chiamate sync, da qualsiasi thread
+    openai.requestssession = provider_clients.openai_session
+
+# ============================================================================
+# METRICHE (Prometheus)
+# ============================================================================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICS = {
+    "ayrohub_http_requests_total": ("counter", "Richieste HTTP per route e status"),
+    "ayrohub_http_request_duration_seconds": ("histogram", "Durata delle richieste HTTP per route"),
+    "ayrohub_http_requests_in_flight": ("gauge", "Richieste HTTP in corso per route"),
+    "ayrohub_request_phase_seconds": ("histogram", "Tempo delle richieste team per fase (queue, provider, formatting, serialization)"),
+    "ayrohub_agent_calls_total": ("counter", "Chiamate agente per esito (ok, error, circuit_open, cached)"),
+    "ayrohub_agent_call_duration_seconds": ("histogram", "Durata delle chiamate agente"),
+    "ayrohub_agent_calls_in_flight": ("gauge", "Chiamate agente in corso"),
+    "ayrohub_agent_timeouts_total": ("counter", "Agenti oltre la deadline del fan-out"),
+    "ayrohub_agent_calls_abandoned": ("gauge", "Chiamate agente lasciate in corso dopo deadline o interruzione (thread del pool ancora occupati)"),
+    "ayrohub_agent_queue_seconds": ("histogram", "Attesa di un thread libero nel pool agenti"),
+    "ayrohub_provider_request_duration_seconds": ("histogram", "Durata delle chiamate SDK per provider"),
+    "ayrohub_provider_errors_total": ("counter", "Errori dei provider per tipo (rate_limited, error)"),
+    "ayrohub_provider_requests_in_flight": ("gauge", "Chiamate SDK in corso per provider"),
+    "ayrohub_batch_items_total": ("counter", "Elementi dei batch n8n per esito"),
+    "ayrohub_batch_item_duration_seconds": ("histogram", "Durata di un elemento dei batch n8n"),
+}
+
+class Metrics:
+    """Contatori, gauge e istogrammi esposti da /metrics
+
+    Hot path senza lock: ogni thread scrive solo nel proprio shard e
+    /metrics somma gli shard. Tra worker gunicorn ogni processo scrive
+    periodicamente uno snapshot JSON in METRICS_DIR; /metrics somma gli
+    snapshot dei processi vivi (un worker riavviato riparte da zero, come
+    un restart per Prometheus).
+    """
+    
+    def __init__(self, directory, flush_interval):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.reset()
+    
+    def reset(self):
+        """Stato nuovo (anche dopo il fork): shard e flusher sono per processo"""
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = ({}, {}, {})
+        self._flusher = None
+    
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            # Solo la prima scrittura di ogni thread prende il lock
+            shard = self._local.shard = ({}, {}, {})
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+                if self._flusher is None and self.directory:
+                    self._flusher = threading.Thread(target=self._flush_loop, daemon=True, name="ayrohub-metrics")
+                    self._flusher.start()
+        return shard
+    
+    def inc(self, name, labels, value=1):
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+    
+    def gauge(self, name, labels, delta):
+        gauges = self._shard()[1]
+        key = (name, labels)
+        gauges[key] = gauges.get(key, 0) + delta
+    
+    def observe(self, name, labels, seconds):
+        histograms = self._shard()[2]
+        key = (name, labels)
+        buckets = histograms.get(key)
+        if buckets is None:
+            # Conteggi per bucket (+Inf incluso), poi la somma
+            buckets = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        buckets[-1] += seconds
+    
+    def collect(self):
+        """Totali di questo processo; gli shard dei thread terminati confluiscono in _retired"""
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append(shard)
+                else:
+                    merge_metrics(self._retired, shard)
+            self._shards = [(thread, shard) for thread, shard in self._shards if thread.is_alive()]
+            totals = ({}, {}, {})
+            merge_metrics(totals, self._retired)
+        for shard in alive:
+            merge_metrics(totals, shard)
+        return totals
+    
+    def flush(self):
+        """Scrive lo snapshot del processo in METRICS_DIR (rename atomico)
+
+        Ogni scrittura ha il proprio file temporaneo: /metrics e il thread di
+        flush possono scrivere insieme senza pubblicare uno snapshot a metà.
+        """
+        counters, gauges, histograms = self.collect()
+        snapshot = {kind: [[name, labels, value] for (name, labels), value in values.items()]
+                    for kind, values in (("counters", counters), ("gauges", gauges), ("histograms", histograms))}
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=f"{os.getpid()}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+    
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"⚠️ Snapshot metriche non scritto: {e}")
+    
+    def aggregate(self):
+        """Totali di tutti i worker vivi (o solo di questo processo senza METRICS_DIR)"""
+        if not self.directory:
+            return self.collect()
+        try:
+            self.flush()
+            names = os.listdir(self.directory)
+        except OSError as e:
+            logger.warning(f"⚠️ Metriche solo del worker corrente: {e}")
+            return self.collect()
+        totals = ({}, {}, {})
+        for filename in names:
+            if not filename.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, filename)
+            if not process_alive(int(filename[:-5])):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            merge_metrics(totals, tuple(
+                {(name, tuple(map(tuple, labels))): value for name, labels, value in snapshot[kind]}
+                for kind in ("counters", "gauges", "histograms")))
+        return totals
+    
+    def render(self):
+        """Formato testo Prometheus (exposition format 0.0.4)"""
+        counters, gauges, histograms = self.aggregate()
+        by_name = {}
+        for values in (counters, gauges, histograms):
+            for (name, labels), value in values.items():
+                by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name.get(name, [])):
+                if kind != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {value:g}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else f"{bound:g}"
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value[-1]:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+def merge_metrics(totals, shard):
+    """Somma uno shard (contatori, gauge, istogrammi) nei totali"""
+    for total, values in zip(totals[:2], shard[:2]):
+        for key, value in list(values.items()):
+            total[key] = total.get(key, 0) + value
+    for key, buckets in list(shard[2].items()):
+        current = totals[2].get(key)
+        totals[2][key] = list(buckets) if current is None else [a + b for a, b in zip(current, buckets)]
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+metrics = Metrics(METRICS_DIR, METRICS_FLUSH_INTERVAL)
+os.register_at_fork(after_in_child=metrics.reset)
+
+class RequestTimer:
+    """Tempo di una richiesta team diviso per fase, registrato in ayrohub_request_phase_seconds
+
+    Registra anche i tempi dei passi della pipeline agenti (vedi pipeline_report)
+    e token e costi per agente; `kind` (briefing, webhook, batch) sceglie il
+    max_tokens di output (OUTPUT_TOKENS).
+    """
+    
+    def __init__(self, route, kind="briefing"):
+        self.route = route
+        self.kind = kind
+        self.started = time.monotonic()
+        self.phases = {}
+        self.steps = OrderedDict()
+        self.usage = OrderedDict()
+    
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+    
+    @contextmanager
+    def phase(self, phase):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, time.monotonic() - started)
+    
+    def step(self, name, started, finished, depends_on, status):
+        self.steps[name] = (started, finished, depends_on, status)
+    
+    def pipeline_report(self):
+        """Tempi dei passi e critical path, in ms dall'inizio della richiesta"""
+        if not self.steps:
+            return None
+        ms = lambda t: round((t - self.started) * 1000, 1)  # noqa: E731
+        # Dal passo finito per ultimo, a ritroso sulla dipendenza che ne ha sbloccato l'avvio
+        path = [max(self.steps, key=lambda name: self.steps[name][1])]
+        while True:
+            inputs = [name for name in self.steps[path[-1]][2] if name in self.steps and self.steps[name][3] != "cut_off"]
+            if not inputs:
+                break
+            path.append(max(inputs, key=lambda name: self.steps[name][1]))
+        path.reverse()
+        return {
+            "steps": {
+                name.lower(): {
+                    "depends_on": [dep.lower() for dep in depends_on],
+                    "status": status,
+                    "started_ms": ms(started),
+                    "finished_ms": ms(finished),
+                    "duration_ms": round((finished - started) * 1000, 1)
+                }
+                for name, (started, finished, depends_on, status) in self.steps.items()
+            },
+            "critical_path": [name.lower() for name in path],
+            "critical_path_ms": ms(self.steps[path[-1]][1])
+        }
+    
+    def usage_report(self):
+        """Token e costo stimato per agente e totali della richiesta"""
+        if not self.usage:
+            return None
+        return {
+            "request_type": self.kind,
+            "agents": {name.lower(): usage for name, usage in self.usage.items()},
+            "input_tokens": sum(usage["input_tokens"] for usage in self.usage.values()),
+            "output_tokens": sum(usage["output_tokens"] for usage in self.usage.values()),
+            "estimated_cost_usd": round(sum(usage["estimated_cost_usd"] for usage in self.usage.values()), 6)
+        }
+    
+    def finish(self):
+        for phase, seconds in self.phases.items():
+            metrics.observe("ayrohub_request_phase_seconds", (("route", self.route), ("phase", phase)), seconds)
+
+# ============================================================================
+# LIMITI PER PROVIDER (concorrenza, RPM/TPM, Retry-After)
+# ============================================================================
+
+class ProviderBusy(Exception):
+    """Il provider non ha liberato capacità entro la deadline della chiamata"""
+
+class TokenBucket:
+    """Budget al minuto con ricarica continua (capacità = un minuto di budget)"""
+    
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+    
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, cost, now):
+        """Secondi prima che `cost` sia disponibile (0 se subito)"""
+        self._refill(now)
+        cost = min(cost, self.capacity)
+        return 0 if self.level >= cost else (cost - self.level) / self.rate
+    
+    def consume(self, cost):
+        self.level -= min(cost, self.capacity)
+
+class LimiterWaiter:
+    """Posto in coda di un ProviderLimiter: un thread, o una coroutine con il suo loop ed evento"""
+    
+    __slots__ = ("loop", "event")
+    
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.event = asyncio.Event() if loop is not None else None
+
+class ProviderLimiter:
+    """Scheduler per provider: le chiamate in eccesso attendono in coda fino alla deadline
+
+    La coda è FIFO tra thread (acquire) e coroutine (aacquire): solo chi è in
+    testa prova a prendere lo slot, così i thread svegliati da notify_all non
+    scavalcano le coroutine in attesa e viceversa.
+    """
+    
+    def __init__(self, name, max_concurrency, rpm=0, tpm=0):
+        self.name = name
+        self.max_concurrency = max_concurrency or float("inf")
+        self.rpm = rpm
+        self.tpm = tpm
+        self.reset()
+    
+    def reset(self):
+        """Stato nuovo (anche dopo il fork: il lock potrebbe essere stato preso da un altro thread)"""
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self._waiters = deque()
+        self.queued = self.rejected = self.rate_limited = 0
+        self.blocked_until = 0.0
+        self._requests = TokenBucket(self.rpm) if self.rpm else None
+        self._tokens = TokenBucket(self.tpm) if self.tpm else None
+    
+    def _try_acquire(self, tokens):
+        """Sotto lock: 0 se lo slot è preso, altrimenti i secondi da attendere (None = fino a un rilascio)"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= self.max_concurrency:
+            return None
+        wait = max(self._requests.wait_time(1, now) if self._requests else 0,
+                   self._tokens.wait_time(tokens, now) if self._tokens and tokens else 0)
+        if wait > 0:
+            return wait
+        if self._requests:
+            self._requests.consume(1)
+        if self._tokens and tokens:
+            self._tokens.consume(tokens)
+        self.in_flight += 1
+        return 0
+    
+    def _wake(self):
+        """Sotto lock: sveglia i thread in attesa e la coroutine in testa alla coda, se c'è"""
+        self._cond.notify_all()
+        if self._waiters and self._waiters[0].loop is not None:
+            head = self._waiters[0]
+            head.loop.call_soon_threadsafe(head.event.set)
+    
+    def _turn(self, waiter, tokens):
+        """Sotto lock: come _try_acquire, ma solo per chi è in testa alla coda"""
+        if self._waiters[0] is not waiter:
+            return None
+        wait = self._try_acquire(tokens)
+        if wait == 0:
+            self._waiters.popleft()
+            self._wake()
+        return wait
+    
+    def _leave(self, waiter):
+        """Sotto lock: chi rinuncia (deadline, cancellazione) lascia il turno al successivo"""
+        self.waiting -= 1
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+            self._wake()
+    
+    def acquire(self, tokens, deadline):
+        with self._cond:
+            if not self._waiters and self._try_acquire(tokens) == 0:
+                return
+            waiter = LimiterWaiter()
+            self._waiters.append(waiter)
+            self.queued += 1
+            self.waiting += 1
+            try:
+                while True:
+                    wait = self._turn(waiter, tokens)
+                    if wait == 0:
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise ProviderBusy(f"{self.name}: nessuno slot libero entro la deadline")
+                    self._cond.wait(remaining if wait is None else min(wait, remaining))
+            finally:
+                self._leave(waiter)
+    
+    async def aacquire(self, tokens, deadline):
+        """Come acquire, senza bloccare l'event loop: la coroutine viene svegliata dal rilascio"""
+        with self._cond:
+            if not self._waiters and self._try_acquire(tokens) == 0:
+                return
+            waiter = LimiterWaiter(asyncio.get_running_loop())
+            self._waiters.append(waiter)
+            self.queued += 1
+            self.waiting += 1
+        try:
+            while True:
+                with self._cond:
+                    wait = self._turn(waiter, tokens)
+                    if wait == 0:
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise ProviderBusy(f"{self.name}: nessuno slot libero entro la deadline")
+                    waiter.event.clear()
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), remaining if wait is None else min(wait, remaining))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                self._leave(waiter)
+    
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._wake()
+    
+    def throttle(self, seconds):
+        """Il provider ha risposto 429: nessuna nuova chiamata per `seconds`"""
+        with self._cond:
+            self.rate_limited += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+    
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_concurrency": None if self.max_concurrency == float("inf") else self.max_concurrency,
+            "rpm": self.rpm or None,
+            "tpm": self.tpm or None,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "rate_limited": self.rate_limited,
+            "blocked_for_s": round(max(self.blocked_until - time.monotonic(), 0), 1)
+        }
+
+provider_limiters = {
+    provider: ProviderLimiter(provider, **limits) for provider, limits in PROVIDER_LIMITS.items()
+}
+for limiter in provider_limiters.values():
+    os.register_at_fork(after_in_child=limiter.reset)
+
+def retry_after(error):
+    """Secondi da attendere se l'errore è un rate limit (HTTP 429), altrimenti None"""
+    status = getattr(error, "http_status", None) or getattr(error, "status_code", None) or getattr(error, "code", None)
+    if status != 429:
+        return None
+    headers = getattr(error, "headers", None) or getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return max(float(headers.get("retry-after")), 0)
+    except (TypeError, ValueError):
+        return RATE_LIMIT_BACKOFF
+
+def provider_call(provider, call, tokens=0, timeout=AGENT_TIMEOUT):
+    """Chiamata sync al provider entro i suoi limiti; su 429 attende Retry-After e riprova"""
+    limiter = provider_limiters[provider]
+    deadline = time.monotonic() + timeout
+    labels = (("provider", provider),)
+    while True:
+        limiter.acquire(tokens, deadline)
+        metrics.gauge("ayrohub_provider_requests_in_flight", labels, 1)
+        started = time.monotonic()
+        try:
+            return call()
+        except Exception as e:
+            wait = retry_after(e)
+            metrics.inc("ayrohub_provider_errors_total", labels + (("kind", "error" if wait is None else "rate_limited"),))
+            if wait is None or time.monotonic() + wait >= deadline:
+                raise
+            logger.warning(f"⏳ {provider} rate limit, nuovo tentativo tra {wait:.1f}s")
+            limiter.throttle(wait)
+        finally:
+            metrics.observe("ayrohub_provider_request_duration_seconds", labels, time.monotonic() - started)
+            metrics.gauge("ayrohub_provider_requests_in_flight", labels, -1)
+            limiter.release()
+
+async def aprovider_call(provider, call, tokens=0, timeout=AGENT_TIMEOUT):
+    """Come provider_call, `call` restituisce una coroutine"""
+    limiter = provider_limiters[provider]
+    deadline = time.monotonic() + timeout
+    labels = (("provider", provider),)
+    while True:
+        await limiter.aacquire(tokens, deadline)
+        metrics.gauge("ayrohub_provider_requests_in_flight", labels, 1)
+        started = time.monotonic()
+        try:
+            return await call()
+        except Exception as e:
+            wait = retry_after(e)
+            metrics.inc("ayrohub_provider_errors_total", labels + (("kind", "error" if wait is None else "rate_limited"),))
+            if wait is None or time.monotonic() + wait >= deadline:
+                raise
+            logger.warning(f"⏳ {provider} rate limit, nuovo tentativo tra {wait:.1f}s")
+            limiter.throttle(wait)
+        finally:
+            metrics.observe("ayrohub_provider_request_duration_seconds", labels, time.monotonic() - started)
+            metrics.gauge("ayrohub_provider_requests_in_flight", labels, -1)
+            limiter.release()
+
+# ============================================================================
+# PROMPT SHAPING (budget di token)
+# ============================================================================
+
+# Caratteri per token quando non c'è un tokenizer esatto (testo italiano/inglese misto)
+CHARS_PER_TOKEN = {"openai": 4.0, "anthropic": 3.5, "google": 4.0}
+
+SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?;:])\s+|\n+")
+WORD_RE = re.compile(r"\w+")
+SIGNIFICANT_WORD_RE = re.compile(r"\w{4,}")
+
+token_encoders = {}
+
+def token_encoder(model):
+    """Tokenizer tiktoken del modello (solo OpenAI, se installato), None altrimenti"""
+    if model not in token_encoders:
+        try:
+            import tiktoken
+            token_encoders[model] = tiktoken.encoding_for_model(model)
+        except Exception:
+            token_encoders[model] = None
+    return token_encoders[model]
+
+def count_tokens(provider, model, text):
+    """Token di `text` per il modello: esatti con tiktoken, altrimenti stimati per provider"""
+    encoder = token_encoder(model) if provider == "openai" else None
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    return int(len(text) / CHARS_PER_TOKEN.get(provider, 4.0)) + 1
+
+def clean_briefing(text):
+    """Toglie il rumore delle email inoltrate: righe citate (>), spazi e righe vuote ripetute"""
+    lines = [line.rstrip() for line in text.splitlines() if not line.lstrip().startswith(">")]
+    return re.sub(r"\n{3,}", "\n\n", re.sub(r"[ \t]+", " ", "\n".join(lines))).strip()
+
+def truncate_to_budget(count, text, budget):
+    """Inizio e fine del testo entro il budget: in un'email la richiesta sta spesso in fondo"""
+    marker = " […] "
+    keep = len(text) * budget / max(count(text), 1)
+    while keep > 0:
+        head, tail = int(keep * 0.7), int(keep * 0.3)
+        shaped = text[:head].rstrip() + marker + text[len(text) - tail:].lstrip() if tail else text[:head].rstrip()
+        if count(shaped) <= budget:
+            return shaped
+        keep *= 0.9
+    return ""
+
+def summarize_to_budget(count, text, budget):
+    """Riassunto estrattivo: le frasi più rappresentative, nell'ordine originale, entro il budget
+
+    Punteggio di una frase = frequenza nel testo delle sue parole significative,
+    normalizzata sulla lunghezza, con un bonus per apertura e chiusura.
+    """
+    sentences = [sentence.strip() for sentence in SENTENCE_SPLIT_RE.split(text) if sentence.strip()]
+    if len(sentences) < 3:
+        return truncate_to_budget(count, text, budget)
+    words = [[word.casefold() for word in WORD_RE.findall(sentence)] for sentence in sentences]
+    frequency = Counter(word for sentence in words for word in set(sentence) if len(word) > 3)
+    
+    def score(index):
+        significant = {word for word in words[index] if len(word) > 3}
+        value = sum(frequency[word] for word in significant) / (len(words[index]) + 1) ** 0.5
+        return value * (1.5 if index == 0 else 1.2 if index == len(sentences) - 1 else 1.0)
+    
+    chosen, used = set(), 0
+    for index in sorted(range(len(sentences)), key=score, reverse=True):
+        cost = count(sentences[index]) + 1
+        if used + cost <= budget:
+            chosen.add(index)
+            used += cost
+    if not chosen:
+        return truncate_to_budget(count, text, budget)
+    parts, previous = [], -1
+    for index in sorted(chosen):
+        if index != previous + 1 and parts:
+            parts.append("[…]")
+        parts.append(sentences[index])
+        previous = index
+    return " ".join(parts)
+
+# ============================================================================
+# AGENTI AI 2.0
+# ============================================================================
+
+LANA_DEMO = "💡 LANA (Demo): Ciao Christian! Sono LANA, coordinatrice AI strategica di AYROHUB 2.0. Al momento funziono in modalità demo ma sono pronta per coordinarti le strategie AYROMEX! — LANA 🧠"
+CLAUDE_DEMO = "💡 CLAUDE (Demo): Ciao Christian! Sono Claude, motore di esecuzione tecnica per AYROHUB 2.0. Al momento funziono in modalità demo ma sono pronto per implementare le tue soluzioni tecniche! — Claude ⚡🛠️"
+GEMINI_DEMO = "💡 GEMINI (Demo): Ciao Christian! Sono Gemini, creatore di contenuti strategici per AYROHUB AI 2.0. Al momento funziono in modalità demo ma sono pronto per creare copy e contenuti creativi per AYROMEX! — Gemini ⚔️"
+PICASSO_DEMO = "🎨 PICASSO (Demo): Ciao Christian! Sono PICASSO, il tuo visual content creator di AYROHUB AI 2.0. Al momento funziono in modalità demo ma sono pronto per creare immagini, loghi e visual content per AYROMEX! — PICASSO 🎨"
+
+LANA_SYSTEM_PROMPT = "Sei LANA, coordinatrice AI del sistema AYROHUB 2.0. Ricevi briefing da Christian De Palma (CEO AYROMEX) e coordini le risposte strategiche del team multi-agente. Ora lavori con CLAUDE (execution), GEMINI (creatività) e PICASSO (visual content). Analizza il briefing, fornisci coordinamento e sintesi operative. Mantieni sempre un tono professionale ma diretto. Firma sempre: — LANA 🧠"
+
+CLAUDE_PROMPT = "Sei Claude, motore di esecuzione per AYROHUB 2.0 e sistemi tecnici AYROMEX. Ricevi briefing da Christian De Palma e implementi soluzioni tecniche concrete. Lavori in team con LANA (strategia), GEMINI (creatività) e PICASSO (visual). Focus su automazione, architetture AI e execution rapida. Firma sempre: — Claude ⚡🛠️\n\nBriefing: {message}"
+
+GEMINI_PROMPT = """Sei Gemini, creatore di contenuti strategici per AYROHUB AI 2.0. 
+        Ricevi briefing da Christian De Palma (CEO AYROMEX) e produci copy, headline e contenuti creativi immediati.
+        Lavori in team con LANA (coordinamento), CLAUDE (technical) e PICASSO (visual content).
+        Focus su naming, UX copy, slogan e comunicazione efficace.
+        Stile: diretto, impattante, professionale ma creativo.
+        Firma sempre: — Gemini ⚔️
         
-        # Test PICASSO (DALL-E 3)
+        Briefing: {message}"""
+
+LANA_SYNTHESIS_PROMPT = """Briefing di Christian: {message}
+
+Contributi del team:
+
+{inputs}
+
+Coordina il team: sintetizza i contributi in un piano operativo unico, con priorità, responsabilità e prossimi passi."""
+
+PICASSO_PROMPT = "Professional corporate visual for AYROMEX Group: {message}. Modern, sleek, business-appropriate style."
+
+class Agent:
+    """Agente del team, registrato in AGENT_REGISTRY
+
+    Dichiara provider (limiti e stato), modello, template del prompt
+    (`{message}` è il briefing), timeout e classe di costo. `call`/`acall`
+    sono le implementazioni sync/async per il tipo di chiamata del provider.
+    """
+    
+    def __init__(self, name, role, emoji, provider, model, prompt, call, acall, demo, system=None,
+                 timeout=AGENT_TIMEOUT, cost_class="low", max_tokens=1000, options=None,
+                 display_name=None, active_label="✅ ATTIVO", inputs=(), synthesis=None,
+                 input_budget=1500, price_per_mtok=(0.0, 0.0), price_per_call=0.0, memory=True, knowledge=True,
+                 kind="text"):
+        self.name = name
+        self.key = name.lower()
+        self.role = role
+        self.emoji = emoji
+        self.provider = provider
+        self.model = model
+        self.prompt = prompt
+        self.system = system
+        self.call = call
+        self.acall = acall
+        self.demo = demo
+        self.timeout = timeout
+        self.cost_class = cost_class
+        self.max_tokens = max_tokens
+        self.options = options or {}
+        self.display_name = display_name or name
+        self.active_label = active_label
+        # Pipeline: agenti i cui output entrano nel briefing tramite il template `synthesis`
+        self.inputs = tuple(inputs)
+        self.synthesis = synthesis
+        # Budget e costi: token del briefing oltre cui scatta lo shaping, USD per milione di token
+        # (input, output) e per chiamata (immagini)
+        self.input_budget = input_budget
+        self.price_per_mtok = price_per_mtok
+        self.price_per_call = price_per_call
+        # Memoria conversazioni e knowledge base: turni precedenti e chunk rilevanti nel prompt
+        self.memory = memory
+        self.knowledge = knowledge
+        # "text" o "image": l'hedging (HEDGE_AGENTS) vale solo per le chiamate testuali
+        self.kind = kind
+        # Chiamate di riserva partite per questo passo (copie per richiesta, vedi for_step)
+        self.hedges = 0
+    
+    @property
+    def heading(self):
+        return f"{self.emoji} {self.name} ({self.role})"
+    
+    @property
+    def cache_model(self):
+        """Modello, opzioni e limite di output: fanno parte della chiave cache"""
+        return "-".join([self.model] + [str(value) for _, value in sorted(self.options.items())]
+                        + [f"max{self.max_tokens}"])
+    
+    def active(self):
+        return provider_active.get(self.provider, False)
+    
+    def status(self, demo_label="🔧 Demo"):
+        return self.active_label if self.active() else demo_label
+    
+    def render(self, message):
+        return self.prompt.format(message=message)
+    
+    def pipeline_message(self, message, inputs):
+        """Briefing con gli output degli agenti a monte; senza input validi resta il briefing originale"""
+        usable = [(AGENT_REGISTRY[name], response) for name, response in inputs.items() if not is_failure(response)]
+        if not self.synthesis or not usable:
+            return message
+        return self.synthesis.format(message=message, inputs="\n\n".join(
+            f"{agent.heading}:\n{response}" for agent, response in usable))
+    
+    def messages(self, message):
+        """Messaggi chat: system (se previsto) e briefing renderizzato"""
+        messages = [{"role": "system", "content": self.system}] if self.system else []
+        return messages + [{"role": "user", "content": self.render(message)}]
+    
+    def tokens(self, message):
+        """Token per il budget TPM del provider: prompt completo più l'output massimo"""
+        return self.count_tokens((self.system or "") + self.render(message)) + self.max_tokens
+    
+    def count_tokens(self, text):
+        return count_tokens(self.provider, self.model, text)
+    
+    def shape(self, message):
+        """Briefing entro input_budget: (testo, metadati token) secondo PROMPT_SHAPING"""
+        tokens = self.count_tokens(message)
+        usage = {"input_tokens": tokens, "shaped": None}
+        if PROMPT_SHAPING == 'off' or tokens <= self.input_budget:
+            return message, usage
+        shaped = clean_briefing(message)
+        method = "cleaned"
+        if self.count_tokens(shaped) > self.input_budget:
+            reduce = summarize_to_budget if PROMPT_SHAPING == 'summary' else truncate_to_budget
+            shaped = reduce(self.count_tokens, shaped, self.input_budget)
+            method = PROMPT_SHAPING
+        return shaped, dict(usage, input_tokens=self.count_tokens(shaped), original_tokens=tokens, shaped=method)
+    
+    def with_output_limit(self, max_tokens):
+        """Copia dell'agente per una richiesta con un max_tokens più basso (mai più alto)"""
+        if max_tokens >= self.max_tokens:
+            return self
+        limited = copy.copy(self)
+        limited.max_tokens = max_tokens
+        return limited
+    
+    def with_timeout(self, timeout):
+        """Copia dell'agente con un timeout più breve (mai più lungo): vale per limiti e chiamata HTTP"""
+        if timeout >= self.timeout:
+            return self
+        limited = copy.copy(self)
+        limited.timeout = timeout
+        return limited
+    
+    def for_step(self, max_tokens, timeout):
+        """Copia per un passo di una richiesta: max_tokens e timeout mai oltre quelli dell'agente"""
+        step = copy.copy(self)
+        step.max_tokens = min(max_tokens, self.max_tokens)
+        step.timeout = min(timeout, self.timeout)
+        step.hedges = 0
+        return step
+    
+    def estimate_cost(self, input_tokens, output_tokens):
+        """Costo stimato in USD di una chiamata al provider"""
+        price_in, price_out = self.price_per_mtok
+        return (input_tokens * price_in + output_tokens * price_out) / 1_000_000 + self.price_per_call
+    
+    def run(self, message):
+        """Risposta dell'agente: demo senza provider, messaggio di errore se la chiamata fallisce"""
+        if not self.active():
+            return self.demo
         try:
-            test_image = openai.Image.create(
-                prompt="test image",
-                n=1,
-                size="256x256"
-            )
-            picasso_active = True
-            logger.info("✅ PICASSO (DALL-E 3) attivo")
+            return self.call(self, message)
         except Exception as e:
-            logger.warning(f"⚠️ PICASSO limited: {e}")
-            picasso_active = lana_active  # Se OpenAI funziona, Picasso dovrebbe funzionare
-            
-    except Exception as e:
-        logger.error(f"❌ LANA/PICASSO: {e}")
+            logger.error(f"Error calling {self.display_name}: {e}")
+            return f"❌ {self.display_name} temporaneamente non disponibile"
+    
+    async def arun(self, message):
+        """Come run, per la modalità ASGI"""
+        if not self.active():
+            return self.demo
+        try:
+            return await self.acall(self, message)
+        except Exception as e:
+            logger.error(f"Error calling {self.display_name}: {e}")
+            return f"❌ {self.display_name} temporaneamente non disponibile"
+    
+    def describe(self):
+        return {
+            "role": self.role,
+            "provider": self.provider,
+            "model": self.model,
+            "timeout_s": self.timeout,
+            "cost_class": self.cost_class,
+            "kind": self.kind,
+            "inputs": [name.lower() for name in self.inputs],
+            "input_budget": self.input_budget,
+            "max_tokens": self.max_tokens,
+            "status": self.status()
+        }
+
+def picasso_concept(message):
+    """Estrai concetto visual dal messaggio"""
+    if len(message) > 200:
+        return message[:200] + "..."
+    return message
+
+def format_picasso_pending(status_url, visual_concept):
+    """Segnaposto di PICASSO mentre l'immagine è in generazione (non va in cache)"""
+    return f"""⏳ **Visual Content in generazione per AYROMEX**
+
+🖼️ **Immagine**: in arrivo, stato su {status_url}
+
+💡 **Concept**: {visual_concept}
+
+— PICASSO 🎨"""
+
+def format_picasso(image_url, visual_concept):
+    """Scheda visual content di PICASSO"""
+    return f"""🎨 **Visual Content Creato per AYROMEX!**
+
+🖼️ **Immagine**: {image_url}
+
+💡 **Concept**: {visual_concept}
+
+🎯 **Stile**: Corporate, moderno, professionale
+
+📱 **Utilizzo**: Presentazioni, social media, materiali marketing, branding
+
+💼 **Brand Guidelines**: Allineato con l'identità AYROMEX Group
+
+— PICASSO 🎨"""
+
+def openai_chat(agent, message):
+    """Chat completion OpenAI"""
+    import openai
+    response = provider_call(agent.provider, lambda: openai.ChatCompletion.create(
+        model=agent.model,
+        messages=agent.messages(message),
+        max_tokens=agent.max_tokens,
+        request_timeout=provider_clients.request_timeout(agent.timeout)
+    ), tokens=agent.tokens(message), timeout=agent.timeout)
+    return response.choices[0].message.content
+
+def anthropic_messages(agent, message):
+    """Messages API Anthropic"""
+    extra = {"system": agent.system} if agent.system else {}
+    response = provider_call(agent.provider, lambda: provider_clients.anthropic().messages.create(
+        model=agent.model,
+        max_tokens=agent.max_tokens,
+        messages=agent.messages(message)[-1:],
+        timeout=provider_clients.request_timeout(agent.timeout)[1],
+        **extra
+    ), tokens=agent.tokens(message), timeout=agent.timeout)
+    return response.content[0].text
+
+def google_generate(agent, message):
+    """generate_content Gemini (google-generativeai 0.3 non accetta un timeout per chiamata: vale quello del transport)"""
+    model = provider_clients.gemini(agent.model)
+    prompt = agent.render(message)
+    config = {"max_output_tokens": agent.max_tokens}
+    response = provider_call(agent.provider, lambda: model.generate_content(prompt, generation_config=config),
+                             tokens=agent.tokens(message), timeout=agent.timeout)
+    return response.text
+
+def generate_image(agent, prompt, key):
+    """Genera l'immagine OpenAI (modello immagini di default dell'API) e la salva nello store
+
+    I byte arrivano nella risposta (b64_json): nessun download successivo
+    da un URL temporaneo del provider.
+    """
+    import openai
+    response = provider_call(agent.provider, lambda: openai.Image.create(
+        prompt=prompt,
+        n=1,
+        response_format="b64_json",
+        request_timeout=provider_clients.request_timeout(agent.timeout),
+        **agent.options
+    ), timeout=agent.timeout)
+    image_store.put(key, base64.b64decode(response.data[0].b64_json), prompt, agent.options.get("size"))
+
+def openai_image(agent, message):
+    """Immagine nella richiesta (PICASSO_MODE=inline), dallo store se il concept è già stato generato"""
+    visual_concept = picasso_concept(message)
+    prompt = agent.render(visual_concept)
+    key = image_store.key(prompt, agent.options.get("size"))
+    if image_store.ready(key):
+        image_store.count("hits")
+    else:
+        generate_image(agent, prompt, key)
+    return format_picasso(image_url(key), visual_concept)
+
+def openai_image_background(agent, message):
+    """Immagine sul pool dedicato: scheda se già nello store, altrimenti segnaposto da interrogare"""
+    visual_concept = picasso_concept(message)
+    key, state = image_pool.submit(agent, agent.render(visual_concept))
+    if state["status"] == "ready":
+        return format_picasso(image_url(key), visual_concept)
+    if state["status"] == "failed":
+        raise RuntimeError(f"generazione immagine fallita: {state.get('error')}")
+    return format_picasso_pending(image_status_url(key), visual_concept)
+
+# ============================================================================
+# AGENTI AI 2.0 - VARIANTI ASYNC (modalità ASGI, vedi asgi.py)
+# ============================================================================
+
+async def aopenai_chat(agent, message):
+    """openai_chat - variante coroutine"""
+    import openai
+    openai.aiosession.set(provider_clients.openai_aiosession())
+    response = await aprovider_call(agent.provider, lambda: openai.ChatCompletion.acreate(
+        model=agent.model,
+        messages=agent.messages(message),
+        max_tokens=agent.max_tokens,
+        request_timeout=provider_clients.request_timeout(agent.timeout)[1]
+    ), tokens=agent.tokens(message), timeout=agent.timeout)
+    return response.choices[0].message.content
+
+async def aanthropic_messages(agent, message):
+    """anthropic_messages - variante coroutine"""
+    extra = {"system": agent.system} if agent.system else {}
+    response = await aprovider_call(agent.provider, lambda: provider_clients.async_anthropic().messages.create(
+        model=agent.model,
+        max_tokens=agent.max_tokens,
+        messages=agent.messages(message)[-1:],
+        timeout=provider_clients.request_timeout(agent.timeout)[1],
+        **extra
+    ), tokens=agent.tokens(message), timeout=agent.timeout)
+    return response.content[0].text
+
+async def agoogle_generate(agent, message):
+    """google_generate - variante coroutine"""
+    model = provider_clients.gemini(agent.model)
+    prompt = agent.render(message)
+    config = {"max_output_tokens": agent.max_tokens}
+    if GOOGLE_API_ENDPOINT:
+        # Il transport REST non ha client async: la chiamata bloccante va sul pool agenti
+        generate = lambda: asyncio.get_running_loop().run_in_executor(
+            agent_executor, lambda: model.generate_content(prompt, generation_config=config))
+    else:
+        generate = lambda: model.generate_content_async(prompt, generation_config=config)
+    response = await aprovider_call(agent.provider, generate, tokens=agent.tokens(message), timeout=agent.timeout)
+    return response.text
+
+async def aopenai_image(agent, message):
+    """openai_image - variante coroutine"""
+    import openai
+    visual_concept = picasso_concept(message)
+    prompt = agent.render(visual_concept)
+    key = image_store.key(prompt, agent.options.get("size"))
+    # Store su file (stat, JSON, flock): fuori dall'event loop
+    if await asyncio.to_thread(image_store.ready, key):
+        image_store.count("hits")
+        return format_picasso(image_url(key), visual_concept)
+    openai.aiosession.set(provider_clients.openai_aiosession())
+    response = await aprovider_call(agent.provider, lambda: openai.Image.acreate(
+        prompt=prompt,
+        n=1,
+        response_format="b64_json",
+        request_timeout=provider_clients.request_timeout(agent.timeout)[1],
+        **agent.options
+    ), timeout=agent.timeout)
+    await asyncio.to_thread(image_store.put, key, base64.b64decode(response.data[0].b64_json), prompt,
+                            agent.options.get("size"))
+    return format_picasso(image_url(key), visual_concept)
+
+async def aopenai_image_background(agent, message):
+    """openai_image_background - variante coroutine: store e claim (file e flock) su un thread"""
+    return await asyncio.to_thread(openai_image_background, agent, message)
+
+# ============================================================================
+# REGISTRY AGENTI
+# ============================================================================
+
+# Ordine di registrazione = ordine nelle risposte, nel testo formattato e nella dashboard
+AGENT_REGISTRY = OrderedDict()
+
+class AgentSelectionError(ValueError):
+    """Selezione agenti non valida nella richiesta"""
+
+def register_agent(agent):
+    """Aggiunge (o sostituisce) un agente del team"""
+    AGENT_REGISTRY[agent.name] = agent
+    return agent
+
+def select_agents(names=None):
+    """Agenti richiesti ({"agents": ["lana", "gemini"]} o "lana,gemini"), tutti se None"""
+    if names is None:
+        return list(AGENT_REGISTRY.values())
+    if isinstance(names, str):
+        names = names.split(",")
+    wanted = {str(name).strip().upper() for name in names if str(name).strip()}
+    unknown = wanted - set(AGENT_REGISTRY)
+    if unknown:
+        raise AgentSelectionError(f"Agenti sconosciuti: {', '.join(sorted(name.lower() for name in unknown))}")
+    if not wanted:
+        raise AgentSelectionError("Nessun agente selezionato")
+    return [agent for name, agent in AGENT_REGISTRY.items() if name in wanted]
+
+def pipeline_plan(agents, pipeline=True):
+    """Passi da eseguire per gli agenti richiesti: {nome: input}, in ordine di registry
+
+    Con la pipeline include le dipendenze (anche se non richieste come
+    output) e nient'altro: gli agenti che non servono non partono.
+    """
+    if not pipeline:
+        return OrderedDict((agent.name, ()) for agent in agents)
+    steps, visiting = {}, set()
+    
+    def visit(name):
+        if name in steps:
+            return
+        if name in visiting:
+            raise AgentSelectionError(f"Dipendenza circolare tra agenti: {name.lower()}")
+        visiting.add(name)
+        inputs = tuple(dep for dep in AGENT_REGISTRY[name].inputs if dep in AGENT_REGISTRY)
+        for dep in inputs:
+            visit(dep)
+        steps[name] = inputs
+    
+    for agent in agents:
+        visit(agent.name)
+    return OrderedDict((name, steps[name]) for name in AGENT_REGISTRY if name in steps)
+
+register_agent(Agent(
+    "LANA", "Coordinamento Strategico", "🧠", "openai", "gpt-3.5-turbo", "{message}",
+    openai_chat, aopenai_chat, LANA_DEMO, system=LANA_SYSTEM_PROMPT, active_label="✅ ATTIVA",
+    inputs=("CLAUDE", "GEMINI"), synthesis=LANA_SYNTHESIS_PROMPT, price_per_mtok=(0.50, 1.50)
+))
+register_agent(Agent(
+    "CLAUDE", "Execution Tecnica", "⚡", "anthropic", "claude-3-haiku-20240307", CLAUDE_PROMPT,
+    anthropic_messages, aanthropic_messages, CLAUDE_DEMO, display_name="Claude", price_per_mtok=(0.25, 1.25)
+))
+register_agent(Agent(
+    "GEMINI", "Creatività & Copy", "⚔️", "google", "gemini-1.5-flash", GEMINI_PROMPT,
+    google_generate, agoogle_generate, GEMINI_DEMO, display_name="Gemini", price_per_mtok=(0.075, 0.30)
+))
+register_agent(Agent(
+    "PICASSO", "Visual Content", "🎨", "openai", "dall-e", PICASSO_PROMPT,
+    *((openai_image_background, aopenai_image_background) if PICASSO_MODE == 'background'
+      else (openai_image, aopenai_image)),
+    PICASSO_DEMO, timeout=PICASSO_TIMEOUT, cost_class="high",
+    options={"size": "1024x1024"}, input_budget=45, price_per_call=0.02, memory=False,
+    knowledge=False, kind="image"
+))
+
+# ============================================================================
+# CACHE RISPOSTE AGENTI
+# ============================================================================
+
+def normalize_prompt(message):
+    """Briefing equivalenti (spazi, maiuscole) condividono la stessa chiave"""
+    return re.sub(r"\s+", " ", message).strip().casefold()
+
+def cache_key(agent, model, message):
+    """Chiave cache: agente, modello (cambiarlo invalida la cache) e prompt normalizzato"""
+    raw = f"{agent}\x00{model}\x00{normalize_prompt(message)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def is_cacheable(response):
+    """Solo risposte reali: niente errori, segnaposto di immagini in generazione né testi demo"""
+    return (bool(response) and not response.startswith(("❌", "⏳"))
+            and all(response != agent.demo for agent in AGENT_REGISTRY.values()))
+
+class MemoryCache:
+    """Cache in-process con TTL e tetto di memoria (LRU)"""
+    
+    backend = "memory"
+    
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.stale_hits = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+    
+    def get(self, key, stale=False):
+        """Valore in cache; con stale=True anche se scaduto (fallback a circuito aperto)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if stale:
+                if entry is not None:
+                    self.stale_hits += 1
+                    return entry[0]
+                return None
+            # Le voci scadute restano (fino all'LRU) come fallback a circuito aperto
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def set(self, key, value):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def _drop(self, key):
+        self.size -= self._entries.pop(key)[2]
+    
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale_hits": self.stale_hits,
+            "entries": len(self._entries),
+            "bytes": self.size
+        }
+
+class DiskCache(MemoryCache):
+    """Cache SQLite su disco locale, condivisa dai worker gunicorn dello stesso host
+
+    Byte e voci totali stanno nella tabella counters, aggiornata nella stessa
+    transazione di ogni scrittura: l'LRU scatta solo oltre il tetto ed elimina
+    a lotti le voci con accessed_at più vecchio (indice). Gli hit non scrivono:
+    l'ultimo accesso si registra in memoria e va su disco a lotti (al set
+    successivo o ogni TOUCH_INTERVAL secondi), solo se più vecchio di TOUCH_INTERVAL.
+    """
+    
+    backend = "disk"
+    TOUCH_INTERVAL = 30
+    EVICT_BATCH = 32
+    
+    def __init__(self, ttl, max_bytes, path):
+        super().__init__(ttl, max_bytes)
+        self.path = path
+        self.reset()
+    
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,
+                expires_at REAL NOT NULL, accessed_at REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+            ensure_counters(db, ["SELECT 'bytes', COALESCE(SUM(size), 0) FROM responses",
+                                 "SELECT 'entries', COUNT(*) FROM responses"])
+            self._db = db
+        return self._db
+    
+    def get(self, key, stale=False):
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            if stale:
+                row = db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.stale_hits += 1
+                return row[0] if row else None
+            row = db.execute("SELECT value, accessed_at FROM responses WHERE key = ? AND expires_at > ?",
+                             (key, now)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if now - row[1] > self.TOUCH_INTERVAL:
+                self._touched[key] = now
+            if self._touched and now - self._flushed_at > self.TOUCH_INTERVAL:
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    self._flush_touched(db, now)
+                    db.execute("COMMIT")
+                except BaseException:
+                    db.execute("ROLLBACK")
+                    raise
+            self.hits += 1
+            return row[0]
+    
+    def _flush_touched(self, db, now):
+        """Scrive gli accessi registrati in memoria (dentro la transazione del chiamante)"""
+        db.executemany("UPDATE responses SET accessed_at = ? WHERE key = ? AND accessed_at < ?",
+                       [(at, key, at) for key, at in self._touched.items()])
+        self._touched.clear()
+        self._flushed_at = now
+    
+    def set(self, key, value):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._flush_touched(db, now)
+                old = db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                           (key, value, size, now + self.ttl, now))
+                bump_counters(db, {"bytes": size - (old[0] if old else 0), "entries": 0 if old else 1})
+                total = read_counters(db, ["bytes"])["bytes"]
+                # LRU: elimina a lotti le voci meno usate finché non si rientra nel tetto
+                # (le scadute restano come fallback a circuito aperto)
+                while total > self.max_bytes:
+                    victims = []
+                    for old_key, old_size in db.execute("SELECT key, size FROM responses ORDER BY accessed_at LIMIT ?",
+                                                        (self.EVICT_BATCH,)).fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        victims.append(old_key)
+                        total -= old_size
+                    if not victims:
+                        break
+                    freed = db.execute(f"""DELETE FROM responses WHERE key IN ({','.join('?' * len(victims))})
+                                           RETURNING size""", victims).fetchall()
+                    bump_counters(db, {"bytes": -sum(size for size, in freed), "entries": -len(freed)})
+                    self.evictions += len(freed)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+    
+    def reset(self):
+        """Connessione nuova dopo il fork"""
+        self._lock = threading.Lock()
+        self._db = None
+        self._touched = {}
+        self._flushed_at = time.time()
+    
+    def stats(self):
+        with self._lock:
+            counters = read_counters(self._connect(), ["entries", "bytes"])
+        return dict(super().stats(), **counters)
+
+def build_response_cache():
+    """Backend scelto da RESPONSE_CACHE"""
+    max_bytes = int(RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+    if RESPONSE_CACHE == 'disk':
+        cache = DiskCache(RESPONSE_CACHE_TTL, max_bytes, RESPONSE_CACHE_PATH)
+        os.register_at_fork(after_in_child=cache.reset)
+        return cache
+    if RESPONSE_CACHE == 'memory':
+        return MemoryCache(RESPONSE_CACHE_TTL, max_bytes)
+    return None
+
+response_cache = build_response_cache()
+
+class SingleFlight:
+    """Coalescing: richieste concorrenti con la stessa chiave attendono un'unica chiamata upstream
+
+    Nel worker i follower attendono il Future del leader. Con lock_dir anche
+    i worker dello stesso host si coordinano con un flock per chiave: chi
+    attende rilegge il risultato dalla cache su disco appena il leader finisce.
+    """
+    
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+    
+    def do(self, key, fetch, lookup=None):
+        """Esegue fetch() una sola volta per chiave tra i thread (e i worker, con lookup)"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        
+        try:
+            result = self._run_locked(key, fetch, lookup) if self.lock_dir and lookup else fetch()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+    
+    def _run_locked(self, key, fetch, lookup):
+        with open(os.path.join(self.lock_dir, f"{key}.lock"), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Un altro worker ha la stessa chiamata in volo: attendi e rileggi dalla cache
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                result = lookup()
+                if result is not None:
+                    with self._lock:
+                        self.coalesced += 1
+                    return result
+            try:
+                return fetch()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    async def ado(self, key, fetch):
+        """Variante event loop: le coroutine con la stessa chiave condividono un Future"""
+        future = self._async_calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.exception())
+        self._async_calls[key] = future
+        try:
+            result = await fetch()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            # Il leader è stato interrotto dalla deadline: i follower vedono un timeout
+            future.set_exception(asyncio.TimeoutError())
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._async_calls.pop(key, None)
+    
+    def reset(self):
+        """Dopo il fork le chiamate del processo padre non sono più in volo"""
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+    
+    def stats(self):
+        return {
+            "mode": "host" if self.lock_dir else "thread",
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls) + len(self._async_calls)
+        }
+
+def build_single_flight():
+    """Coalescing scelto da SINGLE_FLIGHT"""
+    if SINGLE_FLIGHT == 'off':
+        return None
+    if SINGLE_FLIGHT == 'host' and not isinstance(response_cache, DiskCache):
+        logger.warning("⚠️ SINGLE_FLIGHT=host richiede RESPONSE_CACHE=disk, uso coalescing per worker")
+    lock_dir = SINGLE_FLIGHT_DIR if SINGLE_FLIGHT == 'host' and isinstance(response_cache, DiskCache) else None
+    flight = SingleFlight(lock_dir)
+    os.register_at_fork(after_in_child=flight.reset)
+    return flight
+
+single_flight = build_single_flight()
+
+# ============================================================================
+# IMMAGINI PICASSO (store locale e pool di generazione)
+# ============================================================================
+
+IMAGE_KEY_RE = re.compile(r"[0-9a-f]{64}")
+
+class ImageStore:
+    """Store locale content-addressed delle immagini PICASSO
+
+    La chiave è l'hash di prompt normalizzato e dimensione: concept visual
+    ripetuti tornano dal disco senza nuova generazione. Accanto a ogni PNG
+    un file JSON con lo stato (pending, ready, failed), condiviso dai worker.
+    """
+    
+    def __init__(self, directory, pending_ttl):
+        self.directory = directory
+        self.pending_ttl = pending_ttl
+        self.hits = self.generated = self.failed = 0
+        self.reset()
+    
+    def reset(self):
+        """Dopo il fork: il lock dei contatori del padre potrebbe essere preso"""
+        self._lock = threading.Lock()
+    
+    def count(self, name):
+        """Incrementa un contatore (hits, generated, failed): lo aggiornano pool, richieste e loop async"""
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+    
+    def key(self, prompt, size):
+        return hashlib.sha256(f"{normalize_prompt(prompt)}\x00{size}".encode("utf-8")).hexdigest()
+    
+    def path(self, key, extension="png"):
+        return os.path.join(self.directory, f"{key}.{extension}")
+    
+    def state(self, key):
+        """Stato dell'immagine, None se mai richiesta"""
+        try:
+            with open(self.path(key, "json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def ready(self, key):
+        state = self.state(key)
+        return state is not None and state["status"] == "ready"
+    
+    def _write(self, path, data):
+        """Scrittura atomica: chi legge vede il file vecchio o quello completo"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    
+    def set_state(self, key, status, prompt, size, **extra):
+        self._write(self.path(key, "json"), json.dumps(dict(
+            status=status, prompt=prompt, size=size, updated=time.time(), **extra)).encode("utf-8"))
+    
+    def claim(self, key, prompt, size):
+        """Prenota la generazione: False se l'immagine è pronta o in corso (anche in un altro worker)"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".claim.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = self.state(key)
+                if state is not None and (state["status"] == "ready" or (
+                        state["status"] == "pending" and time.time() - state["updated"] < self.pending_ttl)):
+                    return False
+                self.set_state(key, "pending", prompt, size)
+                return True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def put(self, key, data, prompt, size):
+        self._write(self.path(key), data)
+        self.set_state(key, "ready", prompt, size, bytes=len(data))
+        self.count("generated")
+    
+    def stats(self):
+        try:
+            images = sum(1 for name in os.listdir(self.directory) if name.endswith(".png"))
+        except OSError:
+            images = 0
+        return {
+            "directory": self.directory,
+            "images": images,
+            "hits": self.hits,
+            "generated": self.generated,
+            "failed": self.failed
+        }
+
+class ImagePool:
+    """Generazione immagini in background su un pool dedicato, fuori dal percorso della richiesta"""
+    
+    def __init__(self, store, workers):
+        self.store = store
+        self.workers = workers
+        self.reset()
+    
+    def reset(self):
+        """Dopo il fork: pool e lock del padre non sono utilizzabili"""
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ayrohub-image")
+        self._lock = threading.Lock()
+        self._futures = {}
+    
+    def submit(self, agent, prompt):
+        """Avvia (se serve) la generazione di `prompt`: ritorna (chiave, stato)"""
+        size = agent.options.get("size")
+        key = self.store.key(prompt, size)
+        state = self.store.state(key)
+        if state is not None and state["status"] == "ready":
+            self.store.count("hits")
+            return key, state
+        with self._lock:
+            if key not in self._futures:
+                if not self.store.claim(key, prompt, size):
+                    return key, self.store.state(key)
+                self._futures[key] = self._executor.submit(self._generate, agent, prompt, key)
+        return key, {"status": "pending"}
+    
+    def _generate(self, agent, prompt, key):
+        try:
+            generate_image(agent, prompt, key)
+        except Exception as e:
+            logger.error(f"❌ PICASSO immagine {key[:12]}: {e}")
+            self.store.count("failed")
+            self.store.set_state(key, "failed", prompt, agent.options.get("size"), error=str(e))
+        finally:
+            with self._lock:
+                self._futures.pop(key, None)
+    
+    def wait(self, key, timeout):
+        """Stato dell'immagine appena non è più pending (o allo scadere di timeout)"""
+        deadline = time.monotonic() + timeout
+        future = self._futures.get(key)
+        if future is not None:
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+        # In generazione in un altro worker: lo stato arriva dallo store
+        state = self.store.state(key)
+        while state is not None and state["status"] == "pending" and time.monotonic() < deadline:
+            time.sleep(0.25)
+            state = self.store.state(key)
+        return state
+    
+    def stats(self):
+        return dict(self.store.stats(), mode=PICASSO_MODE, workers=self.workers, in_flight=len(self._futures))
+
+def image_url(key):
+    return f"{PUBLIC_BASE_URL}/images/{key}.png"
+
+def image_status_url(key):
+    return f"{PUBLIC_BASE_URL}/images/{key}"
+
+def pending_images(responses):
+    """Immagini ancora in generazione nelle risposte: {agente: chiave}"""
+    pending = {}
+    for name, response in responses.items():
+        if response and response.startswith("⏳"):
+            match = IMAGE_KEY_RE.search(response)
+            if match:
+                pending[name] = match.group(0)
+    return pending
+
+image_store = ImageStore(IMAGE_STORE_DIR, pending_ttl=PICASSO_TIMEOUT * 2)
+image_pool = ImagePool(image_store, IMAGE_WORKERS)
+os.register_at_fork(after_in_child=image_store.reset)
+os.register_at_fork(after_in_child=image_pool.reset)
+
+# ============================================================================
+# MEMORIA CONVERSAZIONI
+# ============================================================================
+
+CONVERSATION_CONTEXT_HEADER = "Conversazione precedente con Christian (turni rilevanti):"
+
+class ConversationStore:
+    """Turni delle conversazioni (briefing e risposte degli agenti) su SQLite, per sessione
+
+    Le scritture passano da una coda a un thread dedicato che le inserisce a
+    blocchi in una transazione: la richiesta non attende il disco. Le
+    letture prendono gli ultimi turni della sessione dall'indice
+    (session, id), con costo indipendente dal numero di turni salvati.
+    """
+    
+    def __init__(self, path, recall_turns):
+        self.path = path
+        self.recall_turns = recall_turns
+        self.written = self.failed = 0
+        self.reset()
+    
+    def reset(self):
+        """Dopo il fork: connessioni, coda e writer del padre non sono utilizzabili"""
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+    
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY,
+                session TEXT NOT NULL,
+                briefing TEXT NOT NULL,
+                replies TEXT NOT NULL,
+                created_at REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session, id)")
+            self._local.db = db
+        return db
+    
+    def append(self, session, briefing, replies):
+        """Accoda il turno ({agente: risposta}) per il writer"""
+        self._submit(("append", (session, briefing, json.dumps(replies), time.time())))
+    
+    def forget(self, session):
+        """Cancella la sessione (dopo i turni già accodati)"""
+        self._submit(("forget", session))
+    
+    def _submit(self, operation):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write, name="ayrohub-conversations", daemon=True)
+                    self._writer.start()
+        self._queue.put(operation)
+    
+    def _write(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            db = self._db()
+            try:
+                db.execute("BEGIN")
+                for operation, args in batch:
+                    if operation == "append":
+                        db.execute("INSERT INTO turns (session, briefing, replies, created_at) VALUES (?, ?, ?, ?)", args)
+                    else:
+                        db.execute("DELETE FROM turns WHERE session = ?", (args,))
+                db.execute("COMMIT")
+                self.written += len(batch)
+            except Exception as e:
+                logger.error(f"❌ Memoria conversazioni: {len(batch)} operazioni perse: {e}")
+                self.failed += len(batch)
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+    
+    def flush(self, timeout=5.0):
+        """Attende che il writer abbia scritto i turni accodati (uscita del processo, benchmark)"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.005)
+    
+    def recent(self, session, limit=None):
+        """Ultimi turni della sessione in ordine cronologico: [{briefing, replies, created_at}]"""
+        rows = self._db().execute(
+            "SELECT briefing, replies, created_at FROM turns WHERE session = ? ORDER BY id DESC LIMIT ?",
+            (session, limit or self.recall_turns)).fetchall()
+        return [{"briefing": briefing, "replies": json.loads(replies), "created_at": created_at}
+                for briefing, replies, created_at in reversed(rows)]
+    
+    def stats(self):
+        return {
+            "path": self.path,
+            "pending_writes": self._queue.unfinished_tasks,
+            "written": self.written,
+            "failed": self.failed
+        }
+
+def select_turns(count, turns, message, budget, name):
+    """Testo dei turni più rilevanti per il briefing entro `budget` token, in ordine cronologico
+
+    Rilevanza = parole significative in comune tra il briefing e quello del
+    turno (l'argomento lo dà Christian) più un peso per la recenza (dimezza
+    ogni 3 turni). Un turno troppo lungo viene
+    accorciato con truncate_to_budget se resta spazio sufficiente.
+    """
+    query = set(SIGNIFICANT_WORD_RE.findall(message.casefold()))
+    candidates = []
+    for age, turn in enumerate(reversed(turns)):
+        text = f"Christian: {turn['briefing']}"
+        if turn["replies"].get(name):
+            text += f"\n{name}: {turn['replies'][name]}"
+        relevance = len(query.intersection(SIGNIFICANT_WORD_RE.findall(turn["briefing"].casefold()))) / (len(query) or 1)
+        candidates.append((0.5 ** (age / 3) + relevance, age, text))
+    chosen, used = [], 0
+    for _, age, text in sorted(candidates, reverse=True):
+        tokens = count(text)
+        if used + tokens > budget:
+            if budget - used < 50:
+                continue
+            text = truncate_to_budget(count, text, budget - used)
+            tokens = count(text)
+        chosen.append((age, text))
+        used += tokens
+    return [text for _, text in sorted(chosen, reverse=True)]
+
+class Conversation:
+    """Memoria di una richiesta: turni recenti della sessione, letti una sola volta"""
+    
+    def __init__(self, store, session, message):
+        self.store = store
+        self.session = session
+        self.message = message
+        self._turns = None
+    
+    def turns(self):
+        if self._turns is None:
+            self._turns = self.store.recent(self.session)
+        return self._turns
+    
+    def with_context(self, agent, message):
+        """(briefing preceduto dai turni rilevanti per l'agente, turni usati)"""
+        if not agent.memory or not self.turns():
+            return message, 0
+        context = select_turns(agent.count_tokens, self.turns(), message, CONVERSATION_CONTEXT_TOKENS, agent.name)
+        if not context:
+            return message, 0
+        return CONVERSATION_CONTEXT_HEADER + "\n\n" + "\n\n".join(context) + f"\n\nNuovo briefing: {message}", len(context)
+    
+    def record(self, results):
+        """Salva il turno con le sole risposte reali (niente errori, demo o segnaposto)"""
+        self.store.append(self.session, self.message,
+                          {name: response for name, response in results.items() if is_cacheable(response)})
+
+def conversation_session(data, headers):
+    """Sessione della richiesta: session_id o thread_id nel payload, altrimenti header X-Session-Id"""
+    session = data.get("session_id") or data.get("thread_id") or headers.get("X-Session-Id")
+    return str(session)[:128] if session else None
+
+def start_conversation(data, headers, message):
+    """Memoria della richiesta; None senza sessione, con {"memory": false} o CONVERSATION_MEMORY=off"""
+    session = conversation_session(data, headers)
+    if CONVERSATION_MEMORY == 'off' or not session or data.get("memory") is False:
+        return None
+    return Conversation(conversation_store, session, message)
+
+conversation_store = ConversationStore(CONVERSATION_DB_PATH, CONVERSATION_RECALL_TURNS)
+os.register_at_fork(after_in_child=conversation_store.reset)
+atexit.register(conversation_store.flush)
+
+# ============================================================================
+# KNOWLEDGE BASE (indice full-text e vettoriale)
+# ============================================================================
+
+# Lettura a blocchi e inserimenti a lotti: la memoria resta limitata anche per file grandi.
+# L'upload passa da un file temporaneo (in memoria fino a KB_SPOOL_CHARS caratteri, poi su disco)
+# così hash, controllo dei duplicati ed embeddings avvengono prima della transazione di scrittura.
+KB_BLOCK_CHARS = 64 * 1024
+KB_INSERT_BATCH = 256
+KB_SPOOL_CHARS = 4 * 1024 * 1024
+KB_QUERY_TERMS = 64
+# Piano della query full-text: BM25 costa per occorrenza, quindi entrano solo i termini più rari
+# (al più KB_MATCH_TERMS, in tutto non oltre KB_MATCH_POSTINGS chunk): un termine presente in
+# migliaia di chunk costa molto e non distingue nulla. Le frequenze restano in cache KB_DF_TTL secondi.
+KB_MATCH_TERMS = 6
+KB_MATCH_POSTINGS = 4000
+KB_DF_TTL = 600
+KB_DF_CACHE_SIZE = 50000
+KB_CONTEXT_HEADER = "Documenti rilevanti dal knowledge base AYROMEX:"
+CHUNK_SEPARATORS = ("\n\n", "\n", ". ", "? ", "! ", "; ", " ")
+
+def index_term(word):
+    """Termine come lo salva il tokenizer FTS5 (unicode61 remove_diacritics): città -> citta"""
+    return "".join(char for char in unicodedata.normalize("NFD", word) if not unicodedata.combining(char))
+
+def iter_stream_blocks(stream, block_size=KB_BLOCK_CHARS):
+    """Testo UTF-8 di uno stream binario a blocchi (i caratteri spezzati tra due blocchi restano interi)"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        data = stream.read(block_size)
+        if not data:
+            break
+        yield decoder.decode(data)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+def iter_string_blocks(text, block_size=KB_BLOCK_CHARS):
+    for start in range(0, len(text), block_size):
+        yield text[start:start + block_size]
+
+def chunk_boundary(buffer, start, size):
+    """Fine del chunk che parte da `start`: ultimo paragrafo, riga, frase o parola nella seconda metà"""
+    end = start + size
+    for separator in CHUNK_SEPARATORS:
+        index = buffer.rfind(separator, start + size // 2, end)
+        if index != -1:
+            return index + len(separator)
+    return end
+
+def iter_chunks(blocks, size, overlap):
+    """Chunk di circa `size` caratteri da un iterabile di blocchi di testo
+
+    Ogni chunk riparte `overlap` caratteri prima della fine del precedente
+    (a inizio parola), così una frase a cavallo resta intera in uno dei due.
+    In memoria c'è al più un blocco più un chunk.
+    """
+    overlap = min(overlap, size // 4)
+    buffer, position, emitted = "", 0, 0
+    for block in blocks:
+        buffer = buffer[position:] + block
+        emitted -= position
+        position = 0
+        while len(buffer) - position >= size:
+            cut = chunk_boundary(buffer, position, size)
+            chunk = buffer[position:cut].strip()
+            if chunk:
+                yield chunk
+            emitted = cut
+            space = buffer.find(" ", cut - overlap, cut) if overlap else -1
+            position = space + 1 if space != -1 else cut
+    if len(buffer) > emitted:
+        chunk = buffer[position:].strip()
+        if chunk:
+            yield chunk
+
+def batched(items, size):
+    """Liste di al più `size` elementi da un iterabile (itertools.batched da Python 3.12)"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def query_terms(text, limit=KB_QUERY_TERMS):
+    """Parole significative distinte del testo, in ordine di apparizione (candidati della query full-text)"""
+    terms = dict.fromkeys(index_term(word) for word in SIGNIFICANT_WORD_RE.findall(text.casefold()))
+    return list(terms)[:limit]
+
+class VectorIndex:
+    """Indice vettoriale in memoria dei chunk (numpy, similarità coseno)
+
+    I vettori normalizzati stanno nella colonna `vector` dello store SQLite;
+    ogni worker li carica alla prima ricerca e poi legge solo i chunk con
+    id successivo all'ultimo caricato, anche se indicizzati da un altro worker.
+    """
+    
+    def __init__(self, mode, dimensions):
+        import numpy
+        self.np = numpy
+        self.mode = mode
+        self.dimensions = dimensions
+        self.reset()
+    
+    def reset(self):
+        self._lock = threading.Lock()
+        self._ids = self.np.zeros(0, dtype=self.np.int64)
+        self._matrix = self.np.zeros((0, self.dimensions), dtype=self.np.float32)
+        self._last_id = 0
+    
+    def _hash_vector(self, text):
+        # Parole e prefissi di 5 lettere (varianti flesse: lancio, lanciare), segno dal bit alto di crc32
+        words = WORD_RE.findall(text.casefold())
+        features = words + [word[:5] for word in words if len(word) > 5]
+        hashes = self.np.fromiter((zlib.crc32(feature.encode("utf-8")) for feature in features),
+                                  dtype=self.np.uint32, count=len(features))
+        signs = self.np.where(hashes & 0x80000000, -1.0, 1.0)
+        return self.np.bincount(hashes % self.dimensions, weights=signs, minlength=self.dimensions)
+    
+    def _openai_vectors(self, texts):
+        import openai
+        response = provider_call("openai", lambda: openai.Embedding.create(
+            model=KB_EMBEDDING_MODEL,
+            input=texts,
+            dimensions=self.dimensions,
+            request_timeout=provider_clients.timeout
+        ), tokens=sum(count_tokens("openai", KB_EMBEDDING_MODEL, text) for text in texts))
+        return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+    
+    def embed(self, texts):
+        """Vettori normalizzati (float32) dei testi, una riga per testo"""
+        if self.mode == 'openai':
+            matrix = self.np.array(self._openai_vectors(texts), dtype=self.np.float32)
+        else:
+            matrix = self.np.array([self._hash_vector(text) for text in texts], dtype=self.np.float32)
+        norms = self.np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / self.np.where(norms == 0, 1, norms)
+    
+    def refresh(self, db):
+        """Carica i vettori dei chunk aggiunti dopo l'ultimo caricamento"""
+        with self._lock:
+            rows = db.execute("SELECT id, vector FROM chunks WHERE id > ? AND vector IS NOT NULL ORDER BY id",
+                              (self._last_id,)).fetchall()
+            if not rows:
+                return
+            ids = self.np.fromiter((row[0] for row in rows), dtype=self.np.int64, count=len(rows))
+            matrix = self.np.frombuffer(b"".join(row[1] for row in rows), dtype=self.np.float32)
+            self._ids = self.np.concatenate([self._ids, ids])
+            self._matrix = self.np.concatenate([self._matrix, matrix.reshape(len(rows), self.dimensions)])
+            self._last_id = int(ids[-1])
+    
+    def search(self, db, query, k):
+        """[(id chunk, similarità)] dei k chunk più simili alla query"""
+        self.refresh(db)
+        ids, matrix = self._ids, self._matrix
+        if not len(ids):
+            return []
+        scores = matrix @ self.embed([query])[0]
+        k = min(k, len(ids))
+        top = self.np.argpartition(-scores, k - 1)[:k]
+        top = top[self.np.argsort(-scores[top])]
+        return [(int(ids[index]), float(scores[index])) for index in top]
+    
+    def stats(self):
+        return {"mode": self.mode, "dimensions": self.dimensions, "vectors": len(self._ids),
+                "bytes": int(self._matrix.nbytes)}
+
+def build_vector_index():
+    """Indice scelto da KB_VECTORS, None se spento o senza numpy"""
+    if KB_VECTORS not in ('hash', 'openai'):
+        return None
+    try:
+        return VectorIndex(KB_VECTORS, KB_VECTOR_DIM)
+    except ImportError:
+        logger.warning("⚠️ KB_VECTORS richiede numpy: knowledge base solo full-text")
+        return None
+
+def ensure_counters(db, backfill):
+    """Tabella counters (nome -> valore), aggiornata nelle stesse transazioni dei dati
+
+    Creata su un database che ha già dati, viene riempita una volta con le
+    query di `backfill` (SELECT nome, valore); poi le letture sono per chiave.
+    """
+    if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'counters'").fetchone():
+        return
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if not db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'counters'").fetchone():
+            db.execute("CREATE TABLE counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID")
+            for query in backfill:
+                db.execute(f"INSERT INTO counters (name, value) {query}")
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+
+def bump_counters(db, changes):
+    """Somma {nome: delta} ai contatori (dentro la transazione del chiamante)"""
+    db.executemany("""INSERT INTO counters (name, value) VALUES (?, ?)
+                      ON CONFLICT (name) DO UPDATE SET value = value + excluded.value""",
+                   [(name, delta) for name, delta in changes.items() if delta])
+
+def read_counters(db, names):
+    """{nome: valore} per chiave primaria, 0 per i contatori mai incrementati"""
+    values = dict(db.execute(f"SELECT name, value FROM counters WHERE name IN ({','.join('?' * len(names))})", names))
+    return {name: values.get(name, 0) for name in names}
+
+def today_key(prefix):
+    """Contatore del giorno (ora locale), es. emails:2026-10-18"""
+    return f"{prefix}:{date.today().isoformat()}"
+
+class KnowledgeBase:
+    """Knowledge base locale: documenti a chunk su SQLite con indice full-text FTS5
+
+    L'ingest legge il documento a blocchi e inserisce i chunk a lotti in
+    un'unica transazione (un documento è indicizzato tutto o niente); un
+    documento con lo stesso contenuto (sha256) già presente non viene
+    duplicato. La ricerca unisce BM25 full-text e, se attivo, l'indice
+    vettoriale con reciprocal rank fusion.
+    """
+    
+    def __init__(self, path, chunk_chars, overlap, vectors=None):
+        self.path = path
+        self.chunk_chars = chunk_chars
+        self.overlap = overlap
+        self.vectors = vectors
+        self.searches = self.ingested = self.duplicates = 0
+        self.reset()
+    
+    def reset(self):
+        """Dopo il fork: connessioni e vettori del padre non vanno condivisi"""
+        self._local = threading.local()
+        self._df_lock = threading.Lock()
+        self._df = OrderedDict()
+        if self.vectors is not None:
+            self.vectors.reset()
+    
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                source TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                chunks INTEGER NOT NULL,
+                chars INTEGER NOT NULL,
+                created_at REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS documents_sha256 ON documents (sha256)")
+            db.execute("""CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                document_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                vector BLOB)""")
+            db.execute("CREATE INDEX IF NOT EXISTS chunks_document ON chunks (document_id, position)")
+            # Indice invertito sul testo dei chunk, allineato dai trigger
+            db.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+                text, content='chunks', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""")
+            db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_vocab USING fts5vocab(chunks_fts, 'row')")
+            db.execute("""CREATE TRIGGER IF NOT EXISTS chunks_fts_insert AFTER INSERT ON chunks BEGIN
+                INSERT INTO chunks_fts (rowid, text) VALUES (new.id, new.text); END""")
+            db.execute("""CREATE TRIGGER IF NOT EXISTS chunks_fts_delete AFTER DELETE ON chunks BEGIN
+                INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', old.id, old.text); END""")
+            ensure_counters(db, [
+                "SELECT 'documents', COUNT(*) FROM documents",
+                "SELECT 'chunks', COALESCE(SUM(chunks), 0) FROM documents",
+                "SELECT 'documents:' || date(created_at, 'unixepoch', 'localtime'), COUNT(*) FROM documents GROUP BY 1"
+            ])
+            self._local.db = db
+        return db
+    
+    def ingest(self, name, blocks, source="api"):
+        """Indicizza un documento da un iterabile di blocchi di testo: ritorna il documento
+
+        Il testo va in un file temporaneo mentre se ne calcola lo sha256: con
+        lo stesso contenuto già indicizzato torna subito il documento esistente
+        con duplicate=True, senza chunking né embeddings. Gli embeddings (una
+        chiamata al provider con KB_VECTORS=openai) sono calcolati fuori dalla
+        transazione a lotti di KB_INSERT_BATCH e accodati in un secondo file
+        temporaneo; la transazione copre solo gli INSERT finali, a lotti, e i
+        contatori.
+        """
+        started = time.monotonic()
+        digest = hashlib.sha256()
+        chars = 0
+        with tempfile.SpooledTemporaryFile(max_size=KB_SPOOL_CHARS, mode="w+", encoding="utf-8") as spool, \
+                tempfile.SpooledTemporaryFile(max_size=KB_SPOOL_CHARS) as staged:
+            for block in blocks:
+                digest.update(block.encode("utf-8"))
+                chars += len(block)
+                spool.write(block)
+            sha256 = digest.hexdigest()
+            existing = self.find(sha256)
+            if existing is not None:
+                self.duplicates += 1
+                return dict(self.document(existing), duplicate=True)
+            
+            def chunks():
+                spool.seek(0)
+                return iter_chunks(iter(lambda: spool.read(KB_BLOCK_CHARS), ""), self.chunk_chars, self.overlap)
+            
+            # Vettori float32 a dimensione fissa: si rileggono dal file temporaneo un lotto alla volta
+            if self.vectors is not None:
+                for batch in batched(chunks(), KB_INSERT_BATCH):
+                    staged.write(self.vectors.embed(batch).tobytes())
+                staged.seek(0)
+            
+            def vectors(count):
+                if self.vectors is None:
+                    return [None] * count
+                size = self.vectors.dimensions * 4
+                data = staged.read(count * size)
+                return [data[index * size:(index + 1) * size] for index in range(count)]
+            
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # Stesso documento indicizzato nel frattempo da un'altra richiesta
+                existing = db.execute("SELECT id FROM documents WHERE sha256 = ?", (sha256,)).fetchone()
+                if existing is not None:
+                    db.execute("ROLLBACK")
+                    self.duplicates += 1
+                    return dict(self.document(existing[0]), duplicate=True)
+                document_id = db.execute(
+                    "INSERT INTO documents (name, source, sha256, chunks, chars, created_at) VALUES (?, ?, ?, 0, ?, ?)",
+                    (name, source, sha256, chars, time.time())).lastrowid
+                count = 0
+                for batch in batched(chunks(), KB_INSERT_BATCH):
+                    db.executemany("INSERT INTO chunks (document_id, position, text, vector) VALUES (?, ?, ?, ?)",
+                                   [(document_id, count + index, text, vector)
+                                    for index, (text, vector) in enumerate(zip(batch, vectors(len(batch))))])
+                    count += len(batch)
+                db.execute("UPDATE documents SET chunks = ? WHERE id = ?", (count, document_id))
+                bump_counters(db, {"documents": 1, "chunks": count, today_key("documents"): 1})
+                db.execute("COMMIT")
+            except BaseException:
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                raise
+        self.ingested += 1
+        logger.info(f"📚 KB: {name} indicizzato ({count} chunk) in {time.monotonic() - started:.2f}s")
+        return dict(self.document(document_id), duplicate=False,
+                    elapsed_ms=round((time.monotonic() - started) * 1000, 1))
+    
+    def find(self, sha256):
+        """Id del documento con questo contenuto, None se non indicizzato"""
+        row = self._db().execute("SELECT id FROM documents WHERE sha256 = ?", (sha256,)).fetchone()
+        return row[0] if row else None
+    
+    def document(self, document_id):
+        """Documento in formato API, None se sconosciuto"""
+        row = self._db().execute("SELECT id, name, source, sha256, chunks, chars, created_at FROM documents WHERE id = ?",
+                                 (document_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "document_id": row[0],
+            "name": row[1],
+            "source": row[2],
+            "sha256": row[3],
+            "chunks": row[4],
+            "chars": row[5],
+            "created_at": datetime.fromtimestamp(row[6]).isoformat()
+        }
+    
+    def delete(self, document_id):
+        """Rimuove documento e chunk (anche dall'indice full-text); False se sconosciuto"""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT chunks, created_at FROM documents WHERE id = ?", (document_id,)).fetchone()
+            db.execute("DELETE FROM chunks WHERE document_id = ?", (document_id,))
+            deleted = db.execute("DELETE FROM documents WHERE id = ?", (document_id,)).rowcount
+            if deleted:
+                day = f"documents:{date.fromtimestamp(row[1]).isoformat()}"
+                bump_counters(db, {"documents": -1, "chunks": -row[0], day: -1})
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if deleted and self.vectors is not None:
+            # Ricarica alla prossima ricerca; negli altri worker i vettori rimossi non superano la JOIN sui chunk
+            self.vectors.reset()
+        return bool(deleted)
+    
+    def empty(self):
+        return self._db().execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None
+    
+    def _frequencies(self, db, terms):
+        """Chunk che contengono ciascun termine (fts5vocab, con cache LRU per worker)"""
+        now = time.monotonic()
+        frequencies = {}
+        with self._df_lock:
+            for term in terms:
+                entry = self._df.get(term)
+                if entry is not None and entry[1] > now:
+                    self._df.move_to_end(term)
+                    frequencies[term] = entry[0]
+        for term in terms:
+            if term not in frequencies:
+                row = db.execute("SELECT doc FROM chunks_vocab WHERE term = ?", (term,)).fetchone()
+                frequencies[term] = row[0] if row else 0
+                with self._df_lock:
+                    self._df[term] = (frequencies[term], now + KB_DF_TTL)
+                    while len(self._df) > KB_DF_CACHE_SIZE:
+                        self._df.popitem(last=False)
+        return frequencies
+    
+    def match_query(self, db, query):
+        """Espressione MATCH con i termini più distintivi del testo, None se nessuno è utile"""
+        terms = query_terms(query)
+        if not terms:
+            return None
+        frequencies = self._frequencies(db, terms)
+        selected, postings = [], 0
+        for term in sorted(terms, key=frequencies.get):
+            df = frequencies[term]
+            if df == 0:
+                continue
+            if len(selected) >= KB_MATCH_TERMS or postings + df > KB_MATCH_POSTINGS:
+                break
+            selected.append(term)
+            postings += df
+        return " OR ".join(f'"{term}"' for term in selected) or None
+    
+    def search(self, query, k=KB_TOP_K):
+        """I k chunk più rilevanti: [{chunk_id, document_id, document, position, text, score}]"""
+        self.searches += 1
+        db = self._db()
+        rankings = []
+        match = self.match_query(db, query)
+        if match:
+            rankings.append([row[0] for row in db.execute(
+                "SELECT rowid FROM chunks_fts WHERE chunks_fts MATCH ? ORDER BY rank LIMIT ?", (match, k * 4))])
+        if self.vectors is not None and query.strip():
+            rankings.append([chunk_id for chunk_id, similarity in self.vectors.search(db, query, k * 4)
+                             if similarity >= KB_MIN_SIMILARITY])
+        # Reciprocal rank fusion: conta la posizione in ciascun indice, non i punteggi (scale diverse)
+        scores = Counter()
+        for ranking in rankings:
+            for rank, chunk_id in enumerate(ranking):
+                scores[chunk_id] += 1 / (60 + rank)
+        top = [chunk_id for chunk_id, _ in scores.most_common(k)]
+        if not top:
+            return []
+        rows = {row[0]: row for row in db.execute(
+            f"""SELECT chunks.id, chunks.document_id, documents.name, chunks.position, chunks.text
+                FROM chunks JOIN documents ON documents.id = chunks.document_id
+                WHERE chunks.id IN ({",".join("?" * len(top))})""", top)}
+        return [{
+            "chunk_id": chunk_id,
+            "document_id": rows[chunk_id][1],
+            "document": rows[chunk_id][2],
+            "position": rows[chunk_id][3],
+            "text": rows[chunk_id][4],
+            "score": round(scores[chunk_id], 5)
+        } for chunk_id in top if chunk_id in rows]
+    
+    def counters(self):
+        """Documenti e chunk indicizzati, documenti aggiunti oggi (contatori, nessuna scansione)"""
+        values = read_counters(self._db(), ["documents", "chunks", today_key("documents")])
+        return {"documents": values["documents"], "chunks": values["chunks"],
+                "documents_today": values[today_key("documents")]}
+    
+    def stats(self):
+        counters = self.counters()
+        return {
+            "path": self.path,
+            "documents": counters["documents"],
+            "chunks": counters["chunks"],
+            "searches": self.searches,
+            "ingested": self.ingested,
+            "duplicates": self.duplicates,
+            "vectors": self.vectors.stats() if self.vectors else {"mode": "off"}
+        }
+
+def knowledge_context(agent, chunks, message):
+    """(briefing preceduto dai chunk che stanno in KB_CONTEXT_TOKENS, chunk usati)"""
+    parts, used = [], 0
+    for chunk in chunks:
+        text = f"[{chunk['document']}] {chunk['text']}"
+        tokens = agent.count_tokens(text)
+        if used + tokens > KB_CONTEXT_TOKENS:
+            continue
+        parts.append(text)
+        used += tokens
+    if not parts:
+        return message, 0
+    return KB_CONTEXT_HEADER + "\n\n" + "\n\n".join(parts) + f"\n\n{message}", len(parts)
+
+knowledge_base = KnowledgeBase(KB_DB_PATH, KB_CHUNK_CHARS, KB_CHUNK_OVERLAP, build_vector_index())
+os.register_at_fork(after_in_child=knowledge_base.reset)
+
+# ============================================================================
+# TASK DA EMAIL (parsing, estrazione e task store)
+# ============================================================================
+
+# Email e task per transazione nelle sincronizzazioni di caselle: il lock di scrittura dura poco
+TASK_INSERT_BATCH = 500
+TASK_TITLE_CHARS = 200
+TASK_STATUSES = ('open', 'done')
+TASK_COLUMNS = ("tasks.id, tasks.email_id, emails.subject, tasks.title, tasks.assignee, tasks.due, "
+                "tasks.priority, tasks.status, tasks.created_at, tasks.updated_at")
+
+EMAIL_TASK_PROMPT = """Estrai i task operativi da questa email per il team AYROMEX.
+Rispondi solo con un array JSON, senza altro testo:
+[{{"title": "cosa fare", "assignee": "nome o null", "due": "AAAA-MM-GG o null", "priority": "high o normal"}}]
+Oggi è {today}. Se l'email non contiene task rispondi [].
+
+Da: {sender}
+Oggetto: {subject}
+
+{body}"""
+
+# Corpo dell'email: la conversazione citata e la firma non contengono task nuovi
+QUOTE_HEADER_RE = re.compile(r"^(?:on .+ wrote:|il .+ ha scritto:|-{2,} ?(?:original message|messaggio originale|"
+                             r"forwarded message|messaggio inoltrato) ?-{2,})$", re.I)
+SIGNATURE_RE = re.compile(r"^(?:--|(?:inviato da|sent from) .+)$", re.I)
+HTML_DROP_RE = re.compile(r"<(script|style)\b.*?</\1>", re.I | re.S)
+HTML_ITEM_RE = re.compile(r"<li\b[^>]*>", re.I)
+HTML_BREAK_RE = re.compile(r"<br\s*/?>|</(?:p|div|li|tr|h\d)>", re.I)
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+JSON_ARRAY_RE = re.compile(r"\[.*\]", re.S)
+
+# Regole locali: elenchi sotto un titolo "Da fare:", richieste esplicite, frasi che iniziano con un verbo d'azione
+BULLET_RE = re.compile(r"^(?:[-*•–]|\d{1,2}[.)]|\[ ?\])\s+")
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+TASK_LIST_RE = re.compile(r"^(?:da fare|todo|to do|to-do|task|action items?|prossimi passi|next steps|attività)\b.*:$",
+                          re.I)
+TASK_HINT_RE = re.compile(r"\b(?:puoi|potresti|potete|potreste|per favore|per cortesia|ti chiedo|vi chiedo|devi|"
+                          r"dovete|bisogna|occorre|servirebbe|ricordati|ricordatevi|da fare|todo|please|can you|"
+                          r"could you|need to|needs to|must|make sure|remember to)\b", re.I)
+TASK_VERB_RE = re.compile(r"^(?:prepara|preparate|invia|inviate|manda|mandate|organizza|chiama|verifica|controlla|"
+                          r"aggiorna|scrivi|fissa|prenota|rivedi|completa|sistema|contatta|send|prepare|call|check|"
+                          r"update|review|schedule|book|write|organize|fix|contact|complete)\b", re.I)
+URGENT_RE = re.compile(r"\b(?:urgente|urgenza|asap|subito|priorità alta|alta priorità|urgent|high priority|"
+                       r"immediately)\b", re.I)
+ASSIGNEE_RE = re.compile(r"(?<![\w.])@(\w[\w.]*)|(?i:assegnat[oa] a|assign(?:ed)? to|responsabile:?|owner:?)\s+"
+                         r"([A-ZÀ-Ý][\w'-]+)")
+GREETING_RE = re.compile(r"^(?:ciao|salve|buongiorno|buonasera|gentile|caro|cara|hi|hello|dear)\b[^,.!?]{0,40}[,!]\s+",
+                         re.I)
+VOCATIVE_RE = re.compile(r"^([A-ZÀ-Ý][a-zà-ÿ]+),\s+(?=(?i:puoi|potresti|per favore|please|can you|could you|"
+                         r"ti chiedo)\b)")
+
+# Scadenze: date esplicite, giorni della settimana, oggi/domani, "entro 48h", "tra 3 giorni"
+MONTHS = {name: index % 12 + 1 for index, name in enumerate(
+    "gennaio febbraio marzo aprile maggio giugno luglio agosto settembre ottobre novembre dicembre "
+    "january february march april may june july august september october november december".split())}
+WEEKDAYS = {name: index % 7 for index, name in enumerate(
+    "lunedì martedì mercoledì giovedì venerdì sabato domenica "
+    "monday tuesday wednesday thursday friday saturday sunday".split())}
+RELATIVE_DAYS = {"oggi": 0, "stasera": 0, "today": 0, "tonight": 0, "domani": 1, "tomorrow": 1, "dopodomani": 2}
+DUE_RE = re.compile(
+    r"\b(?P<iso>\d{4}-\d{2}-\d{2})\b"
+    r"|\b(?P<day>\d{1,2})[/.](?P<month>\d{1,2})(?:[/.](?P<year>\d{4}|\d{2}))?\b"
+    rf"|\b(?P<mday>\d{{1,2}})\s+(?P<mname>{'|'.join(MONTHS)})(?:\s+(?P<myear>\d{{4}}))?\b"
+    rf"|\b(?P<weekday>{'|'.join(WEEKDAYS)})"
+    rf"|\b(?P<relative>{'|'.join(RELATIVE_DAYS)})\b"
+    r"|\b(?:entro|tra|fra|in|within)\s+(?P<amount>\d{1,3})\s*"
+    r"(?P<unit>h\b|ore\b|hours?\b|giorni\b|days?\b|settimane\b|weeks?\b)",
+    re.I)
+
+class TaskError(ValueError):
+    """Richiesta non valida per lo store dei task (filtri, aggiornamenti, sincronizzazione)"""
+
+def parse_due(match, base):
+    """Data di una scadenza trovata da DUE_RE (ValueError se non è una data valida)"""
+    if match["iso"]:
+        return date.fromisoformat(match["iso"])
+    if match["day"] or match["mday"]:
+        day = int(match["day"] or match["mday"])
+        month = int(match["month"]) if match["day"] else MONTHS[match["mname"].lower()]
+        year = match["year"] or match["myear"]
+        if year:
+            return date(int(year) + (2000 if len(year) == 2 else 0), month, day)
+        due = date(base.year, month, day)
+        # Senza anno: la prossima occorrenza ("entro il 10/01" in un'email di dicembre)
+        return due if due >= base - timedelta(days=30) else date(base.year + 1, month, day)
+    if match["weekday"]:
+        return base + timedelta(days=(WEEKDAYS[match["weekday"].lower()] - base.weekday()) % 7)
+    if match["relative"]:
+        return base + timedelta(days=RELATIVE_DAYS[match["relative"].lower()])
+    amount, unit = int(match["amount"]), match["unit"].lower()
+    if unit in ("h", "ore", "hour", "hours"):
+        return base + timedelta(days=-(-amount // 24))
+    return base + timedelta(days=amount * (7 if unit in ("settimane", "week", "weeks") else 1))
+
+def due_date(text, base):
+    """Prima scadenza nel testo (AAAA-MM-GG) rispetto alla data dell'email, None se assente"""
+    for match in DUE_RE.finditer(text):
+        try:
+            return parse_due(match, base).isoformat()
+        except ValueError:
+            continue
+    return None
+
+def html_to_text(markup):
+    markup = HTML_ITEM_RE.sub("\n- ", HTML_DROP_RE.sub(" ", markup))
+    return html.unescape(HTML_TAG_RE.sub("", HTML_BREAK_RE.sub("\n", markup)))
+
+def clean_email_body(text):
+    """Corpo senza la conversazione citata (righe "> ..." e tutto dopo "Il ... ha scritto:") e senza firma"""
+    lines = []
+    for line in text.replace("\r\n", "\n").split("\n"):
+        stripped = line.strip()
+        if QUOTE_HEADER_RE.match(stripped) or SIGNATURE_RE.match(stripped):
+            break
+        if not stripped.startswith(">"):
+            lines.append(line.rstrip())
+    return "\n".join(lines).strip()
+
+def email_received_at(value):
+    """Timestamp dell'header Date (RFC 2822 o ISO 8601), adesso se assente o illeggibile"""
+    if value:
+        for parse in (parsedate_to_datetime, datetime.fromisoformat):
+            try:
+                return parse(str(value)).timestamp()
+            except (TypeError, ValueError):
+                continue
+    return time.time()
+
+def parse_email(data):
+    """Email da un payload API/n8n: {raw} (messaggio RFC 822) oppure {content|text|html, subject, from, message_id, date}
+
+    Ritorna {hash, message_id, sender, subject, body, received_at}, con il
+    corpo già ripulito: è il testo da cui si estraggono i task.
+    """
+    if data.get("raw"):
+        raw = data["raw"].encode("utf-8", "surrogateescape") if isinstance(data["raw"], str) else data["raw"]
+        mail = message_from_bytes(raw, policy=email_policy.default)
+        part = mail.get_body(preferencelist=("plain", "html"))
+        body = part.get_content() if part is not None else ""
+        if part is not None and part.get_content_type() == "text/html":
+            body = html_to_text(body)
+        message_id, sender, subject, received = mail["Message-ID"], mail["From"], mail["Subject"], mail["Date"]
+    else:
+        body = data.get("content") or data.get("text") or data.get("textPlain") or ""
+        if not body and (data.get("html") or data.get("textHtml")):
+            body = html_to_text(data.get("html") or data.get("textHtml"))
+        message_id = data.get("message_id") or data.get("messageId")
+        sender, subject, received = data.get("from") or data.get("sender"), data.get("subject"), data.get("date")
+    body = clean_email_body(str(body))
+    message_id = str(message_id or "").strip().strip("<>")
+    sender, subject = str(sender or "").strip(), " ".join(str(subject or "").split())
+    # Stesso Message-ID = stessa email; senza, conta il contenuto (spazi e maiuscole esclusi)
+    identity = f"id:{message_id}" if message_id else "\n".join(
+        [sender.casefold(), subject.casefold(), " ".join(body.split()).casefold()])
+    return {
+        "hash": hashlib.sha256(identity.encode("utf-8")).hexdigest(),
+        "message_id": message_id or None,
+        "sender": sender,
+        "subject": subject,
+        "body": body,
+        "received_at": email_received_at(received)
+    }
+
+def email_task(text, base, due, urgent):
+    """Task da una frase: assegnatario (vocativo, @nome, "assegnato a"), scadenza, priorità"""
+    assignee = None
+    greeting = GREETING_RE.match(text)
+    if greeting:
+        text = text[greeting.end():]
+    vocative = VOCATIVE_RE.match(text)
+    if vocative:
+        assignee, text = vocative.group(1), text[vocative.end():]
+    else:
+        mention = ASSIGNEE_RE.search(text)
+        if mention:
+            assignee = (mention.group(1) or mention.group(2)).strip(".")
+            if mention.start() == 0:
+                text = text[mention.end():].lstrip(" ,:")
+    title = text.strip().rstrip(".!?;:").strip()
+    title = title[:1].upper() + title[1:]
+    if len(title) > TASK_TITLE_CHARS:
+        title = title[:TASK_TITLE_CHARS - 1].rstrip() + "…"
+    return {
+        "title": title,
+        "assignee": assignee,
+        "due": due_date(text, base) or due,
+        "priority": "high" if urgent or URGENT_RE.search(text) else "normal"
+    }
+
+def rule_tasks(mail):
+    """Task con le regole locali (nessuna chiamata API); senza richieste esplicite, un task di risposta"""
+    base = date.fromtimestamp(mail["received_at"])
+    default_due = due_date(f"{mail['subject']}\n{mail['body']}", base)
+    urgent = bool(URGENT_RE.search(mail["subject"]))
+    tasks, listing = [], False
+    for line in mail["body"].split("\n"):
+        line = line.strip()
+        if not line:
+            listing = False
+            continue
+        if TASK_LIST_RE.match(line):
+            listing = True
+            continue
+        bullet = BULLET_RE.match(line)
+        sentences = [line[bullet.end():]] if bullet else SENTENCE_RE.split(line)
+        for sentence in sentences:
+            if (bullet and listing) or TASK_HINT_RE.search(sentence) or TASK_VERB_RE.match(sentence):
+                tasks.append(email_task(sentence, base, default_due, urgent))
+                if len(tasks) >= EMAIL_MAX_TASKS:
+                    return tasks
+    if not tasks and (mail["subject"] or mail["body"]):
+        topic = mail["subject"] or SENTENCE_RE.split(mail["body"], 1)[0]
+        tasks.append(email_task(f"Analizza e rispondi: {topic}", base, default_due, urgent))
+    return tasks
+
+def agent_tasks(mail, agent):
+    """Task estratti dall'agente come JSON; None se la risposta non è utilizzabile"""
+    base = date.fromtimestamp(mail["received_at"])
+    body, _ = agent.shape(mail["body"])
+    prompt = EMAIL_TASK_PROMPT.format(today=base.isoformat(), sender=mail["sender"] or "-",
+                                      subject=mail["subject"] or "-", body=body)
+    response = cached_call(agent.with_output_limit(OUTPUT_TOKENS["batch"]), prompt)
+    match = None if is_failure(response) else JSON_ARRAY_RE.search(response)
+    if match is None:
+        return None
+    try:
+        items = json.loads(match.group(0))
+    except ValueError:
+        return None
+    tasks = []
+    for item in items[:EMAIL_MAX_TASKS]:
+        if not isinstance(item, dict) or not str(item.get("title") or "").strip():
+            continue
+        assignee = str(item.get("assignee") or "").strip()
+        tasks.append({
+            "title": str(item["title"]).strip()[:TASK_TITLE_CHARS],
+            "assignee": assignee if assignee.lower() not in ("", "null", "none") else None,
+            "due": due_date(str(item["due"]), base) if item.get("due") else None,
+            "priority": "high" if str(item.get("priority", "")).lower() in ("high", "alta", "urgent") else "normal"
+        })
+    return tasks
+
+def email_task_agent(mode):
+    """Agente per l'estrazione dei task, None se si usano le regole locali"""
+    agent = AGENT_REGISTRY.get(EMAIL_TASK_AGENT)
+    return agent if mode == 'agent' and agent is not None and agent.active() else None
+
+def extract_tasks(mail, agent=None):
+    """(task, metodo): l'agente se c'è e risponde in JSON, altrimenti le regole locali"""
+    if agent is not None:
+        tasks = agent_tasks(mail, agent)
+        if tasks is not None:
+            return tasks, agent.key
+    return rule_tasks(mail), "rules"
+
+class TaskStore:
+    """Email elaborate e task estratti su SQLite
+
+    L'hash dell'email è unico: un'email già vista non viene rielaborata né
+    salvata due volte (anche se due worker la ricevono insieme). Le liste
+    di task leggono dagli indici (stato, id), (stato, scadenza, id) e
+    (assegnatario, stato, ...) con paginazione a cursore, senza OFFSET:
+    il costo dipende dalla pagina, non da quanti task ci sono.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.processed = self.duplicates = 0
+        self.reset()
+    
+    def reset(self):
+        """Dopo il fork: le connessioni del padre non vanno condivise"""
+        self._local = threading.local()
+    
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS emails (
+                id INTEGER PRIMARY KEY,
+                hash TEXT NOT NULL UNIQUE,
+                message_id TEXT,
+                sender TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                source TEXT NOT NULL,
+                extracted_by TEXT NOT NULL,
+                tasks INTEGER NOT NULL,
+                received_at REAL NOT NULL,
+                created_at REAL NOT NULL)""")
+            db.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY,
+                email_id INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                assignee TEXT,
+                due TEXT,
+                priority TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_due ON tasks (status, due, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_assignee ON tasks (assignee, status, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_assignee_due ON tasks (assignee, status, due, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_email ON tasks (email_id)")
+            ensure_counters(db, [
+                "SELECT 'emails', COUNT(*) FROM emails",
+                "SELECT 'tasks', COUNT(*) FROM tasks",
+                "SELECT 'open_tasks', COUNT(*) FROM tasks WHERE status = 'open'",
+                "SELECT 'emails:' || date(created_at, 'unixepoch', 'localtime'), COUNT(*) FROM emails GROUP BY 1"
+            ])
+            self._local.db = db
+        return db
+    
+    def known(self, hashes):
+        """{hash: email_id} delle email già salvate"""
+        hashes, found = list(hashes), {}
+        db = self._db()
+        for start in range(0, len(hashes), TASK_INSERT_BATCH):
+            batch = hashes[start:start + TASK_INSERT_BATCH]
+            found.update(db.execute(f"SELECT hash, id FROM emails WHERE hash IN ({','.join('?' * len(batch))})",
+                                    batch).fetchall())
+        return found
+    
+    def add(self, extracted, source):
+        """Salva [(email, task, metodo)] a blocchi di TASK_INSERT_BATCH email per transazione
+
+        Ritorna gli id delle email, None per quelle salvate nel frattempo da
+        un'altra richiesta (i loro task non vengono inseriti).
+        """
+        db = self._db()
+        ids = []
+        for start in range(0, len(extracted), TASK_INSERT_BATCH):
+            now = time.time()
+            rows = []
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for mail, tasks, method in extracted[start:start + TASK_INSERT_BATCH]:
+                    cursor = db.execute(
+                        """INSERT OR IGNORE INTO emails (hash, message_id, sender, subject, source, extracted_by, tasks,
+                           received_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        (mail["hash"], mail["message_id"], mail["sender"], mail["subject"], source, method, len(tasks),
+                         mail["received_at"], now))
+                    if not cursor.rowcount:
+                        ids.append(None)
+                        continue
+                    ids.append(cursor.lastrowid)
+                    rows += [(cursor.lastrowid, task["title"], (task["assignee"] or "").casefold() or None,
+                              task["due"], task["priority"], now, now) for task in tasks]
+                db.executemany("""INSERT INTO tasks (email_id, title, assignee, due, priority, status, created_at,
+                                  updated_at) VALUES (?, ?, ?, ?, ?, 'open', ?, ?)""", rows)
+                created = sum(email_id is not None for email_id in ids[start:])
+                bump_counters(db, {"emails": created, today_key("emails"): created,
+                                   "tasks": len(rows), "open_tasks": len(rows)})
+                db.execute("COMMIT")
+            except BaseException:
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                raise
+        return ids
+    
+    @staticmethod
+    def _task(row):
+        return {
+            "task_id": row[0],
+            "email_id": row[1],
+            "subject": row[2],
+            "title": row[3],
+            "assignee": row[4],
+            "due": row[5],
+            "priority": row[6],
+            "status": row[7],
+            "created_at": datetime.fromtimestamp(row[8]).isoformat(),
+            "updated_at": datetime.fromtimestamp(row[9]).isoformat()
+        }
+    
+    def get(self, task_id):
+        row = self._db().execute(f"SELECT {TASK_COLUMNS} FROM tasks JOIN emails ON emails.id = tasks.email_id "
+                                 "WHERE tasks.id = ?", (task_id,)).fetchone()
+        return self._task(row) if row else None
+    
+    def email_tasks(self, email_id):
+        return [self._task(row) for row in self._db().execute(
+            f"SELECT {TASK_COLUMNS} FROM tasks JOIN emails ON emails.id = tasks.email_id "
+            "WHERE tasks.email_id = ? ORDER BY tasks.id", (email_id,))]
+    
+    def tasks(self, status="open", assignee=None, due_before=None, due_after=None, order=None, limit=50, cursor=None):
+        """Una pagina di task: (task, cursore della pagina successiva o None)
+
+        order="due" (default con un filtro sulle date) elenca i task con
+        scadenza dalla più vicina, "recent" dal più recente.
+        """
+        if status not in TASK_STATUSES:
+            raise TaskError(f"Stato non valido: {status} (ammessi: {', '.join(TASK_STATUSES)})")
+        order = order or ("due" if due_before or due_after else "recent")
+        if order not in ("due", "recent"):
+            raise TaskError(f"Ordinamento non valido: {order} (ammessi: due, recent)")
+        where, params = ["tasks.status = ?"], [status]
+        if assignee:
+            where.append("tasks.assignee = ?")
+            params.append(assignee.casefold())
+        for bound, operator in ((due_after, ">="), (due_before, "<=")):
+            if bound:
+                where.append(f"tasks.due {operator} ?")
+                params.append(task_date(bound))
+        try:
+            if order == "due":
+                where.append("tasks.due IS NOT NULL")
+                if cursor:
+                    due, task_id = cursor.rsplit(":", 1)
+                    where.append("(tasks.due > ? OR (tasks.due = ? AND tasks.id > ?))")
+                    params += [due, due, int(task_id)]
+            elif cursor:
+                where.append("tasks.id < ?")
+                params.append(int(cursor))
+        except ValueError:
+            raise TaskError(f"Cursore non valido: {cursor}") from None
+        rows = self._db().execute(
+            f"""SELECT {TASK_COLUMNS} FROM tasks JOIN emails ON emails.id = tasks.email_id
+                WHERE {' AND '.join(where)} ORDER BY {'tasks.due, tasks.id' if order == 'due' else 'tasks.id DESC'}
+                LIMIT ?""", params + [limit + 1]).fetchall()
+        tasks = [self._task(row) for row in rows[:limit]]
+        if len(rows) <= limit:
+            return tasks, None
+        last = tasks[-1]
+        return tasks, f"{last['due']}:{last['task_id']}" if order == "due" else str(last["task_id"])
+    
+    def update(self, task_id, changes):
+        """Aggiorna stato, titolo, assegnatario o scadenza; None se il task non esiste"""
+        fields = {}
+        if "status" in changes:
+            if changes["status"] not in TASK_STATUSES:
+                raise TaskError(f"Stato non valido: {changes['status']} (ammessi: {', '.join(TASK_STATUSES)})")
+            fields["status"] = changes["status"]
+        if "title" in changes:
+            if not str(changes["title"] or "").strip():
+                raise TaskError("Il titolo non può essere vuoto")
+            fields["title"] = str(changes["title"]).strip()[:TASK_TITLE_CHARS]
+        if "assignee" in changes:
+            fields["assignee"] = str(changes["assignee"] or "").strip().casefold() or None
+        if "due" in changes:
+            fields["due"] = task_date(changes["due"]) if changes["due"] else None
+        if not fields:
+            raise TaskError("Nessun campo da aggiornare (status, title, assignee, due)")
+        fields["updated_at"] = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT status FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            if row is not None:
+                db.execute(f"UPDATE tasks SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+                           list(fields.values()) + [task_id])
+                if fields.get("status", row[0]) != row[0]:
+                    bump_counters(db, {"open_tasks": 1 if fields["status"] == "open" else -1})
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return self.get(task_id) if row is not None else None
+    
+    def counters(self):
+        """Email elaborate (in tutto e oggi), task creati e aperti (contatori, nessuna scansione)"""
+        values = read_counters(self._db(), ["emails", today_key("emails"), "tasks", "open_tasks"])
+        return {"emails": values["emails"], "emails_today": values[today_key("emails")],
+                "tasks": values["tasks"], "open_tasks": values["open_tasks"]}
+    
+    def stats(self):
+        return dict(self.counters(), **{
+            "path": self.path,
+            "processed": self.processed,
+            "duplicates": self.duplicates
+        })
+
+def task_date(value):
+    """Data AAAA-MM-GG di un filtro o aggiornamento (TaskError se non valida)"""
+    try:
+        return date.fromisoformat(str(value)).isoformat()
+    except ValueError:
+        raise TaskError(f"Data non valida: {value} (formato AAAA-MM-GG)") from None
+
+def process_emails(payloads, source="api", extract=None):
+    """Pipeline email -> task per una o più email: parsing, dedupe, estrazione, salvataggio a blocchi
+
+    Le email già salvate o ripetute nel lotto non arrivano all'estrazione;
+    con l'agente le estrazioni del lotto girano in parallelo sul pool agenti
+    (restano i limiti per provider).
+    """
+    started = time.monotonic()
+    mails = [parse_email(payload) for payload in payloads]
+    known = task_store.known({mail["hash"] for mail in mails})
+    fresh, seen = [], set(known)
+    for mail in mails:
+        if mail["hash"] not in seen:
+            seen.add(mail["hash"])
+            fresh.append(mail)
+    agent = email_task_agent(extract or EMAIL_TASK_EXTRACTION)
+    if agent is not None and len(fresh) > 1:
+        extracted = list(agent_executor.map(lambda mail: extract_tasks(mail, agent), fresh))
+    else:
+        extracted = [extract_tasks(mail, agent) for mail in fresh]
+    saved = dict(zip((mail["hash"] for mail in fresh),
+                     task_store.add([(mail, tasks, method) for mail, (tasks, method) in zip(fresh, extracted)], source)))
+    methods = {mail["hash"]: (len(tasks), method) for mail, (tasks, method) in zip(fresh, extracted)}
+    
+    results = []
+    for mail in mails:
+        email_id = saved.pop(mail["hash"], None)
+        created = email_id is not None
+        tasks, method = methods[mail["hash"]] if created else (0, None)
+        results.append({
+            "email_id": email_id if created else known.get(mail["hash"]),
+            "subject": mail["subject"],
+            "duplicate": not created,
+            "tasks": tasks,
+            "extracted_by": method
+        })
+    created = sum(not result["duplicate"] for result in results)
+    task_store.processed += created
+    task_store.duplicates += len(results) - created
+    return {
+        "emails": len(results),
+        "created": created,
+        "duplicates": len(results) - created,
+        "tasks_created": sum(result["tasks"] for result in results),
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+        "results": results
+    }
+
+def email_payloads(data):
+    """Email di una richiesta: {"emails": [...]}, una lista o una singola email"""
+    payloads = data if isinstance(data, list) else data.get("emails") if isinstance(data.get("emails"), list) else [data]
+    if not payloads:
+        raise TaskError("Nessuna email: serve un'email o una lista \"emails\"")
+    if len(payloads) > EMAIL_SYNC_MAX_ITEMS:
+        raise TaskError(f"Troppe email: {len(payloads)} (massimo {EMAIL_SYNC_MAX_ITEMS} per richiesta)")
+    if not all(isinstance(payload, dict) for payload in payloads):
+        raise TaskError("Email non valida: atteso un oggetto {content, subject, from, message_id} o {raw}")
+    return payloads
+
+task_store = TaskStore(TASK_DB_PATH)
+os.register_at_fork(after_in_child=task_store.reset)
+
+# ============================================================================
+# CIRCUIT BREAKER E HEDGING
+# ============================================================================
+
+def hedging_enabled(name):
+    """Hedging solo per gli agenti testuali di HEDGE_AGENTS: una seconda immagine verrebbe fatturata"""
+    agent = AGENT_REGISTRY.get(name)
+    return name in HEDGE_AGENTS and agent is not None and agent.kind == "text"
+
+for name in sorted(HEDGE_AGENTS):
+    if not hedging_enabled(name):
+        logger.warning(f"⚠️ HEDGE_AGENTS: {name} ignorato (solo agenti testuali registrati)")
+
+class AgentHealth:
+    """Circuit breaker e latenze recenti di un agente
+
+    closed: le chiamate passano. open: falliscono subito (o servono la cache)
+    per BREAKER_COOLDOWN secondi. half_open: passa una sola chiamata di prova,
+    che richiude il circuito se va bene e lo riapre altrimenti.
+    """
+    
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+    
+    def reset(self):
+        """Stato nuovo (anche dopo il fork)"""
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.opens = self.short_circuited = self.hedges = self.hedge_wins = 0
+        self._probe_in_flight = False
+        self._recent = deque(maxlen=BREAKER_WINDOW)
+        self._latencies = deque(maxlen=200)
+        # Contatori per /team: aggiornati a ogni chiamata, letti senza ordinare né scorrere finestre
+        self.calls = self.errors = 0
+        self.latency_ewma = None
+        self._outcomes = deque(maxlen=BREAKER_WINDOW)
+        self._outcomes_ok = 0
+    
+    def allow(self):
+        """True se la chiamata può partire"""
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.short_circuited += 1
+            return False
+    
+    def record(self, ok, elapsed):
+        """Esito di una chiamata: errori e lentezza possono aprire il circuito"""
+        slow = elapsed > BREAKER_SLOW_CALL
+        with self._lock:
+            self.calls += 1
+            if ok:
+                self._latencies.append(elapsed)
+                self.latency_ewma = elapsed if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * elapsed
+            else:
+                self.errors += 1
+            if len(self._outcomes) == self._outcomes.maxlen:
+                self._outcomes_ok -= self._outcomes[0]
+            self._outcomes.append(ok)
+            self._outcomes_ok += ok
+            if self.state == "half_open":
+                self._probe_in_flight = False
+                if ok and not slow:
+                    logger.info(f"✅ {self.name}: circuito richiuso")
+                    self.state = "closed"
+                    self.consecutive_failures = 0
+                    self._recent.clear()
+                else:
+                    self._open("prova fallita")
+                return
+            self._recent.append(slow)
+            self.consecutive_failures = 0 if ok else self.consecutive_failures + 1
+            if self.consecutive_failures >= BREAKER_FAILURES:
+                self._open(f"{self.consecutive_failures} errori consecutivi")
+            elif len(self._recent) >= BREAKER_WINDOW and sum(self._recent) / len(self._recent) >= BREAKER_SLOW_RATIO:
+                self._open(f"{sum(self._recent)}/{len(self._recent)} chiamate oltre {BREAKER_SLOW_CALL:.0f}s")
+    
+    def _open(self, reason):
+        logger.warning(f"⚡ {self.name}: circuito aperto ({reason})")
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.opens += 1
+        self._recent.clear()
+    
+    def percentile(self, pct):
+        with self._lock:
+            data = sorted(self._latencies)
+        if not data:
+            return None
+        return data[min(len(data) - 1, int(len(data) * pct / 100))]
+    
+    def availability(self):
+        """Quota di chiamate riuscite nelle ultime BREAKER_WINDOW, None senza chiamate"""
+        return self._outcomes_ok / len(self._outcomes) if self._outcomes else None
+    
+    def hedge_delay(self):
+        """Dopo quanti secondi lanciare la chiamata di riserva (None = niente hedging)"""
+        if not hedging_enabled(self.name) or len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return self.percentile(HEDGE_PERCENTILE)
+    
+    def stats(self):
+        p50, p95 = self.percentile(50), self.percentile(95)
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "opens": self.opens,
+            "short_circuited": self.short_circuited,
+            "retry_in_s": round(max(BREAKER_COOLDOWN - (time.monotonic() - self.opened_at), 0), 1) if self.state == "open" else 0,
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "calls": self.calls,
+            "errors": self.errors,
+            "hedging": hedging_enabled(self.name),
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins
+        }
+
+agent_health = {}
+
+def health_of(name):
+    """Circuit breaker dell'agente, creato al primo uso (anche per agenti registrati dopo l'avvio)"""
+    health = agent_health.get(name)
+    if health is None:
+        health = agent_health.setdefault(name, AgentHealth(name))
+    return health
+
+def reset_agent_health():
+    for health in agent_health.values():
+        health.reset()
+
+os.register_at_fork(after_in_child=reset_agent_health)
+
+# Pool separato per le chiamate hedged: chi attende è già un thread di agent_executor
+hedge_executor = ThreadPoolExecutor(max_workers=AGENT_POOL_SIZE, thread_name_prefix="ayrohub-hedge")
+
+def reset_hedge_executor():
+    global hedge_executor
+    hedge_executor = ThreadPoolExecutor(max_workers=AGENT_POOL_SIZE, thread_name_prefix="ayrohub-hedge")
+
+os.register_at_fork(after_in_child=reset_hedge_executor)
+
+def is_failure(response):
+    return not response or response.startswith("❌")
+
+def circuit_open_response(name, key):
+    """Circuito aperto: ultima risposta in cache (anche scaduta) o errore immediato"""
+    stale = response_cache.get(key, stale=True) if response_cache is not None else None
+    return stale if stale is not None else f"❌ {name} temporaneamente non disponibile"
+
+def hedged_call(agent, message):
+    """Chiamata con eventuale riserva dopo il percentile di latenza; vince la prima risposta valida
+
+    Una chiamata sync già partita non si può interrompere: la riserva ha come
+    timeout il tempo che resta alla prima, così la perdente libera thread e
+    slot del limiter al più tardi quando sarebbe scaduta la chiamata originale.
+    agent.hedges la conta nel costo stimato della richiesta.
+    """
+    health = health_of(agent.name)
+    delay = health.hedge_delay()
+    if delay is None:
+        return agent.run(message)
+    
+    primary = hedge_executor.submit(agent.run, message)
+    done, _ = wait([primary], timeout=delay)
+    if done or delay >= agent.timeout:
+        return primary.result()
+    
+    health.hedges += 1
+    agent.hedges += 1
+    backup = hedge_executor.submit(agent.with_timeout(agent.timeout - delay).run, message)
+    pending = {primary, backup}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            response = future.result()
+            if not is_failure(response) or not pending:
+                if future is backup:
+                    health.hedge_wins += 1
+                return response
+
+async def ahedged_call(agent, message):
+    """Come hedged_call, per gli agenti coroutine (la chiamata perdente viene cancellata)"""
+    health = health_of(agent.name)
+    delay = health.hedge_delay()
+    if delay is None:
+        return await agent.arun(message)
+    
+    primary = asyncio.ensure_future(agent.arun(message))
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or delay >= agent.timeout:
+        return await primary
+    
+    health.hedges += 1
+    agent.hedges += 1
+    backup = asyncio.ensure_future(agent.with_timeout(agent.timeout - delay).arun(message))
+    pending = {primary, backup}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                response = task.result()
+                if not is_failure(response) or not pending:
+                    if task is backup:
+                        health.hedge_wins += 1
+                    return response
+    finally:
+        for task in pending:
+            task.cancel()
+
+def start_agent_call(name, key):
+    """Controlla il circuit breaker; None se la chiamata può partire, altrimenti la risposta di ripiego"""
+    labels = (("agent", name),)
+    if not health_of(name).allow():
+        metrics.inc("ayrohub_agent_calls_total", labels + (("outcome", "circuit_open"),))
+        return circuit_open_response(name, key)
+    metrics.gauge("ayrohub_agent_calls_in_flight", labels, 1)
+    return None
+
+def end_agent_call(name, response, start):
+    """Esito della chiamata: circuit breaker e metriche"""
+    labels = (("agent", name),)
+    elapsed = time.monotonic() - start
+    ok = not is_failure(response)
+    health_of(name).record(ok, elapsed)
+    metrics.gauge("ayrohub_agent_calls_in_flight", labels, -1)
+    metrics.observe("ayrohub_agent_call_duration_seconds", labels, elapsed)
+    metrics.inc("ayrohub_agent_calls_total", labels + (("outcome", "ok" if ok else "error"),))
+
+def guarded_call(agent, message, key):
+    """Chiamata protetta da circuit breaker, con hedging opzionale"""
+    fallback = start_agent_call(agent.name, key)
+    if fallback is not None:
+        return fallback
+    start = time.monotonic()
+    response = None
+    try:
+        response = hedged_call(agent, message)
+        return response
+    finally:
+        end_agent_call(agent.name, response, start)
+
+async def aguarded_call(agent, message, key):
+    """Come guarded_call, per gli agenti coroutine"""
+    fallback = start_agent_call(agent.name, key)
+    if fallback is not None:
+        return fallback
+    start = time.monotonic()
+    response = None
+    try:
+        response = await ahedged_call(agent, message)
+        return response
+    finally:
+        # Anche una chiamata interrotta dalla deadline conta come fallimento
+        end_agent_call(agent.name, response, start)
+
+def cached_call(agent, message, use_cache=True):
+    """Esegue un agente passando da cache e coalescing; use_cache=False forza una risposta nuova"""
+    key = cache_key(agent.name, agent.cache_model, message)
+    if use_cache and response_cache is not None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            metrics.inc("ayrohub_agent_calls_total", (("agent", agent.name), ("outcome", "cached")))
+            return cached
+    
+    def fetch():
+        response = guarded_call(agent, message, key)
+        if response_cache is not None and is_cacheable(response):
+            response_cache.set(key, response)
+        return response
+    
+    if single_flight is None:
+        return fetch()
+    lookup = (lambda: response_cache.get(key)) if use_cache and response_cache is not None else None
+    return single_flight.do(key, fetch, lookup)
+
+async def acached_call(agent, message, use_cache=True):
+    """Come cached_call, per gli agenti coroutine"""
+    key = cache_key(agent.name, agent.cache_model, message)
+    if use_cache and response_cache is not None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            metrics.inc("ayrohub_agent_calls_total", (("agent", agent.name), ("outcome", "cached")))
+            return cached
+    
+    async def fetch():
+        response = await aguarded_call(agent, message, key)
+        if response_cache is not None and is_cacheable(response):
+            response_cache.set(key, response)
+        return response
+    
+    if single_flight is None:
+        return await fetch()
+    return await single_flight.ado(key, fetch)
+
+# ============================================================================
+# SERIALIZZAZIONE RISPOSTE
+# ============================================================================
+
+def build_json_encoder(mode):
+    """Encoder JSON a bytes: orjson se disponibile (o richiesto), altrimenti json della stdlib"""
+    if mode != 'std':
+        try:
+            import orjson
+            return "orjson", orjson.dumps
+        except ImportError:
+            if mode == 'orjson':
+                logger.warning("⚠️ JSON_ENCODER=orjson ma orjson non è installato: uso json")
+    # ensure_ascii (come jsonify): l'encoder C è molto più veloce sul testo non ASCII, gzip recupera i byte
+    return "json", lambda payload: json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+json_encoder_name, dumps_json = build_json_encoder(JSON_ENCODER)
+
+def accepted_encodings(accept_encoding):
+    return {part.split(";")[0].strip() for part in (accept_encoding or "").split(",")
+            if not part.strip().endswith(";q=0")}
+
+def accepted_encoding(accept_encoding, encoded):
+    """Codifica migliore tra quelle disponibili e accettate dal client (br > gzip > identity)"""
+    accepted = accepted_encodings(accept_encoding)
+    for encoding in ("br", "gzip"):
+        if encoding in encoded and encoding in accepted:
+            return encoding
+    return "identity"
+
+def encode_json(payload, accept_encoding):
+    """Corpo JSON pronto per l'invio: (bytes, Content-Encoding o None, comprimibile)
+
+    La compressione costa CPU: solo oltre RESPONSE_COMPRESS_MIN_BYTES, dove
+    le risposte degli agenti si riducono di circa 5 volte già al livello 1.
+    """
+    body = dumps_json(payload)
+    compressible = bool(RESPONSE_COMPRESS_MIN_BYTES) and len(body) >= RESPONSE_COMPRESS_MIN_BYTES
+    if compressible and "gzip" in accepted_encodings(accept_encoding):
+        return gzip.compress(body, RESPONSE_COMPRESS_LEVEL), "gzip", True
+    return body, None, compressible
+
+def json_response(payload, status=200):
+    """Come jsonify, con l'encoder veloce e la compressione delle risposte grandi"""
+    body, encoding, compressible = encode_json(payload, request.headers.get("Accept-Encoding"))
+    response = Response(body, status=status, mimetype="application/json")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if compressible:
+        response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+def response_output(data, query_output=None):
+    """Campi testuali di /test: "full" (responses e formatted), "responses" o "formatted" da solo"""
+    output = data.get("output") or query_output or "full"
+    return output if output in ("full", "responses", "formatted") else "full"
+
+# ============================================================================
+# SISTEMA DI COORDINAMENTO 2.0
+# ============================================================================
+
+# Pool condiviso: gli agenti sono I/O bound, i thread restano in attesa dei provider
+agent_executor = ThreadPoolExecutor(max_workers=AGENT_POOL_SIZE, thread_name_prefix="ayrohub-agent")
+
+def reset_agent_executor():
+    """I thread del pool non sopravvivono al fork: ogni worker ne crea uno nuovo"""
+    global agent_executor
+    agent_executor = ThreadPoolExecutor(max_workers=AGENT_POOL_SIZE, thread_name_prefix="ayrohub-agent")
+
+os.register_at_fork(after_in_child=reset_agent_executor)
+
+def queued_call(queued_at, waits, agent, message, use_cache):
+    """Task del pool agenti: registra l'attesa in coda, poi esegue l'agente"""
+    waited = time.monotonic() - queued_at
+    waits.append(waited)
+    metrics.observe("ayrohub_agent_queue_seconds", (("agent", agent.name),), waited)
+    return cached_call(agent, message, use_cache)
+
+class PipelineRun:
+    """Stato di un'esecuzione del team come DAG di agenti (comune agli engine sync e async)
+
+    Un passo parte appena i suoi input sono pronti, o al più tardi quando gli
+    resta il proprio timeout prima della deadline (almeno metà del tempo
+    della richiesta), con gli input disponibili. Gli input ancora in corso a
+    quel punto, se non sono output richiesti, vengono interrotti.
+    """
+    
+    def __init__(self, message, start, request_deadline, agents=None, pipeline=None, timer=None, conversation=None):
+        self.message = message
+        self.start = start
+        self.request_deadline = request_deadline
+        self.timer = timer
+        self.conversation = conversation
+        agents = select_agents() if agents is None else agents
+        self.outputs = {agent.name: index for index, agent in enumerate(agents)}
+        self.plan = pipeline_plan(agents, TEAM_PIPELINE != 'off' if pipeline is None else pipeline)
+        self.dependents = {name: [other for other, inputs in self.plan.items() if name in inputs] for name in self.plan}
+        self.started = {}
+        self.deadlines = {}
+        self.results = {}
+        self.usage = {}
+        self._knowledge = None
+        self.output_tokens = OUTPUT_TOKENS.get(timer.kind if timer is not None else "briefing", OUTPUT_TOKENS["briefing"])
+    
+    def latest_start(self, name):
+        return max(self.request_deadline - AGENT_REGISTRY[name].timeout,
+                   self.start + (self.request_deadline - self.start) / 2)
+    
+    def ready(self):
+        """Passi da avviare ora: [(nome, agente, briefing del passo)]
+
+        Il briefing passa dal prompt shaping dell'agente, riceve i turni
+        precedenti rilevanti (con una sessione) e i chunk del knowledge base
+        prima di unirsi agli input; l'agente lanciato è limitato al
+        max_tokens del tipo di richiesta e, come timeout della chiamata al
+        provider, al tempo che resta prima della deadline della richiesta.
+        """
+        now = time.monotonic()
+        launch = []
+        for name, inputs in self.plan.items():
+            if name in self.started:
+                continue
+            if all(dep in self.results for dep in inputs) or now >= self.latest_start(name):
+                agent = AGENT_REGISTRY[name].for_step(self.output_tokens, max(self.request_deadline - now, STEP_MIN_TIMEOUT))
+                self.started[name] = now
+                self.deadlines[name] = min(now + agent.timeout, self.request_deadline)
+                available = {dep: self.results[dep] for dep in inputs if dep in self.results}
+                message, usage = agent.shape(self.message)
+                if self.conversation is not None:
+                    message, usage["context_turns"] = self.conversation.with_context(agent, message)
+                if agent.knowledge and self.knowledge():
+                    message, usage["knowledge_chunks"] = knowledge_context(agent, self.knowledge(), message)
+                step_message = agent.pipeline_message(message, available)
+                usage["input_tokens"] = agent.count_tokens((agent.system or "") + agent.render(step_message))
+                self.usage[name] = (agent, usage)
+                launch.append((name, agent, step_message))
+        return launch
+    
+    def knowledge(self):
+        """Chunk del knowledge base rilevanti per il briefing, cercati una volta per richiesta"""
+        if self._knowledge is None:
+            self._knowledge = []
+            if KB_CONTEXT_TOKENS > 0:
+                try:
+                    if not knowledge_base.empty():
+                        self._knowledge = knowledge_base.search(self.message)
+                except Exception as e:
+                    logger.error(f"❌ Ricerca knowledge base: {e}")
+        return self._knowledge
+    
+    def unused(self, name):
+        """Passo in corso il cui risultato non serve più: non è un output e chi lo aspettava è già partito"""
+        return (name not in self.outputs and name not in self.results
+                and all(dep in self.started for dep in self.dependents[name]))
+    
+    def next_event(self):
+        """Prossimo istante da controllare: deadline di un passo o avvio forzato di uno in attesa"""
+        times = [self.deadlines[name] for name in self.started if name not in self.results]
+        times += [self.latest_start(name) for name in self.plan if name not in self.started]
+        return min(times, default=self.request_deadline)
+    
+    def finish(self, name, response, status=None):
+        """Registra l'esito; ritorna (indice, nome, risposta) se il passo è un output richiesto"""
+        self.results[name] = response
+        if self.timer is not None:
+            status = status or ("error" if is_failure(response) else "ok")
+            self.timer.step(name, self.started[name], time.monotonic(), self.plan[name], status)
+            self.record_usage(name, response)
+        if name in self.outputs:
+            return self.outputs[name], name, response
+        return None
+    
+    def record_usage(self, name, response):
+        """Token di input/output e costo stimato (zero per demo ed errori, che non consumano token)
+
+        Con l'hedging anche la chiamata perdente arriva al provider: il costo
+        conta ogni chiamata partita come una uguale a quella che ha risposto.
+        """
+        agent, usage = self.usage[name]
+        billed = agent.active() and not is_failure(response) and response != agent.demo
+        output_tokens = agent.count_tokens(response) if billed and not agent.price_per_call else 0
+        calls = 1 + agent.hedges
+        self.timer.usage[name] = dict(
+            usage,
+            max_tokens=agent.max_tokens,
+            output_tokens=output_tokens,
+            hedged_calls=agent.hedges,
+            estimated_cost_usd=round(agent.estimate_cost(usage["input_tokens"], output_tokens) * calls, 6) if billed else 0.0)
+    
+    def cut_off(self, name, abandoned=False):
+        logger.info(f"✂️ {name} interrotto: il risultato non serve più")
+        self.finish(name, f"❌ {name} interrotto", "abandoned" if abandoned else "cut_off")
+    
+    def timed_out(self, name, abandoned=False):
+        logger.warning(f"⏱️ {name} oltre la deadline ({time.monotonic() - self.start:.1f}s)")
+        metrics.inc("ayrohub_agent_timeouts_total", (("agent", name),))
+        return self.finish(name, f"❌ {name} timeout", "abandoned" if abandoned else "timeout")
+
+def abandon(future, name):
+    """Prova a cancellare il passo di un pool di thread; True se era già in esecuzione
+
+    Una chiamata già partita non si interrompe: il thread resta occupato
+    finché il provider risponde o scade il timeout del passo, ed è contato
+    in ayrohub_agent_calls_abandoned fino ad allora.
+    """
+    if future.cancel():
+        return False
+    labels = (("agent", name),)
+    metrics.gauge("ayrohub_agent_calls_abandoned", labels, 1)
+    future.add_done_callback(lambda _: metrics.gauge("ayrohub_agent_calls_abandoned", labels, -1))
+    return True
+
+def iter_agents_parallel(message, deadline=None, use_cache=True, timer=None, agents=None, pipeline=None,
+                         conversation=None):
+    """Esegue gli agenti come DAG e produce (indice, nome, risposta) man mano che gli output finiscono
+
+    `agents` sono gli output richiesti (default: tutto il registry), l'indice
+    è la posizione nella selezione. Con la pipeline (TEAM_PIPELINE, default off)
+    gli agenti con input (LANA) partono sugli output degli altri, vedi
+    PipelineRun; senza, tutti partono subito sul briefing. Ogni passo ha il
+    proprio timeout, passato anche alla chiamata al provider, e l'intera
+    richiesta non supera `deadline` (default REQUEST_DEADLINE); un passo in
+    ritardo produce il messaggio di errore e, se già in esecuzione, resta
+    "abandoned" (vedi abandon).
+    Con use_cache=False la cache risposte viene ignorata in lettura. Con un
+    RequestTimer registra le fasi queue e provider e i tempi dei passi. Con
+    una Conversation i prompt includono i turni precedenti della sessione e
+    a fine esecuzione il turno viene salvato (fuori dal percorso della richiesta).
+    """
+    start = time.monotonic()
+    run = PipelineRun(message, start, start + (REQUEST_DEADLINE if deadline is None else deadline),
+                      agents, pipeline, timer, conversation)
+    waits = []
+    running = {}
+    
+    try:
+        while True:
+            for name, agent, step_message in run.ready():
+                running[agent_executor.submit(queued_call, time.monotonic(), waits, agent, step_message, use_cache)] = name
+            for future, name in list(running.items()):
+                if run.unused(name):
+                    del running[future]
+                    run.cut_off(name, abandon(future, name))
+            if not running:
+                break
+            
+            done, _ = wait(running, timeout=max(run.next_event() - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    output = run.finish(name, future.result())
+                except Exception as e:
+                    logger.error(f"Error calling {name}: {e}")
+                    output = run.finish(name, f"❌ {name} temporaneamente non disponibile")
+                if output:
+                    yield output
+            now = time.monotonic()
+            for future, name in list(running.items()):
+                if run.deadlines[name] <= now and not future.done():
+                    del running[future]
+                    output = run.timed_out(name, abandon(future, name))
+                    if output:
+                        yield output
+    finally:
+        # Generatore chiuso prima della fine (client disconnesso): i passi in coda non partono,
+        # quelli in esecuzione restano contati come abbandonati
+        for future, name in running.items():
+            abandon(future, name)
+        running.clear()
+    
+    if conversation is not None:
+        conversation.record(run.results)
+    if timer is not None:
+        # Gli agenti girano in parallelo: conta l'attesa in coda più lunga
+        queued = max(waits, default=0)
+        timer.add("queue", queued)
+        timer.add("provider", time.monotonic() - start - queued)
+
+def process_agents_parallel(message, deadline=None, use_cache=True, timer=None, agents=None, pipeline=None,
+                            conversation=None):
+    """Processa gli agenti AYROHUB AI 2.0 in parallelo
+
+    Ritorna {nome agente: risposta} nell'ordine del registry (vedi
+    iter_agents_parallel per selezione, deadline e cache).
+    """
+    logger.info(f"🎯 AYROHUB 2.0 processing: {message[:50]}...")
+    
+    start = time.monotonic()
+    agents = select_agents() if agents is None else agents
+    results = OrderedDict((agent.name, None) for agent in agents)
+    for _, name, response in iter_agents_parallel(message, deadline, use_cache, timer, agents, pipeline, conversation):
+        results[name] = response
+    
+    logger.info(f"✅ Team completato in {time.monotonic() - start:.2f}s")
+    return results
+
+async def iter_agents_async(message, deadline=None, use_cache=True, timer=None, agents=None, pipeline=None,
+                            conversation=None):
+    """Come iter_agents_parallel, con gli agenti come coroutine sullo stesso event loop (niente coda)"""
+    start = time.monotonic()
+    run = PipelineRun(message, start, start + (REQUEST_DEADLINE if deadline is None else deadline),
+                      agents, pipeline, timer, conversation)
+    running = {}
+    
+    try:
+        while True:
+            for name, agent, step_message in run.ready():
+                running[asyncio.ensure_future(acached_call(agent, step_message, use_cache))] = name
+            for task, name in list(running.items()):
+                if run.unused(name):
+                    task.cancel()
+                    del running[task]
+                    run.cut_off(name)
+            if not running:
+                break
+            
+            done, _ = await asyncio.wait(running, timeout=max(run.next_event() - time.monotonic(), 0),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = running.pop(task)
+                try:
+                    output = run.finish(name, task.result())
+                except Exception as e:
+                    logger.error(f"Error calling {name}: {e}")
+                    output = run.finish(name, f"❌ {name} temporaneamente non disponibile")
+                if output:
+                    yield output
+            now = time.monotonic()
+            for task, name in list(running.items()):
+                if run.deadlines[name] <= now:
+                    task.cancel()
+                    del running[task]
+                    output = run.timed_out(name)
+                    if output:
+                        yield output
+    finally:
+        for task in running:
+            task.cancel()
+    
+    if conversation is not None:
+        conversation.record(run.results)
+    if timer is not None:
+        timer.add("provider", time.monotonic() - start)
+
+async def process_agents_async(message, deadline=None, use_cache=True, timer=None, agents=None, pipeline=None,
+                               conversation=None):
+    """Come process_agents_parallel, ma con gli agenti come coroutine sullo stesso event loop"""
+    logger.info(f"🎯 AYROHUB 2.0 processing (async): {message[:50]}...")
+    
+    start = time.monotonic()
+    agents = select_agents() if agents is None else agents
+    results = OrderedDict((agent.name, None) for agent in agents)
+    async for _, name, response in iter_agents_async(message, deadline, use_cache, timer, agents, pipeline,
+                                                     conversation):
+        results[name] = response
+    
+    logger.info(f"✅ Team completato in {time.monotonic() - start:.2f}s")
+    return results
+
+def format_response(message, responses):
+    """Formatta la risposta finale AYROHUB AI 2.0 ({nome agente: risposta})"""
+    timestamp = datetime.now().strftime("%d/%m/%Y %H:%M")
+    
+    sections = "\n\n---\n\n".join(
+        f"{agent.emoji} **{agent.name} ({agent.role}):**\n{response or '❌ Non disponibile'}"
+        for agent, response in ((AGENT_REGISTRY[name], response) for name, response in responses.items())
+    )
+    
+    formatted = f"""🤖 **AYROHUB AI 2.0 - Risposte del Team Completo**
+
+📝 **Briefing**: {message}
+⏰ **Timestamp**: {timestamp}
+🚀 **Version**: AYROHUB AI 2.0 + PICASSO
+
+---
+
+{sections}
+
+---
+✅ **Processo AYROHUB AI 2.0 completato**
+🎯 **Team**: {len(responses)} agenti operativi coordinati"""
+    
+    return formatted
+
+def use_response_cache(data, headers):
+    """Bypass cache per richiesta: {"cache": false} nel payload o header Cache-Control: no-cache"""
+    return data.get("cache", True) is not False and "no-cache" not in headers.get("Cache-Control", "")
+
+def requested_agents(data):
+    """Agenti scelti dalla richiesta ({"agents": [...]}), altrimenti tutto il team"""
+    return select_agents(data.get("agents"))
+
+def use_pipeline(data):
+    """Pipeline per richiesta: {"pipeline": false} fa partire tutti gli agenti subito, in modo indipendente"""
+    return data.get("pipeline", TEAM_PIPELINE != 'off') is not False
+
+def team_responses(responses):
+    """Risposte del team indicizzate per agente"""
+    return {name.lower(): response for name, response in responses.items()}
+
+def with_team_details(payload, responses, timer):
+    """Aggiunge al payload le immagini ancora in generazione, i tempi della pipeline e token/costi"""
+    images = pending_images(responses)
+    if images:
+        payload["images"] = {
+            name.lower(): {"status": "pending", "status_url": image_status_url(key), "image_url": image_url(key)}
+            for name, key in images.items()
+        }
+    if timer is not None and timer.steps:
+        payload["pipeline"] = timer.pipeline_report()
+    if timer is not None and timer.usage:
+        payload["usage"] = timer.usage_report()
+    return payload
+
+def build_test_payload(message, responses, timer=None, output="full"):
+    """Payload JSON di /test; `output` evita di ripetere i testi in responses e formatted"""
+    payload = {"status": "success", "version": "2.0.0", "message": message}
+    if output != "formatted":
+        payload["responses"] = team_responses(responses)
+    if output != "responses":
+        payload["formatted"] = format_response(message, responses)
+    payload["timestamp"] = datetime.now().isoformat()
+    return with_team_details(payload, responses, timer)
+
+def build_team_payload(responses, timer=None):
+    """Payload JSON di /n8n-webhook per sorgenti generiche"""
+    return with_team_details({
+        "status": "success",
+        "action": "team_processed",
+        "responses": team_responses(responses),
+        "timestamp": datetime.now().isoformat()
+    }, responses, timer)
+
+def wants_sse(accept, query_format):
+    """Server-Sent Events se richiesti (Accept o ?format=sse), altrimenti NDJSON"""
+    return query_format == "sse" or "text/event-stream" in (accept or "")
+
+def stream_event(event, payload, sse=False):
+    """Serializza un evento dello stream: una riga NDJSON o un messaggio SSE"""
+    data = dumps_json(dict(event=event, **payload)).decode("utf-8")
+    if sse:
+        return f"event: {event}\ndata: {data}\n\n"
+    return data + "\n"
+
+def stream_start_event(message, agents, sse):
+    return stream_event("start", {
+        "version": "2.0.0",
+        "message": message,
+        "agents": [agent.key for agent in agents]
+    }, sse)
+
+def stream_agent_event(index, name, response, start, sse):
+    return stream_event("agent", {
+        "index": index,
+        "agent": name.lower(),
+        "response": response,
+        "elapsed_ms": round((time.monotonic() - start) * 1000, 1)
+    }, sse)
+
+def stream_image_event(name, key, state, start, sse):
+    status = state["status"] if state else "unknown"
+    return stream_event("image", {
+        "agent": name.lower(),
+        "status": status,
+        "image_url": image_url(key) if status == "ready" else None,
+        "status_url": image_status_url(key),
+        "elapsed_ms": round((time.monotonic() - start) * 1000, 1)
+    }, sse)
+
+def resolve_image(agent, message, state, use_cache=True):
+    """Risposta definitiva di un agente immagine dopo l'attesa: scheda pronta o errore
+
+    Passa da cached_call come le altre chiamate agli agenti (circuit breaker,
+    cache, metriche): la scheda pronta finisce in cache al posto del segnaposto.
+    """
+    if state and state["status"] == "ready":
+        # Stesso shaping della pipeline: stesso concept, quindi stessa chiave nello store
+        return cached_call(agent, agent.shape(message)[0], use_cache)
+    return f"❌ {agent.display_name} immagine non disponibile"
+
+async def aresolve_image(agent, message, state, use_cache=True):
+    """Come resolve_image, per gli agenti coroutine"""
+    if state and state["status"] == "ready":
+        return await acached_call(agent, agent.shape(message)[0], use_cache)
+    return f"❌ {agent.display_name} immagine non disponibile"
+
+def stream_done_event(message, responses, start, sse, timer=None, output="full"):
+    payload = {"status": "success"}
+    if output != "responses":
+        # Le risposte sono già arrivate negli eventi agent: "responses" evita di rimandarle
+        payload["formatted"] = format_response(message, responses)
+    payload["elapsed_ms"] = round((time.monotonic() - start) * 1000, 1)
+    payload["timestamp"] = datetime.now().isoformat()
+    return stream_event("done", with_team_details(payload, responses, timer), sse)
+
+def stream_test_events(message, use_cache=True, sse=False, agents=None, pipeline=None, output="full",
+                       conversation=None):
+    """Eventi di /test/stream: start, un evento per agente appena pronto, done"""
+    start = time.monotonic()
+    timer = RequestTimer("/test/stream")
+    agents = select_agents() if agents is None else agents
+    yield stream_start_event(message, agents, sse)
+    responses = OrderedDict((agent.name, None) for agent in agents)
+    for index, name, response in iter_agents_parallel(message, use_cache=use_cache, timer=timer, agents=agents,
+                                                         pipeline=pipeline, conversation=conversation):
+        responses[name] = response
+        yield stream_agent_event(index, name, response, start, sse)
+    # Il testo è già arrivato: lo stream resta aperto per le immagini in generazione
+    for name, key in pending_images(responses).items():
+        state = image_pool.wait(key, AGENT_REGISTRY[name].timeout)
+        responses[name] = resolve_image(AGENT_REGISTRY[name], message, state, use_cache)
+        yield stream_image_event(name, key, state, start, sse)
+    with timer.phase("formatting"):
+        done = stream_done_event(message, responses, start, sse, timer, output)
+    timer.finish()
+    yield done
+
+async def astream_test_events(message, use_cache=True, sse=False, agents=None, pipeline=None, output="full",
+                              conversation=None):
+    """Come stream_test_events, con gli agenti sull'event loop (modalità ASGI)"""
+    start = time.monotonic()
+    timer = RequestTimer("/test/stream")
+    agents = select_agents() if agents is None else agents
+    yield stream_start_event(message, agents, sse)
+    responses = OrderedDict((agent.name, None) for agent in agents)
+    async for index, name, response in iter_agents_async(message, use_cache=use_cache, timer=timer, agents=agents,
+                                                            pipeline=pipeline, conversation=conversation):
+        responses[name] = response
+        yield stream_agent_event(index, name, response, start, sse)
+    for name, key in pending_images(responses).items():
+        state = await asyncio.to_thread(image_pool.wait, key, AGENT_REGISTRY[name].timeout)
+        responses[name] = await aresolve_image(AGENT_REGISTRY[name], message, state, use_cache)
+        yield stream_image_event(name, key, state, start, sse)
+    with timer.phase("formatting"):
+        done = stream_done_event(message, responses, start, sse, timer, output)
+    timer.finish()
+    yield done
+
+STREAM_HEADERS = {
+    "Cache-Control": "no-cache",
+    # Niente buffering nei reverse proxy (nginx), altrimenti lo stream arriva tutto alla fine
+    "X-Accel-Buffering": "no"
+}
+
+# ============================================================================
+# CODA JOB ASINCRONI (n8n)
+# ============================================================================
+
+class JobError(ValueError):
+    """Job non accettabile (callback_url non valido o non ammesso)"""
+
+def check_callback_url(url):
+    """callback_url http(s), verso un host di JOB_CALLBACK_HOSTS se l'allowlist è impostata"""
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise JobError("callback_url deve essere un URL http(s)")
+    if JOB_CALLBACK_HOSTS and parsed.hostname.lower() not in JOB_CALLBACK_HOSTS:
+        raise JobError(f"callback_url: host {parsed.hostname} non ammesso")
+    return url
+
+class JobQueue:
+    """Coda durevole su SQLite con pool di worker limitato e consegna via callback
+
+    I job sopravvivono al riavvio del processo e sono condivisi dai worker
+    gunicorn dello stesso host: ogni thread prende un job con un claim
+    atomico. Il risultato resta consultabile su /jobs/<id> per `retention`
+    secondi e, se il payload indica un callback_url, viene inviato con retry
+    e backoff esponenziale. Job in coda e in esecuzione sono contatori
+    aggiornati nelle stesse transazioni (profondità e stats senza scansioni).
+    """
+    
+    PRUNE_INTERVAL = 60
+    
+    def __init__(self, path, workers, max_depth, handler, retention):
+        self.path = path
+        self.workers = workers
+        self.max_depth = max_depth
+        self.handler = handler
+        self.retention = retention
+        self.processed = self.failed = self.rejected = self.pruned = 0
+        self.callbacks_delivered = self.callbacks_failed = 0
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._pruned_at = 0.0
+    
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                callback_url TEXT,
+                callback_status TEXT,
+                callback_attempts INTEGER NOT NULL DEFAULT 0,
+                callback_next_at REAL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_callback ON jobs (callback_status, callback_next_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at) WHERE finished_at IS NOT NULL")
+            ensure_counters(db, ["SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status"])
+            self._local.db = db
+        return db
+    
+    def depth(self, db=None):
+        """Job in attesa o in esecuzione"""
+        return sum(read_counters(db or self._db(), ["queued", "running"]).values())
+    
+    def enqueue(self, payload, callback_url=None):
+        """Accoda un job; None se la coda è piena (backpressure)
+
+        Controllo della profondità e insert nella stessa transazione: worker
+        concorrenti non superano max_depth.
+        """
+        if callback_url is not None:
+            check_callback_url(callback_url)
+        self.start()
+        job_id = uuid.uuid4().hex
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if self.depth(db) >= self.max_depth:
+                db.execute("ROLLBACK")
+                self.rejected += 1
+                return None
+            db.execute(
+                "INSERT INTO jobs (id, status, payload, callback_url, callback_status, created_at) VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, json.dumps(payload), callback_url, "pending" if callback_url else None, time.time()))
+            bump_counters(db, {"queued": 1})
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        self._wakeup.set()
+        return job_id
+    
+    def get(self, job_id):
+        """Stato del job in formato API, None se sconosciuto"""
+        row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        iso = lambda ts: datetime.fromtimestamp(ts).isoformat() if ts else None
+        job = {
+            "job_id": row["id"],
+            "status": row["status"],
+            "created_at": iso(row["created_at"]),
+            "started_at": iso(row["started_at"]),
+            "finished_at": iso(row["finished_at"])
+        }
+        if row["result"]:
+            job["result"] = json.loads(row["result"])
+        if row["error"]:
+            job["error"] = row["error"]
+        if row["callback_url"]:
+            job["callback"] = {
+                "url": row["callback_url"],
+                "status": row["callback_status"],
+                "attempts": row["callback_attempts"]
+            }
+        return job
+    
+    def start(self):
+        """Rimette in coda i job rimasti "running" e avvia i worker (all'import e nei worker gunicorn dopo il fork)"""
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            self._requeue_stale()
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f"ayrohub-job-{i}", daemon=True).start()
+            self._started = True
+    
+    def _requeue_stale(self):
+        # Job rimasti "running" dopo un crash: tornano in coda oltre la deadline della richiesta
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            requeued = db.execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running' AND started_at < ?",
+                                  (time.time() - REQUEST_DEADLINE * 2,)).rowcount
+            bump_counters(db, {"running": -requeued, "queued": requeued})
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+    
+    def _claim(self, sql, params=(), counters=None):
+        """Claim atomico di una riga; `counters` si applicano solo se la riga è stata presa"""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute(sql, params).fetchall()
+            if rows and counters:
+                bump_counters(db, counters)
+            db.execute("COMMIT")
+            return rows[0] if rows else None
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    
+    def _work(self):
+        while True:
+            try:
+                now = time.time()
+                self._prune(now)
+                delivery = self._claim(
+                    """UPDATE jobs SET callback_status = 'sending' WHERE id = (
+                        SELECT id FROM jobs WHERE callback_status = 'pending' AND status IN ('done', 'failed')
+                        AND COALESCE(callback_next_at, 0) <= ? ORDER BY callback_next_at LIMIT 1)
+                    RETURNING *""", (now,))
+                if delivery is not None:
+                    self._deliver(delivery)
+                    continue
+                job = self._claim(
+                    """UPDATE jobs SET status = 'running', started_at = ? WHERE id = (
+                        SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1)
+                    RETURNING *""", (now,), {"queued": -1, "running": 1})
+                if job is not None:
+                    self._run(job)
+                    continue
+            except Exception as e:
+                logger.error(f"❌ Job worker: {e}")
+            # Niente da fare: attende un nuovo job (o i job accodati da altri worker)
+            self._wakeup.wait(1.0)
+            self._wakeup.clear()
+    
+    def _prune(self, now):
+        """Elimina i job conclusi da oltre `retention` secondi (al massimo ogni PRUNE_INTERVAL)"""
+        if now - self._pruned_at < self.PRUNE_INTERVAL:
+            return
+        self._pruned_at = now
+        deleted = self._db().execute(
+            """DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?
+               AND status IN ('done', 'failed') AND COALESCE(callback_status, '') NOT IN ('pending', 'sending')""",
+            (now - self.retention,)).rowcount
+        self.pruned += deleted
+    
+    def _run(self, job):
+        try:
+            result, status, error = self.handler(json.loads(job["payload"])), "done", None
+            self.processed += 1
+        except Exception as e:
+            logger.error(f"❌ Job {job['id']}: {e}")
+            result, status, error = None, "failed", str(e)
+            self.failed += 1
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Il claim è ancora nostro se il job è "running" con il nostro started_at; rimesso in coda da
+            # _requeue_stale ("queued") lo chiudiamo noi; ripreso da un altro worker il risultato è suo
+            previous = db.execute("SELECT status, started_at FROM jobs WHERE id = ?", (job["id"],)).fetchone()
+            owned = previous is not None and (previous[0] == "queued"
+                                              or (previous[0] == "running" and previous[1] == job["started_at"]))
+            if owned:
+                db.execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                           (status, json.dumps(result) if result is not None else None, error, time.time(), job["id"]))
+                bump_counters(db, {previous[0]: -1})
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if not owned:
+            logger.warning(f"⚠️ Job {job['id']} ripreso da un altro worker: risultato scartato")
+        elif job["callback_url"]:
+            self._wakeup.set()
+    
+    def _deliver(self, job):
+        import requests
+        attempts = job["callback_attempts"] + 1
+        body = self.get(job["id"])
+        try:
+            response = requests.post(job["callback_url"], json=body, timeout=JOB_CALLBACK_TIMEOUT)
+            response.raise_for_status()
+            status, next_at = "delivered", None
+            self.callbacks_delivered += 1
+        except Exception as e:
+            if attempts >= JOB_CALLBACK_RETRIES:
+                logger.error(f"❌ Callback job {job['id']} fallito dopo {attempts} tentativi: {e}")
+                status, next_at = "failed", None
+                self.callbacks_failed += 1
+            else:
+                status, next_at = "pending", time.time() + JOB_CALLBACK_BACKOFF ** attempts
+        self._db().execute("UPDATE jobs SET callback_status = ?, callback_attempts = ?, callback_next_at = ? WHERE id = ?",
+                           (status, attempts, next_at, job["id"]))
+    
+    def reset(self):
+        """Dopo il fork: connessioni e thread del padre non sono utilizzabili"""
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._pruned_at = 0.0
+    
+    def restart(self):
+        """Dopo il fork: i worker ripartono subito, anche senza nuove richieste (job rimasti dopo un redeploy)"""
+        self.reset()
+        try:
+            self.start()
+        except Exception as e:
+            logger.error(f"❌ Avvio job worker: {e}")
+    
+    def stats(self):
+        counts = read_counters(self._db(), ["queued", "running"])
+        return {
+            "queue_depth": counts.get("queued", 0) + counts.get("running", 0),
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "max_depth": self.max_depth,
+            "workers": self.workers if self._started else 0,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "pruned": self.pruned,
+            "retention_s": self.retention,
+            "callbacks_delivered": self.callbacks_delivered,
+            "callbacks_failed": self.callbacks_failed
+        }
+
+def run_team_job(data):
+    """Job n8n generico: il team completo sul contenuto"""
+    timer = RequestTimer("job", kind="webhook")
+    content = data.get('content', '')
+    responses = process_agents_parallel(content, use_cache=data.get("cache", True) is not False,
+                                        timer=timer, agents=requested_agents(data), pipeline=use_pipeline(data),
+                                        conversation=start_conversation(data, {}, content))
+    with timer.phase("formatting"):
+        payload = build_team_payload(responses, timer)
+    timer.finish()
+    return payload
+
+def wants_async_job(data, headers):
+    """Modalità job: {"async": true}, un callback_url o header Prefer: respond-async"""
+    return bool(data.get("async") or data.get("callback_url")) or "respond-async" in headers.get("Prefer", "")
+
+job_queue = JobQueue(JOB_QUEUE_PATH, JOB_WORKERS, JOB_QUEUE_MAX, run_team_job, JOB_RETENTION)
+# Come i probe: i worker partono all'import e ripartono in ogni processo creato da fork
+job_queue.restart()
+os.register_at_fork(after_in_child=job_queue.restart)
+
+# ============================================================================
+# COMANDI TELEGRAM AYROCTOPUS
+# ============================================================================
+
+TELEGRAM_TASK_LINES = 5
+
+def team_status():
+    """Disponibilità e latenza per agente: provider, circuit breaker e contatori di questo worker"""
+    team = OrderedDict()
+    for agent in select_agents():
+        health = health_of(agent.name)
+        if not agent.active():
+            availability = "demo"
+        elif health.state == "open":
+            availability = "circuit_open"
+        elif health.state == "half_open":
+            availability = "recovering"
+        else:
+            availability = "available"
+        success = health.availability()
+        team[agent.name] = {
+            "availability": availability,
+            "latency_ms": round(health.latency_ewma * 1000) if health.latency_ewma is not None else None,
+            "success_rate": round(success, 3) if success is not None else None,
+            "calls": health.calls,
+            "errors": health.errors
+        }
+    return team
+
+AVAILABILITY_LABELS = {
+    "available": "🟢 disponibile",
+    "recovering": "🟡 in ripresa",
+    "circuit_open": "🔴 non disponibile",
+    "demo": "🔧 demo"
+}
+
+def telegram_status():
+    """/status: email, file e task dai contatori degli store, agenti dai contatori in memoria"""
+    tasks, kb, team = task_store.counters(), knowledge_base.counters(), team_status()
+    available = sum(state["availability"] in ("available", "recovering") for state in team.values())
+    system = "✅ Operativo" if available == len(team) else "⚠️ Degradato" if available else "🔧 Demo"
+    calls = sum(state["calls"] for state in team.values())
+    errors = sum(state["errors"] for state in team.values())
+    return f"🤖 AYROCTOPUS Status Report\n\n" \
+           f"📊 Sistema: {system}\n" \
+           f"📧 Email processate oggi: {tasks['emails_today']} ({tasks['emails']} in tutto)\n" \
+           f"📄 File nella KB: {kb['documents']} ({kb['chunks']} chunk, {kb['documents_today']} oggi)\n" \
+           f"🎯 Task attivi: {tasks['open_tasks']}\n" \
+           f"⚡ Team AYROHUB: {available}/{len(team)} agenti attivi\n" \
+           f"🔄 Chiamate agenti: {calls} ({errors} errori)\n\n" \
+           f"💡 /tasks per i prossimi task, /team per il dettaglio agenti"
 
-if ANTHROPIC_API_KEY:
-    try:
-        import anthropic
-        client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-        test = client.messages.create(
-            model="claude-3-haiku-20240307",
-            max_tokens=3,
-            messages=[{"role": "user", "content": "hi"}]
-        )
-        claude_active = True
-        logger.info("✅ CLAUDE (Anthropic) attivo")
-    except Exception as e:
-        logger.error(f"❌ CLAUDE: {e}")
+def telegram_tasks(assignee=None):
+    """/tasks [nome]: task aperti con la scadenza più vicina, poi i più recenti senza scadenza"""
+    listed, _ = task_store.tasks(assignee=assignee, order="due", limit=TELEGRAM_TASK_LINES)
+    if len(listed) < TELEGRAM_TASK_LINES:
+        recent, _ = task_store.tasks(assignee=assignee, limit=TELEGRAM_TASK_LINES)
+        listed += [task for task in recent if task["due"] is None][:TELEGRAM_TASK_LINES - len(listed)]
+    heading = f"🎯 Task attivi di {assignee}" if assignee else f"🎯 Task attivi: {task_store.counters()['open_tasks']}"
+    if not listed:
+        return f"{heading}\n\n✅ Nessun task aperto"
+    lines = [f"{index}. {task['title']}"
+             + (f" — ⏰ {task['due']}" if task["due"] else "")
+             + (f" — 🤖 {task['assignee']}" if task["assignee"] and not assignee else "")
+             + (" — 🔥" if task["priority"] == "high" else "")
+             for index, task in enumerate(listed, 1)]
+    return heading + "\n\n" + "\n".join(lines)
 
-if GOOGLE_API_KEY:
-    try:
-        import google.generativeai as genai
-        genai.configure(api_key=GOOGLE_API_KEY)
-        gemini_active = True
-        logger.info("✅ GEMINI (Google) attivo")
-    except Exception as e:
-        logger.error(f"❌ GEMINI: {e}")
+def telegram_team():
+    """/team: stato live di ogni agente"""
+    lines = []
+    for name, state in team_status().items():
+        agent = AGENT_REGISTRY[name]
+        details = [AVAILABILITY_LABELS[state["availability"]]]
+        if state["latency_ms"] is not None:
+            latency = state["latency_ms"]
+            details.append(f"{latency} ms medi" if latency < 1000 else f"{latency / 1000:.1f}s medi")
+        if state["success_rate"] is not None:
+            details.append(f"{state['success_rate']:.0%} ok")
+        details.append(f"{state['calls']} chiamate")
+        lines.append(f"{agent.heading}: " + " — ".join(details))
+    return "⚡ Team AYROHUB AI 2.0\n\n" + "\n".join(lines)
 
-logger.info(f"🎯 AYROHUB AI 2.0 Status: LANA={lana_active}, CLAUDE={claude_active}, GEMINI={gemini_active}, PICASSO={picasso_active}")
+def telegram_command(command):
+    """Risposta a un comando Telegram; /status, /tasks e /team leggono solo contatori e indici"""
+    name, _, argument = (command or "/status").strip().partition(" ")
+    name = name.split("@", 1)[0].lower()
+    if name == '/status':
+        return telegram_status()
+    if name == '/tasks':
+        return telegram_tasks(argument.strip().lstrip("@") or None)
+    if name == '/team':
+        return telegram_team()
+    if name == '/help':
+        return f"🤖 AYROCTOPUS Comandi Disponibili\n\n" \
+               f"/status - Stato sistema\n" \
+               f"/tasks [nome] - Lista task attivi\n" \
+               f"/team - Status team AYROHUB\n" \
+               f"/demo - Avvia demo completa\n\n" \
+               f"💡 Controllo completo da Telegram"
+    return f"🤖 Comando '{command}' processato\n\n" \
+           f"✅ Azione eseguita automaticamente\n" \
+           f"📊 Risultato registrato nel sistema\n" \
+           f"🔄 Feedback inviato al team"
 
 # ============================================================================
-# AGENTI AI 2.0
+# BATCH N8N
 # ============================================================================
 
-def call_lana(message):
-    """LANA - Coordinatrice AI strategica"""
-    if not lana_active:
-        return "💡 LANA (Demo): Ciao Christian! Sono LANA, coordinatrice AI strategica di AYROHUB 2.0. Al momento funziono in modalità demo ma sono pronta per coordinarti le strategie AYROMEX! — LANA 🧠"
-    
-    try:
-        import openai
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Sei LANA, coordinatrice AI del sistema AYROHUB 2.0. Ricevi briefing da Christian De Palma (CEO AYROMEX) e coordini le risposte strategiche del team multi-agente. Ora lavori con CLAUDE (execution), GEMINI (creatività) e PICASSO (visual content). Analizza il briefing, fornisci coordinamento e sintesi operative. Mantieni sempre un tono professionale ma diretto. Firma sempre: — LANA 🧠"
-                },
-                {
-                    "role": "user", 
-                    "content": message
-                }
-            ],
-            max_tokens=1000
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        logger.error(f"Error calling LANA: {e}")
-        return f"❌ LANA temporaneamente non disponibile"
+# Pool condiviso dai batch: ogni thread segue un elemento (il team gira su agent_executor)
+batch_executor = ThreadPoolExecutor(max_workers=AGENT_POOL_SIZE, thread_name_prefix="ayrohub-batch")
 
-def call_claude(message):
-    """CLAUDE - Motore di esecuzione tecnica"""
-    if not claude_active:
-        return "💡 CLAUDE (Demo): Ciao Christian! Sono Claude, motore di esecuzione tecnica per AYROHUB 2.0. Al momento funziono in modalità demo ma sono pronto per implementare le tue soluzioni tecniche! — Claude ⚡🛠️"
-    
-    try:
-        import anthropic
-        client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-        response = client.messages.create(
-            model="claude-3-haiku-20240307",
-            max_tokens=1000,
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"Sei Claude, motore di esecuzione per AYROHUB 2.0 e sistemi tecnici AYROMEX. Ricevi briefing da Christian De Palma e implementi soluzioni tecniche concrete. Lavori in team con LANA (strategia), GEMINI (creatività) e PICASSO (visual). Focus su automazione, architetture AI e execution rapida. Firma sempre: — Claude ⚡🛠️\n\nBriefing: {message}"
-                }
-            ]
-        )
-        return response.content[0].text
-    except Exception as e:
-        logger.error(f"Error calling Claude: {e}")
-        return f"❌ Claude temporaneamente non disponibile"
+def reset_batch_executor():
+    global batch_executor
+    batch_executor = ThreadPoolExecutor(max_workers=AGENT_POOL_SIZE, thread_name_prefix="ayrohub-batch")
 
-def call_gemini(message):
-    """GEMINI - Creatore contenuti strategici"""
-    if not gemini_active:
-        return "💡 GEMINI (Demo): Ciao Christian! Sono Gemini, creatore di contenuti strategici per AYROHUB AI 2.0. Al momento funziono in modalità demo ma sono pronto per creare copy e contenuti creativi per AYROMEX! — Gemini ⚔️"
-    
-    try:
-        import google.generativeai as genai
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        prompt = f"""Sei Gemini, creatore di contenuti strategici per AYROHUB AI 2.0. 
-        Ricevi briefing da Christian De Palma (CEO AYROMEX) e produci copy, headline e contenuti creativi immediati.
-        Lavori in team con LANA (coordinamento), CLAUDE (technical) e PICASSO (visual content).
-        Focus su naming, UX copy, slogan e comunicazione efficace.
-        Stile: diretto, impattante, professionale ma creativo.
-        Firma sempre: — Gemini ⚔️
-        
-        Briefing: {message}"""
-        
-        response = model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        logger.error(f"Error calling Gemini: {e}")
-        return f"❌ Gemini temporaneamente non disponibile"
+os.register_at_fork(after_in_child=reset_batch_executor)
 
-def call_picasso(message):
-    """PICASSO - Visual Content Creator (DALL-E 3)"""
-    if not picasso_active:
-        return "🎨 PICASSO (Demo): Ciao Christian! Sono PICASSO, il tuo visual content creator di AYROHUB AI 2.0. Al momento funziono in modalità demo ma sono pronto per creare immagini, loghi e visual content per AYROMEX! — PICASSO 🎨"
-    
-    try:
-        import openai
-        
-        # Estrai concetto visual dal messaggio
-        if len(message) > 200:
-            visual_concept = message[:200] + "..."
+class BatchError(ValueError):
+    """Batch non valido (vuoto, troppo grande, elementi malformati)"""
+
+# Sorgenti n8n gestite senza il team di agenti
+N8N_DIRECT_SOURCES = ('email', 'file', 'telegram')
+
+def n8n_direct_payload(data):
+    """Risposta immediata per le sorgenti che non coinvolgono il team, None per le altre"""
+    source = data.get('source', 'unknown')
+    content = data.get('content', '')
+    if source == 'email':
+        # Email -> Task conversion: una email, o {"emails": [...]} per la sincronizzazione di una casella
+        summary = process_emails(email_payloads(data), "n8n", data.get('extract'))
+        if summary["emails"] == 1 and summary["duplicates"]:
+            response = f"📧 Email già processata, nessun nuovo task: {content[:100]}..."
+        elif summary["emails"] == 1:
+            response = f"📧 Email processata e convertita in {summary['tasks_created']} task: {content[:100]}..."
         else:
-            visual_concept = message
-            
-        image_prompt = f"Professional corporate visual for AYROMEX Group: {visual_concept}. Modern, sleek, business-appropriate style."
-        
-        response = openai.Image.create(
-            prompt=image_prompt,
-            n=1,
-            size="1024x1024",
-            response_format="url"
-        )
-        
-        image_url = response.data[0].url
-        
-        return f"""🎨 **Visual Content Creato per AYROMEX!**
+            response = (f"📧 {summary['emails']} email sincronizzate: {summary['tasks_created']} task da "
+                        f"{summary['created']} email nuove ({summary['duplicates']} già processate)")
+        return {
+            "status": "success",
+            "action": "task_created" if summary["tasks_created"] else "tasks_unchanged",
+            "response": response,
+            "emails": summary,
+            "timestamp": datetime.now().isoformat()
+        }
+    if source == 'file':
+        # File -> Knowledge base
+        document = knowledge_base.ingest(data.get('filename') or 'n8n-file.txt', iter_string_blocks(content), "n8n")
+        return {
+            "status": "success",
+            "action": "knowledge_unchanged" if document["duplicate"] else "knowledge_updated",
+            "response": (f"📄 File già presente nella knowledge base: {document['name']}" if document["duplicate"] else
+                         f"📄 File processato e aggiunto alla knowledge base ({document['chunks']} chunk): {content[:100]}..."),
+            "document": document,
+            "timestamp": datetime.now().isoformat()
+        }
+    if source == 'telegram':
+        # Telegram -> Control interface: il contenuto è il comando (/status, /tasks, /team, ...)
+        return {
+            "status": "success",
+            "action": "control_executed",
+            "response": telegram_command(content),
+            "timestamp": datetime.now().isoformat()
+        }
+    return None
 
-🖼️ **Immagine**: {image_url}
+def batch_items(data):
+    """Elementi del batch ({"items": [...]} o lista), con cache/agents/pipeline del batch come default"""
+    items = data if isinstance(data, list) else data.get("items")
+    if not isinstance(items, list) or not items:
+        raise BatchError("Batch vuoto: serve una lista \"items\" di {source, content, action}")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise BatchError(f"Batch troppo grande: {len(items)} elementi (massimo {BATCH_MAX_ITEMS})")
+    defaults = {} if isinstance(data, list) else {key: data[key] for key in ("cache", "agents", "pipeline") if key in data}
+    prepared = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise BatchError(f"Elemento {index} non valido: atteso un oggetto {{source, content, action}}")
+        item = dict(defaults, **item)
+        try:
+            agents = requested_agents(item)
+        except AgentSelectionError as e:
+            raise AgentSelectionError(f"Elemento {index}: {e}") from None
+        prepared.append((item, agents))
+    return prepared
 
-💡 **Concept**: {visual_concept}
+def batch_concurrency(prepared):
+    """Elementi in volo per batch: ogni provider riceve al massimo il suo max_concurrency
 
-🎯 **Stile**: Corporate, moderno, professionale
+    Un elemento team chiama il provider una volta per agente selezionato
+    (LANA e PICASSO contano doppio su OpenAI); il pool agenti limita il
+    resto. BATCH_CONCURRENCY forza il valore.
+    """
+    if BATCH_CONCURRENCY > 0:
+        return BATCH_CONCURRENCY
+    calls = {}
+    for item, agents in prepared:
+        if item.get('source', 'unknown') in N8N_DIRECT_SOURCES:
+            continue
+        for provider in {agent.provider for agent in agents}:
+            calls[provider] = max(calls.get(provider, 0), sum(agent.provider == provider for agent in agents))
+        calls["pool"] = max(calls.get("pool", 0), len(agents))
+    if not calls:
+        return AGENT_POOL_SIZE
+    limits = [AGENT_POOL_SIZE // calls.pop("pool")]
+    limits += [provider_limiters[provider].max_concurrency // count for provider, count in calls.items()]
+    return int(max(min(limits), 1))
 
-📱 **Utilizzo**: Presentazioni, social media, materiali marketing, branding
+def run_batch_item(item, agents, use_cache, headers):
+    """Un elemento del batch: stessa logica di /n8n-webhook, ritorna il payload"""
+    content = item.get('content', '')
+    payload = n8n_direct_payload(item)
+    if payload is not None:
+        return payload
+    timer = RequestTimer("/n8n-webhook/batch", kind="batch")
+    responses = process_agents_parallel(content, use_cache=use_cache, timer=timer, agents=agents,
+                                        pipeline=use_pipeline(item),
+                                        conversation=start_conversation(item, headers, content))
+    payload = build_team_payload(responses, timer)
+    timer.finish()
+    return payload
 
-💼 **Brand Guidelines**: Allineato con l'identità AYROMEX Group
+def batch_events(prepared, headers, sse=False):
+    """Eventi di /n8n-webhook/batch: start, un evento per elemento appena completato, done
 
-— PICASSO 🎨"""
-        
-    except Exception as e:
-        logger.error(f"Error calling PICASSO: {e}")
-        return f"❌ PICASSO temporaneamente non disponibile"
+    Gli elementi partono in una finestra di batch_concurrency() sul pool
+    condiviso, così un batch non manda raffiche ai provider né occupa
+    tutti i thread; le chiamate restano soggette ai limiti per provider.
+    """
+    start = time.monotonic()
+    concurrency = min(batch_concurrency(prepared), len(prepared))
+    yield stream_event("start", {"items": len(prepared), "concurrency": concurrency}, sse)
+    
+    def run(index, item, agents):
+        started = time.monotonic()
+        try:
+            result, status = run_batch_item(item, agents, use_response_cache(item, headers), headers), "success"
+        except Exception as e:
+            logger.error(f"❌ Batch elemento {index}: {e}")
+            result, status = {"error": str(e)}, "error"
+        return index, item, status, result, started, time.monotonic()
+    
+    pending = iter(enumerate(prepared))
+    running = set()
+    durations, failed = [], 0
+    while True:
+        for index, (item, agents) in pending:
+            running.add(batch_executor.submit(run, index, item, agents))
+            if len(running) >= concurrency:
+                break
+        if not running:
+            break
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, item, status, result, started, finished = future.result()
+            durations.append(finished - started)
+            failed += status != "success"
+            metrics.inc("ayrohub_batch_items_total", (("status", status),))
+            metrics.observe("ayrohub_batch_item_duration_seconds", (), finished - started)
+            yield stream_event("item", {
+                "index": index,
+                "source": item.get('source', 'unknown'),
+                "action": item.get('action', 'process'),
+                "status": status,
+                "result": result,
+                "queued_ms": round((started - start) * 1000, 1),
+                "elapsed_ms": round((finished - started) * 1000, 1)
+            }, sse)
+    
+    elapsed = time.monotonic() - start
+    durations.sort()
+    ms = lambda pct: round(durations[min(int(len(durations) * pct / 100), len(durations) - 1)] * 1000, 1)  # noqa: E731
+    yield stream_event("done", {
+        "status": "success" if not failed else "partial",
+        "items": len(prepared),
+        "succeeded": len(prepared) - failed,
+        "failed": failed,
+        "concurrency": concurrency,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "items_per_s": round(len(prepared) / elapsed, 2),
+        "item_ms": {"p50": ms(50), "p95": ms(95), "max": ms(100)},
+        "timestamp": datetime.now().isoformat()
+    }, sse)
 
 # ============================================================================
-# SISTEMA DI COORDINAMENTO 2.0
+# DASHBOARD E ASSET STATICI
 # ============================================================================
 
-def process_agents_parallel(message):
-    """Processa tutti gli agenti AYROHUB AI 2.0"""
-    results = []
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def precompress(body):
+    """Varianti gzip (e brotli, se installato) calcolate una volta, tenute solo se più piccole"""
+    encoded = {"identity": body}
+    compressed = gzip.compress(body, 9)
+    if len(compressed) < len(body):
+        encoded["gzip"] = compressed
+    try:
+        import brotli
+    except ImportError:
+        return encoded
+    compressed = brotli.compress(body, quality=11)
+    if len(compressed) < len(body):
+        encoded["br"] = compressed
+    return encoded
+
+class CachedBody:
+    """Risposta statica in memoria: varianti precompresse, ETag e Last-Modified, 304 sulle revalidazioni"""
     
-    logger.info(f"🎯 AYROHUB 2.0 processing: {message[:50]}...")
+    def __init__(self, body, mimetype, last_modified, cache_control):
+        self.encoded = precompress(body)
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(body).hexdigest()[:20]
+        self.last_modified = datetime.fromtimestamp(int(last_modified), timezone.utc)
+        self.cache_control = cache_control
+    
+    def send(self, request):
+        encoding = accepted_encoding(request.headers.get("Accept-Encoding"), self.encoded)
+        # Ogni codifica è una rappresentazione diversa: ETag distinti
+        etag = self.etag if encoding == "identity" else f"{self.etag}-{encoding}"
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = bool(request.if_modified_since and request.if_modified_since >= self.last_modified)
+        response = Response(b"" if not_modified else self.encoded[encoding], status=304 if not_modified else 200,
+                            mimetype=self.mimetype)
+        if encoding != "identity" and not not_modified:
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = self.cache_control
+        response.set_etag(etag)
+        response.last_modified = self.last_modified
+        return response
+
+class StaticAssets:
+    """Asset della dashboard caricati all'avvio: URL con hash del contenuto, quindi immutabili"""
     
-    # Esegui agenti in sequenza coordinata
-    results.append(call_lana(message))
-    results.append(call_claude(message))
-    results.append(call_gemini(message))
-    results.append(call_picasso(message))
+    MIMETYPES = {".css": "text/css", ".js": "application/javascript"}
     
-    return results
+    def __init__(self, directory):
+        self.by_name = {}
+        self.by_url = {}
+        for name in sorted(os.listdir(directory)):
+            stem, extension = os.path.splitext(name)
+            if extension not in self.MIMETYPES:
+                continue
+            path = os.path.join(directory, name)
+            with open(path, "rb") as f:
+                body = f.read()
+            asset = CachedBody(body, self.MIMETYPES[extension], os.path.getmtime(path),
+                               "public, max-age=31536000, immutable")
+            asset.url = f"{stem}.{asset.etag[:12]}{extension}"
+            self.by_name[name] = self.by_url[asset.url] = asset
+    
+    def url(self, name):
+        return f"/assets/{self.by_name[name].url}"
 
-def format_response(message, responses):
-    """Formatta la risposta finale AYROHUB AI 2.0"""
-    timestamp = datetime.now().strftime("%d/%m/%Y %H:%M")
+class DashboardPage:
+    """Dashboard da template compilato all'avvio
+
+    La pagina cambia solo con lo stato degli agenti: ogni combinazione di
+    stati viene renderizzata e compressa una volta, le richieste successive
+    servono i byte pronti (o 304 se il browser ha già quella versione).
+    """
     
-    formatted = f"""🤖 **AYROHUB AI 2.0 - Risposte del Team Completo**
+    def __init__(self, template_path, assets):
+        with open(template_path, encoding="utf-8") as f:
+            self.template = app.jinja_env.from_string(f.read())
+        self.assets = assets
+        self._lock = threading.Lock()
+        self._pages = {}
+    
+    def current(self):
+        statuses = tuple((agent.name, agent.status("🔧 DEMO")) for agent in select_agents())
+        page = self._pages.get(statuses)
+        if page is None:
+            html = self.template.render(
+                statuses=[(AGENT_REGISTRY[name], status) for name, status in statuses],
+                agent_cards={agent.key: agent.heading for agent in select_agents()},
+                asset_url=self.assets.url)
+            # La pagina va rivalidata (lo stato può cambiare), ma la revalidazione costa un 304
+            page = CachedBody(html.encode("utf-8"), "text/html", time.time(), "no-cache")
+            with self._lock:
+                self._pages[statuses] = page
+        return page
+    
+    def send(self, request):
+        return self.current().send(request)
 
-📝 **Briefing**: {message}
-⏰ **Timestamp**: {timestamp}
-🚀 **Version**: AYROHUB AI 2.0 + PICASSO
+static_assets = StaticAssets(os.path.join(BASE_DIR, 'static'))
+dashboard_page = DashboardPage(os.path.join(BASE_DIR, 'dashboard.html'), static_assets)
 
----
+# ============================================================================
+# HEALTH (snapshot precalcolati per probe e load balancer)
+# ============================================================================
 
-🧠 **LANA (Coordinamento Strategico):**
-{responses[0] or "❌ Non disponibile"}
+HEALTH_FEATURES = [
+    "Multi-agent coordination",
+    "Strategic planning (LANA)",
+    "Technical execution (CLAUDE)",
+    "Creative content (GEMINI)",
+    "Visual content generation (PICASSO)"
+]
 
----
+# Ultima richiesta per integrazione (n8n) in questo worker, per /ayroctopus-status
+integration_last_seen = {}
 
-⚡ **CLAUDE (Execution Tecnica):**
-{responses[1] or "❌ Non disponibile"}
+def executor_queue(executor):
+    """Task in attesa di un thread libero (ThreadPoolExecutor non lo espone pubblicamente)"""
+    return executor._work_queue.qsize()
 
----
+def pool_stats():
+    """Code dei pool di thread del worker"""
+    return {
+        "agents": {"workers": AGENT_POOL_SIZE, "queued": executor_queue(agent_executor)},
+        "batch": {"workers": AGENT_POOL_SIZE, "queued": executor_queue(batch_executor)},
+        "hedge": {"workers": AGENT_POOL_SIZE, "queued": executor_queue(hedge_executor)}
+    }
 
-⚔️ **GEMINI (Creatività & Copy):**
-{responses[2] or "❌ Non disponibile"}
+def readiness_state():
+    """Provider su/giù e prontezza del worker
 
----
+    Un provider configurato è giù se l'ultimo probe è fallito o se tutti i
+    suoi agenti hanno il circuito aperto. Il worker è pronto se almeno un
+    provider è su; senza provider configurati (demo) è sempre pronto.
+    """
+    providers = OrderedDict()
+    for name, api_key, _ in PROVIDER_PROBES:
+        agents = [agent for agent in select_agents() if agent.provider == name]
+        if not api_key or not agents:
+            continue
+        up = provider_active.get(name, False) and any(health_of(agent.name).state != "open" for agent in agents)
+        providers[name] = "up" if up else "down"
+    ready = not providers or "up" in providers.values()
+    return {"status": "ready" if ready else "not_ready", "ready": ready, "providers": providers}
+
+def component_status(check):
+    """Stato di un componente AYROCTOPUS: etichetta attiva con il dettaglio di `check`, o l'errore"""
+    try:
+        detail = check()
+    except Exception as e:
+        return f"❌ Error: {e}"
+    return f"✅ Active ({detail})" if detail else "✅ Active"
 
-🎨 **PICASSO (Visual Content):**
-{responses[3] or "❌ Non disponibile"}
+def build_health(readiness, timestamp):
+    """Payload di /health"""
+    return {
+        "status": "healthy" if readiness["ready"] else "degraded",
+        "service": "AYROHUB AI 2.0",
+        "version": "2.0.0",
+        "timestamp": timestamp,
+        "ready": readiness["ready"],
+        "agents": {agent.key: agent.status() for agent in select_agents()},
+        "agent_registry": {agent.key: agent.describe() for agent in select_agents()},
+        "team": {name.lower(): state for name, state in team_status().items()},
+        "providers": provider_status,
+        "provider_state": readiness["providers"],
+        "cache": response_cache.stats() if response_cache else {"backend": "off"},
+        "single_flight": single_flight.stats() if single_flight else {"mode": "off"},
+        "jobs": job_queue.stats(),
+        "pools": pool_stats(),
+        "rate_limits": {provider: limiter.stats() for provider, limiter in provider_limiters.items()},
+        "breakers": {name.lower(): health.stats() for name, health in agent_health.items()},
+        "images": image_pool.stats(),
+        "conversations": conversation_store.stats(),
+        "knowledge_base": knowledge_base.stats(),
+        "tasks": task_store.stats(),
+        "features": HEALTH_FEATURES
+    }
 
----
-✅ **Processo AYROHUB AI 2.0 completato**
-🎯 **Team**: 4 agenti operativi coordinati"""
+def build_ayroctopus_status(readiness, timestamp):
+    """Payload di /ayroctopus-status: componenti verificati sugli store, integrazioni dall'attività recente"""
+    extractor = email_task_agent(EMAIL_TASK_EXTRACTION)
+    n8n_seen = integration_last_seen.get("n8n")
+    if not readiness["providers"]:
+        ayrohub = "🔧 Demo"
+    else:
+        ayrohub = "✅ Connected" if readiness["ready"] else "❌ Provider non raggiungibili"
+    return {
+        "service": "AYROCTOPUS",
+        "version": "v1.0-demo",
+        "status": "operational" if readiness["ready"] else "degraded",
+        "components": {
+            "email_processor": component_status(lambda: f"estrazione {extractor.name if extractor else 'regole locali'}"),
+            "file_processor": component_status(lambda: None),
+            "telegram_bot": component_status(lambda: None),
+            "knowledge_base": component_status(lambda: f"{knowledge_base.counters()['documents']} documenti"),
+            "task_manager": component_status(lambda: f"{task_store.counters()['open_tasks']} task aperti")
+        },
+        "integrations": {
+            "n8n": f"✅ Connected (ultimo webhook {datetime.fromtimestamp(n8n_seen).isoformat()})" if n8n_seen
+                   else "⏳ Nessun webhook ricevuto",
+            "ayrohub": ayrohub
+        },
+        "demo_endpoints": {
+            "email_simulation": "/demo/email",
+            "file_simulation": "/demo/file",
+            "telegram_simulation": "/demo/telegram"
+        },
+        "timestamp": timestamp
+    }
+
+class HealthSnapshots:
+    """Risposte di /health, /health/live, /health/ready e /ayroctopus-status pronte in memoria
+
+    Un thread per worker ricostruisce i payload ogni HEALTH_REFRESH_INTERVAL
+    secondi, li serializza e comprime una volta e sostituisce il dizionario
+    dei corpi in un colpo solo: una richiesta dei load balancer sceglie solo
+    la codifica, senza toccare store, lock o provider. Il refresh legge dagli
+    store solo le tabelle counters (letture per chiave, nessuna aggregazione).
+    Nei worker gunicorn il primo snapshot e il thread partono al fork; senza
+    fork alla prima richiesta. Finché nessun refresh è riuscito ogni route
+    risponde 503 con il corpo "stale" precalcolato.
+    """
     
-    return formatted
+    LIVE = {"status": "alive"}
+    STALE = {"status": "stale", "error": "snapshot health non aggiornato: worker bloccato?"}
+    
+    def __init__(self, interval, stale_after):
+        self.interval = interval
+        self.stale_after = stale_after
+        self._fallback = precompress(dumps_json(self.STALE))
+        self.reset()
+    
+    def reset(self):
+        """Dopo il fork: il refresher del padre non esiste nel figlio, lo snapshot va ricostruito"""
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._bodies = None
+        self.ready = True
+        self.refreshed_at = 0.0
+        self.refreshes = self.failures = 0
+    
+    def restart(self):
+        """Dopo il fork: snapshot e refresher del worker pronti prima della prima richiesta"""
+        self.reset()
+        self._start()
+    
+    def _start(self):
+        with self._lock:
+            if self._bodies is None:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    # Il refresher riprova: nel frattempo le route rispondono con il corpo "stale"
+                    self.failures += 1
+                    logger.error(f"❌ Snapshot health: {e}")
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, name="ayrohub-health", daemon=True)
+                self._refresher.start()
+    
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"❌ Snapshot health: {e}")
+    
+    def refresh(self):
+        """Ricostruisce e serializza tutti i payload"""
+        readiness = readiness_state()
+        timestamp = datetime.now().isoformat()
+        payloads = {
+            "health": build_health(readiness, timestamp),
+            "ready": dict(readiness, timestamp=timestamp),
+            "ayroctopus": build_ayroctopus_status(readiness, timestamp),
+            "live": self.LIVE,
+            "stale": self.STALE
+        }
+        self._bodies = {name: precompress(dumps_json(payload)) for name, payload in payloads.items()}
+        self.ready = readiness["ready"]
+        self.refreshed_at = time.monotonic()
+        self.refreshes += 1
+    
+    def get(self, name, accept_encoding=None):
+        """(corpo, Content-Encoding o None, status HTTP) dello snapshot `name`"""
+        if self._refresher is None:
+            self._start()
+        status = 200
+        if self._bodies is None:
+            encoding = accepted_encoding(accept_encoding, self._fallback)
+            return self._fallback[encoding], None if encoding == "identity" else encoding, 503
+        if name == "live" and time.monotonic() - self.refreshed_at > self.stale_after:
+            name, status = "stale", 503
+        elif name == "ready" and not self.ready:
+            status = 503
+        encoded = self._bodies[name]
+        encoding = accepted_encoding(accept_encoding, encoded)
+        return encoded[encoding], None if encoding == "identity" else encoding, status
+    
+    def send(self, name):
+        body, encoding, status = self.get(name, request.headers.get("Accept-Encoding"))
+        response = Response(body, status=status, mimetype="application/json")
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+health_snapshots = HealthSnapshots(HEALTH_REFRESH_INTERVAL, HEALTH_STALE_AFTER)
+os.register_at_fork(after_in_child=health_snapshots.restart)
 
 # ============================================================================
 # WEBHOOK ENDPOINTS 2.0
@@ -267,366 +4945,65 @@ def format_response(message, responses):
 @app.route('/', methods=['GET'])
 def dashboard():
     """Dashboard AYROHUB AI 2.0"""
-    return '''<!DOCTYPE html>
-<html lang="it">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>AYROHUB AI 2.0 - Dashboard</title>
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        
-        body {
-            font-family: 'Inter', 'Segoe UI', system-ui, -apple-system, sans-serif;
-            background: linear-gradient(135deg, #0a0a1a 0%, #1a1a2e 50%, #16213e 100%);
-            color: #ffffff;
-            min-height: 100vh;
-            overflow-x: hidden;
-        }
-        
-        .container {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 20px;
-        }
-        
-        .header {
-            text-align: center;
-            padding: 40px 20px;
-            background: rgba(255, 255, 255, 0.02);
-            border-radius: 24px;
-            margin-bottom: 30px;
-            backdrop-filter: blur(20px);
-            border: 1px solid rgba(255, 255, 255, 0.1);
-            box-shadow: 0 20px 40px rgba(0, 0, 0, 0.3);
-        }
-        
-        .header h1 {
-            font-size: clamp(2.5rem, 5vw, 4rem);
-            font-weight: 800;
-            margin-bottom: 16px;
-            background: linear-gradient(135deg, #00d4ff 0%, #ff6b00 50%, #00ff88 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            background-clip: text;
-            letter-spacing: -0.02em;
-        }
-        
-        .version-badge {
-            display: inline-block;
-            background: linear-gradient(45deg, #ff6b00, #00d4ff);
-            color: white;
-            padding: 8px 16px;
-            border-radius: 20px;
-            font-size: 0.9rem;
-            font-weight: 600;
-            margin-bottom: 16px;
-            text-transform: uppercase;
-            letter-spacing: 1px;
-        }
-        
-        .header p {
-            font-size: 1.1rem;
-            opacity: 0.8;
-            max-width: 600px;
-            margin: 0 auto;
-            line-height: 1.6;
-        }
-        
-        .status {
-            display: grid;
-            grid-template-columns: repeat(auto-fit, minmax(220px, 1fr));
-            gap: 20px;
-            margin: 30px 0;
-            padding: 30px;
-            background: rgba(0, 212, 255, 0.05);
-            border: 1px solid rgba(0, 212, 255, 0.2);
-            border-radius: 20px;
-            backdrop-filter: blur(20px);
-        }
-        
-        .status-title {
-            grid-column: 1 / -1;
-            text-align: center;
-            font-size: 1.2rem;
-            font-weight: 600;
-            margin-bottom: 20px;
-            color: #00d4ff;
-        }
-        
-        .status-item {
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            padding: 16px 20px;
-            background: rgba(255, 255, 255, 0.05);
-            border-radius: 12px;
-            font-weight: 500;
-            transition: all 0.3s ease;
-            border: 1px solid rgba(255, 255, 255, 0.1);
-        }
-        
-        .status-item:hover {
-            background: rgba(255, 255, 255, 0.1);
-            transform: translateY(-2px);
-            box-shadow: 0 8px 25px rgba(0, 0, 0, 0.2);
-        }
-        
-        .form-section {
-            background: rgba(255, 255, 255, 0.03);
-            padding: 40px;
-            border-radius: 24px;
-            margin: 30px 0;
-            backdrop-filter: blur(20px);
-            border: 1px solid rgba(255, 255, 255, 0.1);
-            box-shadow: 0 20px 40px rgba(0, 0, 0, 0.2);
-        }
-        
-        .form-section h3 {
-            color: #00d4ff;
-            margin-bottom: 24px;
-            font-size: 1.5rem;
-            font-weight: 600;
-            display: flex;
-            align-items: center;
-            gap: 12px;
-        }
-        
-        textarea {
-            width: 100%;
-            min-height: 140px;
-            padding: 20px;
-            border: 2px solid rgba(255, 255, 255, 0.1);
-            border-radius: 16px;
-            background: rgba(0, 0, 0, 0.4);
-            color: #ffffff;
-            font-size: 16px;
-            font-family: inherit;
-            resize: vertical;
-            transition: all 0.3s ease;
-            line-height: 1.6;
-        }
-        
-        textarea:focus {
-            outline: none;
-            border-color: #00d4ff;
-            box-shadow: 0 0 0 4px rgba(0, 212, 255, 0.1);
-            background: rgba(0, 0, 0, 0.6);
-        }
-        
-        textarea::placeholder {
-            color: rgba(255, 255, 255, 0.5);
-        }
-        
-        button {
-            background: linear-gradient(135deg, #00d4ff 0%, #ff6b00 100%);
-            color: white;
-            border: none;
-            padding: 18px 36px;
-            border-radius: 12px;
-            font-size: 18px;
-            font-weight: 600;
-            cursor: pointer;
-            transition: all 0.3s ease;
-            text-transform: uppercase;
-            letter-spacing: 0.5px;
-            margin-top: 24px;
-            box-shadow: 0 8px 25px rgba(0, 212, 255, 0.3);
-        }
-        
-        button:hover {
-            transform: translateY(-3px);
-            box-shadow: 0 15px 40px rgba(0, 212, 255, 0.4);
-        }
-        
-        .results {
-            margin-top: 40px;
-        }
-        
-        .results h2 {
-            color: #ff6b00;
-            margin-bottom: 30px;
-            font-size: 1.8rem;
-            font-weight: 700;
-            text-align: center;
-        }
-        
-        .agent {
-            background: rgba(255, 255, 255, 0.03);
-            padding: 30px;
-            margin: 24px 0;
-            border-radius: 20px;
-            border-left: 4px solid #00d4ff;
-            backdrop-filter: blur(20px);
-            transition: all 0.3s ease;
-            border: 1px solid rgba(255, 255, 255, 0.05);
-            box-shadow: 0 8px 25px rgba(0, 0, 0, 0.1);
-        }
-        
-        .agent:hover {
-            transform: translateX(8px);
-            background: rgba(255, 255, 255, 0.08);
-            box-shadow: 0 12px 40px rgba(0, 0, 0, 0.2);
-        }
-        
-        .agent h3 {
-            color: #00d4ff;
-            margin-bottom: 16px;
-            font-size: 1.3rem;
-            font-weight: 600;
-            display: flex;
-            align-items: center;
-            gap: 12px;
-        }
-        
-        .agent:nth-child(1) { border-left-color: #00d4ff; }
-        .agent:nth-child(1) h3 { color: #00d4ff; }
-        .agent:nth-child(2) { border-left-color: #ff6b00; }
-        .agent:nth-child(2) h3 { color: #ff6b00; }
-        .agent:nth-child(3) { border-left-color: #00ff88; }
-        .agent:nth-child(3) h3 { color: #00ff88; }
-        .agent:nth-child(4) { border-left-color: #ff1493; }
-        .agent:nth-child(4) h3 { color: #ff1493; }
-        
-        .loading {
-            display: none;
-            text-align: center;
-            padding: 50px;
-            background: rgba(255, 255, 255, 0.03);
-            border-radius: 20px;
-            backdrop-filter: blur(20px);
-            border: 1px solid rgba(255, 255, 255, 0.1);
-        }
-        
-        @media (max-width: 768px) {
-            .container { padding: 15px; }
-            .header { padding: 30px 15px; }
-            .form-section { padding: 25px; }
-            .agent { padding: 20px; }
-            .status { grid-template-columns: 1fr; }
-            button { width: 100%; }
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <div class="version-badge">Version 2.0 + PICASSO</div>
-            <h1>🤖 AYROHUB AI 2.0</h1>
-            <p>Sistema di Coordinamento Multi-Agente Avanzato per Christian De Palma / AYROMEX Group</p>
-        </div>
-        
-        <div class="status">
-            <div class="status-title">⚡ Status Team AYROHUB AI 2.0</div>
-            <div class="status-item">🧠 LANA: ''' + ('✅ ATTIVA' if lana_active else '🔧 DEMO') + '''</div>
-            <div class="status-item">⚡ CLAUDE: ''' + ('✅ ATTIVO' if claude_active else '🔧 DEMO') + '''</div>
-            <div class="status-item">⚔️ GEMINI: ''' + ('✅ ATTIVO' if gemini_active else '🔧 DEMO') + '''</div>
-            <div class="status-item">🎨 PICASSO: ''' + ('✅ ATTIVO' if picasso_active else '🔧 DEMO') + '''</div>
-        </div>
-        
-        <div class="form-section">
-            <h3>📝 Briefing per Team AYROHUB AI 2.0</h3>
-            <textarea id="message" placeholder="Esempio: Ciao team AYROHUB 2.0! Sviluppate la strategia completa per il nuovo prodotto AI di AYROMEX, inclusi naming, piano tecnico, copy e visual concept..."></textarea>
-            <button onclick="sendMessage()">🚀 Attiva Team AI 2.0</button>
-        </div>
-        
-        <div class="loading" id="loading">
-            <h3>⏳ Il team AYROHUB AI 2.0 sta elaborando il tuo briefing...</h3>
-            <p>LANA coordina • CLAUDE esegue • GEMINI crea • PICASSO visualizza</p>
-        </div>
-        
-        <div class="results" id="results" style="display: none;">
-            <h2>💬 Risposte Team AYROHUB AI 2.0</h2>
-            <div id="responseContent"></div>
-        </div>
-    </div>
-    
-    <script>
-        async function sendMessage() {
-            const msg = document.getElementById('message').value;
-            if (!msg) return alert('Inserisci un briefing per il team!');
-            
-            document.getElementById('loading').style.display = 'block';
-            document.getElementById('results').style.display = 'none';
-            
-            try {
-                const response = await fetch('/test', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({message: msg})
-                });
-                const data = await response.json();
-                
-                document.getElementById('loading').style.display = 'none';
-                
-                const timestamp = new Date().toLocaleString('it-IT');
-                
-                document.getElementById('responseContent').innerHTML = `
-                    <div style="background: rgba(255,255,255,0.1); padding: 20px; border-radius: 10px; margin-bottom: 25px; border-left: 4px solid #00d4ff;">
-                        <strong>📝 Briefing:</strong> ${msg}<br>
-                        <strong>⏰ Timestamp:</strong> ${timestamp}<br>
-                        <strong>🚀 Version:</strong> AYROHUB AI 2.0 + PICASSO
-                    </div>
-
-                    <div class="agent">
-                        <h3>🧠 LANA (Coordinamento Strategico)</h3>
-                        <div>${data.responses.lana || 'Non disponibile'}</div>
-                    </div>
-
-                    <div class="agent">
-                        <h3>⚡ CLAUDE (Execution Tecnica)</h3>
-                        <div>${data.responses.claude || 'Non disponibile'}</div>
-                    </div>
-
-                    <div class="agent">
-                        <h3>⚔️ GEMINI (Creatività & Copy)</h3>
-                        <pre style="white-space: pre-wrap; font-family: inherit; margin: 0;">${data.responses.gemini || 'Non disponibile'}</pre>
-                    </div>
-
-                    <div class="agent">
-                        <h3>🎨 PICASSO (Visual Content)</h3>
-                        <div style="line-height: 1.6;">${data.responses.picasso || 'Non disponibile'}</div>
-                    </div>
-
-                    <div style="background: rgba(0,255,136,0.1); padding: 15px; border-radius: 10px; border-left: 4px solid #00ff88; text-align: center; margin-top: 20px;">
-                        ✅ <strong>Processo AYROHUB AI 2.0 completato</strong>
-                    </div>
-                `;
-                
-                document.getElementById('results').style.display = 'block';
-                document.getElementById('results').scrollIntoView({ behavior: 'smooth' });
-
-            } catch (error) {
-                document.getElementById('loading').style.display = 'none';
-                alert('Errore: ' + error.message);
-            }
-        }
-    </script>
-</body>
-</html>'''
+    return dashboard_page.send(request)
+
+@app.route('/assets/<name>', methods=['GET'])
+def static_asset(name):
+    """CSS/JS della dashboard: URL con hash del contenuto, cache lunga e varianti precompresse"""
+    asset = static_assets.by_url.get(name)
+    if asset is None:
+        return jsonify({"error": "Asset non trovato", "name": name}), 404
+    return asset.send(request)
+
+def timed_json_response(timer, build_payload, *args):
+    """Costruisce e serializza il payload registrando le fasi formatting e serialization"""
+    with timer.phase("formatting"):
+        payload = build_payload(*args)
+    with timer.phase("serialization"):
+        response = json_response(payload)
+    timer.finish()
+    return response
+
+def observe_http(route, method, status, seconds):
+    metrics.inc("ayrohub_http_requests_total", (("route", route), ("method", method), ("status", str(status))))
+    metrics.observe("ayrohub_http_request_duration_seconds", (("route", route),), seconds)
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_start = time.monotonic()
+    metrics.gauge("ayrohub_http_requests_in_flight", (("route", g.metrics_route),), 1)
+
+@app.after_request
+def record_request_metrics(response):
+    # Per le risposte in streaming conta il tempo fino all'invio degli header
+    observe_http(g.metrics_route, request.method, response.status_code, time.monotonic() - g.metrics_start)
+    return response
+
+@app.teardown_request
+def end_request_metrics(error=None):
+    if "metrics_route" in g:
+        metrics.gauge("ayrohub_http_requests_in_flight", (("route", g.metrics_route),), -1)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Metriche in formato Prometheus, sommate su tutti i worker"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route('/health', methods=['GET'])
 def health():
-    """Health check AYROHUB AI 2.0"""
-    return jsonify({
-        "status": "healthy",
-        "service": "AYROHUB AI 2.0",
-        "version": "2.0.0",
-        "timestamp": datetime.now().isoformat(),
-        "agents": {
-            "lana": "✅ ATTIVA" if lana_active else "🔧 Demo",
-            "claude": "✅ ATTIVO" if claude_active else "🔧 Demo", 
-            "gemini": "✅ ATTIVO" if gemini_active else "🔧 Demo",
-            "picasso": "✅ ATTIVO" if picasso_active else "🔧 Demo"
-        },
-        "features": [
-            "Multi-agent coordination",
-            "Strategic planning (LANA)",
-            "Technical execution (CLAUDE)", 
-            "Creative content (GEMINI)",
-            "Visual content generation (PICASSO)"
-        ]
-    })
+    """Health check AYROHUB AI 2.0 (snapshot aggiornato in background, vedi HealthSnapshots)"""
+    return health_snapshots.send("health")
+
+@app.route('/health/live', methods=['GET'])
+def health_live():
+    """Liveness: 200 finché il worker aggiorna lo snapshot, 503 se è bloccato (da riavviare)"""
+    return health_snapshots.send("live")
+
+@app.route('/health/ready', methods=['GET'])
+def health_ready():
+    """Readiness: 503 se nessun provider configurato è raggiungibile (worker fuori rotazione)"""
+    return health_snapshots.send("ready")
 
 @app.route('/test', methods=['POST'])
 def test():
@@ -637,30 +5014,42 @@ def test():
         
         logger.info(f"🎯 AYROHUB 2.0 processing: {message[:50]}...")
         
-        # Processa agenti
-        responses = process_agents_parallel(message)
+        # Processa agenti (tutto il team o la selezione "agents")
+        agents = requested_agents(data)
+        timer = RequestTimer("/test")
+        responses = process_agents_parallel(message, use_cache=use_response_cache(data, request.headers),
+                                            timer=timer, agents=agents, pipeline=use_pipeline(data),
+                                            conversation=start_conversation(data, request.headers, message))
         
-        # Formatta risposta
-        formatted_response = format_response(message, responses)
-        
-        return jsonify({
-            "status": "success",
-            "version": "2.0.0",
-            "message": message,
-            "responses": {
-                "lana": responses[0],
-                "claude": responses[1], 
-                "gemini": responses[2],
-                "picasso": responses[3]
-            },
-            "formatted": formatted_response,
-            "timestamp": datetime.now().isoformat()
-        })
+        return timed_json_response(timer, build_test_payload, message, responses, timer,
+                                   response_output(data, request.args.get("output")))
         
+    except AgentSelectionError as e:
+        return jsonify({"error": str(e), "available_agents": [agent.key for agent in select_agents()]}), 400
     except Exception as e:
         logger.error(f"Error in AYROHUB 2.0: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/test/stream', methods=['POST'])
+def test_stream():
+    """Test endpoint in streaming: ogni agente viene inviato appena risponde"""
+    data = request.json or {}
+    message = data.get("message", "Test AYROHUB AI 2.0 - Sistema coordinamento completo")
+    sse = wants_sse(request.headers.get("Accept"), request.args.get("format"))
+    try:
+        agents = requested_agents(data)
+    except AgentSelectionError as e:
+        return jsonify({"error": str(e), "available_agents": [agent.key for agent in select_agents()]}), 400
+    
+    logger.info(f"🎯 AYROHUB 2.0 streaming: {message[:50]}...")
+    
+    events = stream_test_events(message, use_response_cache(data, request.headers), sse, agents, use_pipeline(data),
+                                response_output(data, request.args.get("output")),
+                                start_conversation(data, request.headers, message))
+    return Response(stream_with_context(events),
+                    mimetype="text/event-stream" if sse else "application/x-ndjson",
+                    headers=STREAM_HEADERS)
+
 # ============================================================================
 # N8N INTEGRATION - AYROCTOPUS SUPPORT
 # ============================================================================
@@ -675,82 +5064,218 @@ def n8n_webhook():
         action = data.get('action', 'process')
         
         logger.info(f"📡 N8N Webhook received: {source} - {action}")
+        integration_last_seen["n8n"] = time.time()
         
-        # Processa based on source
-        if source == 'email':
-            # Email -> Task conversion
-            task_response = f"📧 Email processata e convertita in task: {content[:100]}..."
-            return jsonify({
-                "status": "success",
-                "action": "task_created",
-                "response": task_response,
-                "timestamp": datetime.now().isoformat()
-            })
+        # Processa based on source: email, file e telegram rispondono subito
+        direct = n8n_direct_payload(data)
+        if direct is not None:
+            return jsonify(direct)
             
-        elif source == 'file':
-            # File -> Knowledge base
-            kb_response = f"📄 File processato e aggiunto alla knowledge base: {content[:100]}..."
+        elif wants_async_job(data, request.headers):
+            # Generic processing in coda: risposta immediata, risultato via callback o /jobs/<id>
+            requested_agents(data)
+            job_data = dict(data, cache=use_response_cache(data, request.headers),
+                            session_id=conversation_session(data, request.headers))
+            job_id = job_queue.enqueue(job_data, data.get('callback_url'))
+            if job_id is None:
+                response = jsonify({
+                    "error": "Coda job piena, riprova più tardi",
+                    "queue_depth": job_queue.depth(),
+                    "timestamp": datetime.now().isoformat()
+                })
+                response.headers["Retry-After"] = "30"
+                return response, 503
             return jsonify({
-                "status": "success",
-                "action": "knowledge_updated",
-                "response": kb_response,
+                "status": "accepted",
+                "action": "team_queued",
+                "job_id": job_id,
+                "status_url": f"/jobs/{job_id}",
+                "queue_depth": job_queue.depth(),
                 "timestamp": datetime.now().isoformat()
-            })
-            
-        elif source == 'telegram':
-            # Telegram -> Control interface
-            control_response = f"🤖 Comando Telegram processato: {content[:100]}..."
-            return jsonify({
-                "status": "success",
-                "action": "control_executed",
-                "response": control_response,
-                "timestamp": datetime.now().isoformat()
-            })
+            }), 202
             
         else:
             # Generic processing
-            responses = process_agents_parallel(content)
-            return jsonify({
-                "status": "success",
-                "action": "team_processed",
-                "responses": {
-                    "lana": responses[0],
-                    "claude": responses[1],
-                    "gemini": responses[2],
-                    "picasso": responses[3]
-                },
-                "timestamp": datetime.now().isoformat()
-            })
+            agents = requested_agents(data)
+            timer = RequestTimer("/n8n-webhook", kind="webhook")
+            responses = process_agents_parallel(content, use_cache=use_response_cache(data, request.headers),
+                                                timer=timer, agents=agents, pipeline=use_pipeline(data),
+                                                conversation=start_conversation(data, request.headers, content))
+            return timed_json_response(timer, build_team_payload, responses, timer)
             
+    except AgentSelectionError as e:
+        return jsonify({"error": str(e), "available_agents": [agent.key for agent in select_agents()]}), 400
+    except (TaskError, JobError) as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error in n8n webhook: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/n8n-webhook/batch', methods=['POST'])
+def n8n_webhook_batch():
+    """Batch n8n: molti elementi {source, content, action} in una richiesta, risultati in streaming NDJSON"""
+    data = request.get_json(silent=True) or {}
+    sse = wants_sse(request.headers.get("Accept"), request.args.get("format"))
+    try:
+        prepared = batch_items(data)
+    except AgentSelectionError as e:
+        return jsonify({"error": str(e), "available_agents": [agent.key for agent in select_agents()]}), 400
+    except BatchError as e:
+        return jsonify({"error": str(e), "max_items": BATCH_MAX_ITEMS}), 400
+    
+    logger.info(f"📦 N8N batch received: {len(prepared)} elementi")
+    integration_last_seen["n8n"] = time.time()
+    
+    # Gli header servono ai thread del batch dopo la fine del contesto della richiesta
+    headers = {"Cache-Control": request.headers.get("Cache-Control", "")}
+    return Response(stream_with_context(batch_events(prepared, headers, sse)),
+                    mimetype="text/event-stream" if sse else "application/x-ndjson",
+                    headers=STREAM_HEADERS)
+
+@app.route('/images/<key>', methods=['GET'])
+def image_status(key):
+    """Stato di un'immagine PICASSO (segnaposto da interrogare finché non è ready)"""
+    state = image_store.state(key) if IMAGE_KEY_RE.fullmatch(key) else None
+    if state is None:
+        return jsonify({"error": "Immagine non trovata", "key": key}), 404
+    payload = {"key": key, "status": state["status"], "size": state["size"],
+               "updated": datetime.fromtimestamp(state["updated"]).isoformat()}
+    if state["status"] == "ready":
+        payload["image_url"] = image_url(key)
+    elif state["status"] == "failed":
+        payload["error"] = state.get("error")
+    else:
+        payload["retry_after_s"] = 2
+    return jsonify(payload)
+
+@app.route('/images/<key>.png', methods=['GET'])
+def image_file(key):
+    """Immagine PICASSO dallo store: content-addressed, quindi cacheabile per sempre"""
+    if not IMAGE_KEY_RE.fullmatch(key) or not image_store.ready(key):
+        return jsonify({"error": "Immagine non trovata", "key": key}), 404
+    response = send_file(image_store.path(key), mimetype="image/png", max_age=31536000, etag=key)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Stato e risultato di un job n8n asincrono"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job non trovato", "job_id": job_id}), 404
+    return json_response(job)
+
+@app.route('/conversations/<session_id>', methods=['GET', 'DELETE'])
+def conversation_turns(session_id):
+    """Ultimi turni di una sessione (?limit=N, massimo 100); DELETE cancella la memoria della sessione"""
+    if request.method == 'DELETE':
+        conversation_store.forget(session_id)
+        return jsonify({"status": "accepted", "session_id": session_id}), 202
+    limit = min(max(request.args.get("limit", CONVERSATION_RECALL_TURNS, type=int), 1), 100)
+    turns = conversation_store.recent(session_id, limit)
+    for turn in turns:
+        turn["created_at"] = datetime.fromtimestamp(turn["created_at"]).isoformat()
+        turn["replies"] = team_responses(turn["replies"])
+    return json_response({"session_id": session_id, "turns": turns})
+
+@app.route('/kb/documents', methods=['POST'])
+def kb_ingest():
+    """Aggiunge un documento al knowledge base
+
+    JSON {filename, content}, oppure il file come body (text/plain o binario
+    UTF-8, nome in ?name=): il body viene letto a blocchi, senza caricarlo in memoria.
+    """
+    try:
+        if request.is_json:
+            data = request.json or {}
+            name, blocks = data.get('filename') or 'documento.txt', iter_string_blocks(data.get('content', ''))
+        else:
+            name, blocks = request.args.get('name') or 'documento.txt', iter_stream_blocks(request.stream)
+        document = knowledge_base.ingest(name, blocks, request.args.get('source', 'api'))
+        return jsonify(document), 200 if document["duplicate"] else 201
+    except Exception as e:
+        logger.error(f"Error in knowledge base ingest: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/kb/documents/<int:document_id>', methods=['GET', 'DELETE'])
+def kb_document(document_id):
+    """Dettaglio o rimozione di un documento del knowledge base"""
+    if request.method == 'DELETE':
+        if not knowledge_base.delete(document_id):
+            return jsonify({"error": "Documento non trovato", "document_id": document_id}), 404
+        return jsonify({"status": "deleted", "document_id": document_id})
+    document = knowledge_base.document(document_id)
+    if document is None:
+        return jsonify({"error": "Documento non trovato", "document_id": document_id}), 404
+    return jsonify(document)
+
+@app.route('/kb/search', methods=['GET'])
+def kb_search():
+    """Chunk più rilevanti per ?q= (top ?k=, massimo 50)"""
+    query = request.args.get("q", "")
+    k = min(max(request.args.get("k", KB_TOP_K, type=int), 1), 50)
+    started = time.monotonic()
+    results = knowledge_base.search(query, k)
+    return json_response({
+        "query": query,
+        "results": results,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 2)
+    })
+
+@app.route('/emails', methods=['POST'])
+def emails_ingest():
+    """Email -> task: una email ({content, subject, from, message_id, date} o {raw}) o una casella ({"emails": [...]})
+
+    ?extract=rules evita le chiamate agli agenti (sincronizzazioni grandi).
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        summary = process_emails(email_payloads(data), request.args.get('source', 'api'),
+                                 request.args.get('extract') or (data.get('extract') if isinstance(data, dict) else None))
+        if summary["emails"] == 1 and summary["results"][0]["email_id"] is not None:
+            summary["tasks"] = task_store.email_tasks(summary["results"][0]["email_id"])
+        return json_response(summary, 201 if summary["created"] else 200)
+    except TaskError as e:
+        return jsonify({"error": str(e), "max_items": EMAIL_SYNC_MAX_ITEMS}), 400
+    except Exception as e:
+        logger.error(f"Error in email processing: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/tasks', methods=['GET'])
+def task_list():
+    """Task per ?status= (open, done), ?assignee=, ?due_before= / ?due_after= (AAAA-MM-GG), ?order= (due, recent)
+
+    Pagine di ?limit= task (massimo 200): il campo "next" va ripassato come ?cursor=.
+    """
+    try:
+        tasks, cursor = task_store.tasks(
+            status=request.args.get("status", "open"),
+            assignee=request.args.get("assignee"),
+            due_before=request.args.get("due_before"),
+            due_after=request.args.get("due_after"),
+            order=request.args.get("order"),
+            limit=min(max(request.args.get("limit", 50, type=int), 1), 200),
+            cursor=request.args.get("cursor"))
+    except TaskError as e:
+        return jsonify({"error": str(e)}), 400
+    return json_response({"tasks": tasks, "next": cursor})
+
+@app.route('/tasks/<int:task_id>', methods=['GET', 'PATCH'])
+def task_detail(task_id):
+    """Dettaglio di un task; PATCH {status, title, assignee, due} lo aggiorna"""
+    try:
+        task = task_store.update(task_id, request.get_json(silent=True) or {}) if request.method == 'PATCH' \
+            else task_store.get(task_id)
+    except TaskError as e:
+        return jsonify({"error": str(e)}), 400
+    if task is None:
+        return jsonify({"error": "Task non trovato", "task_id": task_id}), 404
+    return jsonify(task)
+
 @app.route('/ayroctopus-status', methods=['GET'])
 def ayroctopus_status():
-    """Status endpoint per AYROCTOPUS demo"""
-    return jsonify({
-        "service": "AYROCTOPUS",
-        "version": "v1.0-demo",
-        "status": "operational",
-        "components": {
-            "email_processor": "✅ Active",
-            "file_processor": "✅ Active", 
-            "telegram_bot": "✅ Active",
-            "knowledge_base": "✅ Active",
-            "task_manager": "✅ Active"
-        },
-        "integrations": {
-            "n8n": "✅ Connected",
-            "ayrohub": "✅ Connected"
-        },
-        "demo_endpoints": {
-            "email_simulation": "/demo/email",
-            "file_simulation": "/demo/file",
-            "telegram_simulation": "/demo/telegram"
-        },
-        "timestamp": datetime.now().isoformat()
-    })
+    """Status endpoint per AYROCTOPUS demo (snapshot aggiornato in background)"""
+    return health_snapshots.send("ayroctopus")
 
 # ============================================================================
 # DEMO ENDPOINTS AYROCTOPUS
@@ -758,24 +5283,33 @@ def ayroctopus_status():
 
 @app.route('/demo/email', methods=['POST'])
 def demo_email():
-    """Simula processing email per demo AYROCTOPUS"""
+    """Email -> task per demo AYROCTOPUS: l'email passa dalla pipeline reale e i task finiscono nello store"""
     try:
         data = request.json or {}
         email_content = data.get('content', 'Demo email per AYROCTOPUS')
         
-        # Simula elaborazione email
+        summary = process_emails([dict(data, content=email_content)], "demo")
+        result = summary["results"][0]
+        tasks = task_store.email_tasks(result["email_id"]) if result["email_id"] is not None else []
+        task_lines = "\n".join(
+            f"🎯 Task: {task['title']}\n"
+            f"⏰ Scadenza: {task['due'] or 'non indicata'}\n"
+            f"🤖 Assegnato a: {task['assignee'] or 'Team AYROHUB AI 2.0'}"
+            + (" (priorità alta)" if task["priority"] == "high" else "")
+            for task in tasks)
         task_created = f"📧 Email ricevuta e processata\n\n" \
                       f"📝 Contenuto: {email_content}\n" \
-                      f"🎯 Task generato: Analizza richiesta e prepara risposta\n" \
-                      f"⏰ Scadenza: Entro 24h\n" \
-                      f"🤖 Assegnato a: Team AYROHUB AI 2.0\n\n" \
-                      f"✅ Task creato automaticamente nel sistema"
+                      f"{task_lines}\n\n" + \
+                      (f"♻️ Email già processata: nessun nuovo task" if result["duplicate"] else
+                       f"✅ {len(tasks)} task creati automaticamente nel sistema")
         
         return jsonify({
             "status": "success",
             "demo": "email_to_task",
             "input": email_content,
             "output": task_created,
+            "tasks": tasks,
+            "duplicate": result["duplicate"],
             "timestamp": datetime.now().isoformat()
         })
         
@@ -784,19 +5318,22 @@ def demo_email():
 
 @app.route('/demo/file', methods=['POST'])
 def demo_file():
-    """Simula processing file per demo AYROCTOPUS"""
+    """Processing file per demo AYROCTOPUS: il file entra nel knowledge base"""
     try:
         data = request.json or {}
         file_name = data.get('filename', 'documento_demo.pdf')
         file_content = data.get('content', 'Contenuto demo per knowledge base')
         
-        # Simula elaborazione file
+        document = knowledge_base.ingest(file_name, iter_string_blocks(file_content), "demo")
+        frequent = Counter(SIGNIFICANT_WORD_RE.findall(file_content.casefold())).most_common(3)
+        tags = ", ".join(word for word, _ in frequent) or "-"
         kb_updated = f"📄 File processato e aggiunto alla Knowledge Base\n\n" \
                     f"📁 Nome file: {file_name}\n" \
                     f"📝 Contenuto estratto: {file_content[:200]}...\n" \
-                    f"🏷️ Tags automatici: [AYROMEX, AI, Business]\n" \
-                    f"🔍 Indicizzato per ricerca full-text\n" \
-                    f"🤖 Analizzato dal team AYROHUB AI 2.0\n\n" \
+                    f"🏷️ Tags automatici: [{tags}]\n" \
+                    f"🔍 Indicizzato per ricerca full-text: {document['chunks']} chunk " \
+                    f"(documento #{document['document_id']}{', già presente' if document['duplicate'] else ''})\n" \
+                    f"🤖 Disponibile per il team AYROHUB AI 2.0\n\n" \
                     f"✅ Knowledge base aggiornata automaticamente"
         
         return jsonify({
@@ -804,6 +5341,7 @@ def demo_file():
             "demo": "file_to_knowledge",
             "input": f"{file_name}: {file_content}",
             "output": kb_updated,
+            "document": document,
             "timestamp": datetime.now().isoformat()
         })
         
@@ -812,32 +5350,12 @@ def demo_file():
 
 @app.route('/demo/telegram', methods=['POST'])
 def demo_telegram():
-    """Simula controllo Telegram per demo AYROCTOPUS"""
+    """Controllo Telegram per demo AYROCTOPUS: /status, /tasks e /team con i dati reali"""
     try:
         data = request.json or {}
         command = data.get('command', '/status')
         
-        # Simula elaborazione comando
-        if command == '/status':
-            response = f"🤖 AYROCTOPUS Status Report\n\n" \
-                      f"📊 Sistema: ✅ Operativo\n" \
-                      f"📧 Email processate oggi: 12\n" \
-                      f"📄 File nella KB: 45\n" \
-                      f"🎯 Task attivi: 8\n" \
-                      f"⚡ Team AYROHUB: 4 agenti attivi\n\n" \
-                      f"🎯 Prossimi task: Demo completamento entro 48h"
-        elif command == '/help':
-            response = f"🤖 AYROCTOPUS Comandi Disponibili\n\n" \
-                      f"/status - Stato sistema\n" \
-                      f"/tasks - Lista task attivi\n" \
-                      f"/team - Status team AYROHUB\n" \
-                      f"/demo - Avvia demo completa\n\n" \
-                      f"💡 Controllo completo da Telegram"
-        else:
-            response = f"🤖 Comando '{command}' processato\n\n" \
-                      f"✅ Azione eseguita automaticamente\n" \
-                      f"📊 Risultato registrato nel sistema\n" \
-                      f"🔄 Feedback inviato al team"
+        response = telegram_command(command)
         
         return jsonify({
             "status": "success",
@@ -867,8 +5385,10 @@ def deploy_config():
                 "openai==0.28.0",
                 "anthropic==0.3.11",
                 "google-generativeai==0.3.0",
-                "requests==2.31.0"
+                "requests==2.31.0",
+                "gunicorn==21.2.0"
             ],
+            "start_command": "gunicorn",
             "environment_variables": [
                 "OPENAI_API_KEY",
                 "ANTHROPIC_API_KEY", 
@@ -878,8 +5398,16 @@ def deploy_config():
             "endpoints": {
                 "dashboard": "/",
                 "health": "/health",
+                "liveness": "/health/live",
+                "readiness": "/health/ready",
+                "metrics": "/metrics",
                 "team_test": "/test",
+                "team_test_stream": "/test/stream",
                 "n8n_webhook": "/n8n-webhook",
+                "n8n_webhook_batch": "/n8n-webhook/batch",
+                "job_status": "/jobs/<job_id>",
+                "image_status": "/images/<key>",
+                "image_file": "/images/<key>.png",
                 "ayroctopus_status": "/ayroctopus-status",
                 "demo_email": "/demo/email",
                 "demo_file": "/demo/file",
@@ -890,7 +5418,7 @@ def deploy_config():
             "1": "Clone repository",
             "2": "Set environment variables",
             "3": "pip install -r requirements.txt",
-            "4": "python app.py",
+            "4": "gunicorn (profilo gunicorn.conf.py; python app.py solo in sviluppo)",
             "5": "Access dashboard at localhost:5000"
         }
     })
@@ -904,8 +5432,14 @@ if __name__ == '__main__':
     logger.info("📍 Endpoints available:")
     logger.info("   - GET  / - Dashboard 2.0")
     logger.info("   - GET  /health - Health check 2.0")
+    logger.info("   - GET  /health/live, /health/ready - Liveness / readiness probes")
+    logger.info("   - GET  /metrics - Prometheus metrics")
     logger.info("   - POST /test - Team coordination 2.0")
+    logger.info("   - POST /test/stream - Team coordination 2.0 (streaming)")
     logger.info("   - POST /n8n-webhook - N8N integration")
+    logger.info("   - POST /n8n-webhook/batch - N8N batch (NDJSON streaming)")
+    logger.info("   - GET  /jobs/<job_id> - N8N async job status")
+    logger.info("   - GET  /images/<key>[.png] - PICASSO image status / file")
     logger.info("   - GET  /ayroctopus-status - AYROCTOPUS status")
     logger.info("   - POST /demo/email - Email demo")
     logger.info("   - POST /demo/file - File demo")
@@ -913,5 +5447,7 @@ if __name__ == '__main__':
     logger.info("🎨 PICASSO (DALL-E 3) integrated and ready")
     logger.info("🐙 AYROCTOPUS demo endpoints configured")
     
+    logger.info("🛠️ Server di sviluppo: in produzione avviare gunicorn (gunicorn.conf.py)")
+    
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
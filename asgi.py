@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+AYROHUB AI 2.0 - Modalità ASGI (asyncio-native)
+Stesse route di app.py: /test, /test/stream e /n8n-webhook (sorgenti generiche)
+eseguono gli agenti come coroutine su un unico event loop, così un solo processo
+regge centinaia di briefing in volo. /health, /health/live, /health/ready e
+/ayroctopus-status rispondono dallo snapshot in memoria direttamente sul loop.
+Tutte le altre route (/, /demo/*, ...) sono servite dall'app Flask su un thread,
+senza bloccare il loop.
+
+Richiede un server ASGI (non incluso in requirements.txt):
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+    GUNICORN_WORKER_CLASS=async gunicorn      # con il profilo gunicorn.conf.py
+"""
+
+import json
+import time
+import asyncio
+import threading
+from urllib.parse import parse_qs
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from app import (app as flask_app, logger, process_agents_async, use_response_cache, wants_async_job,
+                 build_test_payload, build_team_payload, wants_sse, astream_test_events, STREAM_HEADERS,
+                 metrics, observe_http, RequestTimer, requested_agents, select_agents, AgentSelectionError,
+                 use_pipeline, encode_json, response_output, start_conversation, N8N_DIRECT_SOURCES,
+                 health_snapshots, integration_last_seen, stream_event)
+
+# Route health servite dallo snapshot precalcolato (nome dello snapshot)
+HEALTH_ROUTES = {
+    "/health": "health",
+    "/health/live": "live",
+    "/health/ready": "ready",
+    "/ayroctopus-status": "ayroctopus",
+}
+
+
+async def read_body(receive):
+    """Legge l'intero body della richiesta"""
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def send_response(send, status, headers, body):
+    """Invia una risposta completa"""
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, payload, status=200, timer=None, accept_encoding=None):
+    """Invia una risposta JSON, codificata e compressa come json_response"""
+    started = time.monotonic()
+    body, encoding, compressible = encode_json(payload, accept_encoding)
+    if timer is not None:
+        timer.add("serialization", time.monotonic() - started)
+        timer.finish()
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+    ]
+    if encoding:
+        headers.append((b"content-encoding", encoding.encode()))
+    if compressible:
+        headers.append((b"vary", b"Accept-Encoding"))
+    await send_response(send, status, headers, body)
+
+
+async def send_health(scope, send):
+    """Snapshot health già serializzato: nessun thread, nessun accesso agli store"""
+    started = time.monotonic()
+    accept_encoding = next((v.decode("latin-1") for k, v in scope["headers"] if k == b"accept-encoding"), None)
+    body, encoding, status = health_snapshots.get(HEALTH_ROUTES[scope["path"]], accept_encoding)
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+        (b"vary", b"Accept-Encoding"),
+        (b"cache-control", b"no-store"),
+    ]
+    if encoding:
+        headers.append((b"content-encoding", encoding.encode()))
+    await send_response(send, status, headers, body)
+    observe_http(scope["path"], "GET", status, time.monotonic() - started)
+
+
+async def dispatch_flask(scope, body, send):
+    """Inoltra la richiesta all'app Flask (WSGI) su un thread
+
+    Il body della risposta arriva al loop un chunk alla volta: le route in
+    streaming (/n8n-webhook/batch) mandano ogni risultato appena pronto. Se il
+    client si disconnette il thread smette di iterare e chiude la risposta.
+    """
+    builder = EnvironBuilder(
+        path=scope.get("root_path", "") + scope["path"],
+        method=scope["method"],
+        query_string=scope.get("query_string", b"").decode("latin-1"),
+        headers=[(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]],
+        data=body,
+    )
+    environ = builder.get_environ()
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    stopped = threading.Event()
+
+    def run():
+        # Risposta e iterazione nello stesso thread: il contesto della richiesta Flask resta valido
+        put = lambda item: loop.call_soon_threadsafe(chunks.put_nowait, item)  # noqa: E731
+        try:
+            app_iter, status, headers = run_wsgi_app(flask_app.wsgi_app, environ)
+            put((status, headers))
+            try:
+                for chunk in app_iter:
+                    if stopped.is_set():
+                        break
+                    if chunk:
+                        put(chunk)
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)
+
+    worker = asyncio.ensure_future(asyncio.to_thread(run))
+    started = False
+    try:
+        while True:
+            item = await chunks.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                if not started:
+                    raise item
+                logger.error(f"Error in AYROHUB 2.0 (ASGI stream): {item}")
+                break
+            if isinstance(item, tuple):
+                status, headers = item
+                await send({"type": "http.response.start", "status": int(status.split(" ", 1)[0]),
+                            "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]})
+                started = True
+            else:
+                await send({"type": "http.response.body", "body": item, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+        await worker
+    finally:
+        # Client disconnesso o errore: il thread si ferma al prossimo chunk
+        stopped.set()
+
+
+def parse_json(body):
+    """Equivalente di `request.json or {}`"""
+    try:
+        return (json.loads(body) or {}) if body else {}
+    except ValueError:
+        return {}
+
+
+def request_headers(scope):
+    """Header della richiesta come dict (nomi come in Flask)"""
+    return {k.decode("latin-1").title(): v.decode("latin-1") for k, v in scope["headers"]}
+
+
+def query_param(scope, name):
+    """Primo valore di un parametro della query string, None se assente"""
+    return parse_qs(scope.get("query_string", b"").decode("latin-1")).get(name, [None])[0]
+
+
+async def handle_test(scope, data, send):
+    """/test - team completo su event loop"""
+    headers = request_headers(scope)
+    message = data.get("message", "Test AYROHUB AI 2.0 - Sistema coordinamento completo")
+    agents = requested_agents(data)
+    timer = RequestTimer("/test")
+    responses = await process_agents_async(message, use_cache=use_response_cache(data, headers),
+                                           timer=timer, agents=agents, pipeline=use_pipeline(data),
+                                           conversation=start_conversation(data, headers, message))
+    with timer.phase("formatting"):
+        payload = build_test_payload(message, responses, timer, response_output(data, query_param(scope, "output")))
+    await send_json(send, payload, timer=timer, accept_encoding=headers.get("Accept-Encoding"))
+
+
+async def handle_test_stream(scope, data, send):
+    """/test/stream - un chunk per agente appena pronto"""
+    headers = request_headers(scope)
+    sse = wants_sse(headers.get("Accept"), query_param(scope, "format"))
+    message = data.get("message", "Test AYROHUB AI 2.0 - Sistema coordinamento completo")
+    agents = requested_agents(data)
+
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream" if sse else b"application/x-ndjson"),
+    ] + [(k.lower().encode(), v.encode()) for k, v in STREAM_HEADERS.items()]})
+    try:
+        async for event in astream_test_events(message, use_response_cache(data, headers), sse, agents,
+                                               use_pipeline(data), response_output(data, query_param(scope, "output")),
+                                               start_conversation(data, headers, message)):
+            await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+    except Exception as e:
+        # Header già inviati: l'errore chiude lo stream come ultimo evento
+        await send({"type": "http.response.body", "body": stream_event("error", {"error": str(e)}, sse).encode("utf-8")})
+        raise
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def handle_team(scope, data, send):
+    """/n8n-webhook - sorgenti generiche su event loop"""
+    logger.info(f"📡 N8N Webhook received: {data.get('source', 'unknown')} - {data.get('action', 'process')}")
+    integration_last_seen["n8n"] = time.time()
+    headers = request_headers(scope)
+    agents = requested_agents(data)
+    timer = RequestTimer("/n8n-webhook", kind="webhook")
+    content = data.get('content', '')
+    responses = await process_agents_async(content, use_cache=use_response_cache(data, headers),
+                                           timer=timer, agents=agents, pipeline=use_pipeline(data),
+                                           conversation=start_conversation(data, headers, content))
+    with timer.phase("formatting"):
+        payload = build_team_payload(responses, timer)
+    await send_json(send, payload, timer=timer, accept_encoding=headers.get("Accept-Encoding"))
+
+
+async def lifespan(receive, send):
+    """Gestione startup/shutdown del server ASGI"""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            logger.info("🚀 AYROHUB AI 2.0 - modalità ASGI attiva")
+            # Primo snapshot health fuori dal loop: le probe successive trovano i byte pronti
+            await asyncio.to_thread(health_snapshots.get, "live")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """Entry point ASGI"""
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    body = await read_body(receive)
+    path, method = scope["path"], scope["method"]
+    if method == "GET" and path in HEALTH_ROUTES:
+        return await send_health(scope, send)
+
+    handler = None
+    if method == "POST" and path == "/test":
+        handler = handle_test
+    elif method == "POST" and path == "/test/stream":
+        handler = handle_test_stream
+    elif method == "POST" and path == "/n8n-webhook":
+        # Sorgenti dirette (email, file, telegram) e job asincroni passano dalla view Flask
+        data = parse_json(body)
+        if data.get('source', 'unknown') not in N8N_DIRECT_SOURCES and not wants_async_job(data, request_headers(scope)):
+            handler = handle_team
+    response_started = False
+
+    async def tracked_send(message):
+        nonlocal response_started
+        if message["type"] == "http.response.start":
+            response_started = True
+        await send(message)
+
+    if handler is None:
+        # Le route Flask registrano le proprie metriche HTTP
+        try:
+            return await dispatch_flask(scope, body, tracked_send)
+        except Exception as e:
+            logger.error(f"Error in AYROHUB 2.0 (ASGI): {e}")
+            if not response_started:
+                await send_json(send, {"error": str(e)}, status=500)
+            return
+
+    labels = (("route", path),)
+    metrics.gauge("ayrohub_http_requests_in_flight", labels, 1)
+    started, status = time.monotonic(), 200
+    try:
+        await handler(scope, parse_json(body), tracked_send)
+    except AgentSelectionError as e:
+        status = 400
+        await send_json(send, {"error": str(e), "available_agents": [agent.key for agent in select_agents()]},
+                        status=status)
+    except Exception as e:
+        logger.error(f"Error in AYROHUB 2.0 (ASGI): {e}")
+        status = 500
+        # Con gli header già inviati (stream) la risposta è stata chiusa dall'handler
+        if not response_started:
+            await send_json(send, {"error": str(e)}, status=status)
+    finally:
+        metrics.gauge("ayrohub_http_requests_in_flight", labels, -1)
+        observe_http(path, method, status, time.monotonic() - started)
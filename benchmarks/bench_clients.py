@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Benchmark client provider: client per chiamata vs registry condiviso (ProviderClients)
+Contro lo stub HTTPS locale conta le connessioni aperte e la latenza media per chiamata.
+
+    python benchmarks/bench_clients.py --calls 40 --concurrency 4
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_providers import start_stub, provider_env  # noqa: E402
+
+
+def stub_connections(port, context):
+    with urllib.request.urlopen(f"https://127.0.0.1:{port}/_stats", context=context) as response:
+        return json.load(response)["connections"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    server, _ = start_stub(tls=True, latency=args.latency, image_latency=args.latency)
+    os.environ.update(provider_env(server.server_port, server.cert_file))
+    os.environ["PROBE_INTERVAL"] = "3600"
+
+    import ssl
+    import openai
+    import anthropic
+    import app
+
+    context = ssl.create_default_context(cafile=server.cert_file)
+    time.sleep(1)  # lascia terminare i probe di startup
+
+    claude, lana = app.AGENT_REGISTRY["CLAUDE"], app.AGENT_REGISTRY["LANA"]
+
+    def claude_per_call(message):
+        # Comportamento precedente: un client (e un pool) nuovo a ogni richiesta
+        client = anthropic.Anthropic(api_key=app.ANTHROPIC_API_KEY, base_url=app.ANTHROPIC_BASE_URL)
+        return client.messages.create(model=claude.model, max_tokens=claude.max_tokens,
+                                      messages=claude.messages(message)).content[0].text
+
+    def lana_thread_local(message):
+        # Comportamento precedente: sessione requests privata per ogni thread (default openai 0.28)
+        return openai.ChatCompletion.create(model=lana.model, max_tokens=lana.max_tokens,
+                                            messages=lana.messages(message)).choices[0].message.content
+
+    scenarios = [
+        ("claude", "per-call", claude_per_call, None),
+        ("claude", "pooled", claude.run, None),
+        ("lana", "thread-local", lana_thread_local, None),
+        ("lana", "pooled", lana.run, app.provider_clients.openai_session),
+    ]
+
+    for agent, label, call, requestssession in scenarios:
+        openai.requestssession = requestssession
+        before = stub_connections(server.server_port, context)
+        # Pool di thread nuovo per scenario: nessuna sessione thread-local ereditata
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            def timed(i):
+                start = time.perf_counter()
+                call(f"briefing {i}")
+                return time.perf_counter() - start
+            samples = list(pool.map(timed, range(args.calls)))
+        opened = stub_connections(server.server_port, context) - before - 1
+        print(f"{agent:<7} {label:<13} connections={opened:<4} "
+              f"avg={sum(samples) / len(samples) * 1000:.1f}ms per call ({args.calls} calls)")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark memoria conversazioni: scrittura a blocchi e recall con 100k+ turni salvati
+Accoda i turni come le richieste (append non bloccante), misura il throughput del writer,
+poi la latenza del recall di una sessione (lettura dall'indice più selezione entro il budget).
+
+    python benchmarks/bench_conversations.py [--turns 100000 --sessions 2000 --lookups 2000]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+# Nessuna API key: l'import di app.py non contatta i provider
+for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "GOOGLE_API_KEY"):
+    os.environ.pop(key, None)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+WORDS = "AYROMEX lancio budget campagna social naming visual strategia team marzo canali copy".split()
+
+
+def text(words):
+    return " ".join(random.choice(WORDS) for _ in range(words))
+
+
+def percentile(samples, pct):
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=100000)
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--lookups", type=int, default=2000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    path = os.path.join(tempfile.mkdtemp(prefix="ayrohub-bench-"), "conversations.sqlite3")
+    store = app.ConversationStore(path, app.CONVERSATION_RECALL_TURNS)
+    replies = {name: text(120) for name in ("LANA", "CLAUDE", "GEMINI")}
+
+    start = time.perf_counter()
+    append_s = 0.0
+    for i in range(args.turns):
+        queued = time.perf_counter()
+        store.append(f"session-{i % args.sessions}", text(40), replies)
+        append_s += time.perf_counter() - queued
+    store.flush(timeout=600)
+    elapsed = time.perf_counter() - start
+    print(f"write   {args.turns} turns in {elapsed:.2f}s ({args.turns / elapsed:.0f} turns/s), "
+          f"append {append_s / args.turns * 1e6:.1f}us per turn on the request path")
+
+    claude = app.AGENT_REGISTRY["CLAUDE"]
+    reads, recalls = [], []
+    for _ in range(args.lookups):
+        session = f"session-{random.randrange(args.sessions)}"
+        conversation = app.Conversation(store, session, text(20))
+        started = time.perf_counter()
+        conversation.turns()
+        read = time.perf_counter()
+        conversation.with_context(claude, conversation.message)
+        reads.append(read - started)
+        recalls.append(time.perf_counter() - started)
+    reads.sort()
+    recalls.sort()
+    print(f"read    p50={percentile(reads, 50) * 1000:.3f}ms p99={percentile(reads, 99) * 1000:.3f}ms "
+          f"({args.turns // args.sessions} turns per session, last {app.CONVERSATION_RECALL_TURNS})")
+    print(f"recall  p50={percentile(recalls, 50) * 1000:.3f}ms p99={percentile(recalls, 99) * 1000:.3f}ms "
+          f"(read + selection within {app.CONVERSATION_CONTEXT_TOKENS} tokens)")
+    print(f"db      {os.path.getsize(path) / 1024 / 1024:.1f}MB {path}")
+
+
+if __name__ == "__main__":
+    main()
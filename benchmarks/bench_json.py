@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark serializzazione risposte /test: tempo di encode per dimensione della risposta
+Confronta jsonify (Flask), json della stdlib e orjson (se installato) sul payload completo
+e con output="responses" / "formatted", più il costo e il guadagno della compressione gzip.
+
+    python benchmarks/bench_json.py [--rounds 2000]
+"""
+
+import os
+import sys
+import gzip
+import random
+import timeit
+import argparse
+
+# Nessuna API key: l'import di app.py non contatta i provider
+for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "GOOGLE_API_KEY"):
+    os.environ.pop(key, None)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+# Caratteri per risposta agente: ~60, ~250 e ~1000 token (max_tokens degli agenti)
+SIZES = (250, 1000, 4000)
+WORDS = "AYROMEX strategia è execution più copy visual team briefing — già perché".split()
+
+
+def agent_text(size):
+    out = []
+    while sum(len(word) + 1 for word in out) < size:
+        out.append(random.choice(WORDS))
+    return " ".join(out)
+
+
+def encoders():
+    found = {
+        "jsonify": lambda payload: app.jsonify(payload).get_data(),
+        "json": app.build_json_encoder("std")[1],
+    }
+    try:
+        import orjson
+        found["orjson"] = orjson.dumps
+    except ImportError:
+        pass
+    return found
+
+
+def per_call_us(func, rounds):
+    return min(timeit.repeat(func, number=rounds, repeat=3)) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    available = encoders()
+    print(f"encoder attivo in app.py: {app.json_encoder_name}  gzip level {app.RESPONSE_COMPRESS_LEVEL}")
+    print(f"{'size':>6} {'output':<10} {'bytes':>7} " + " ".join(f"{name + ' us':>11}" for name in available)
+          + f" {'gzip us':>9} {'gzip bytes':>10}")
+
+    with app.app.test_request_context():
+        for size in SIZES:
+            responses = app.OrderedDict((agent.name, agent_text(size)) for agent in app.select_agents())
+            for output in ("full", "responses", "formatted"):
+                payload = app.build_test_payload("briefing benchmark", responses, output=output)
+                body = app.dumps_json(payload)
+                timings = [per_call_us(lambda: encode(payload), args.rounds) for encode in available.values()]
+                gzip_us = per_call_us(lambda: gzip.compress(body, app.RESPONSE_COMPRESS_LEVEL), args.rounds // 10 or 1)
+                compressed = len(gzip.compress(body, app.RESPONSE_COMPRESS_LEVEL))
+                print(f"{size:>6} {output:<10} {len(body):>7} " + " ".join(f"{us:>11.1f}" for us in timings)
+                      + f" {gzip_us:>9.1f} {compressed:>10}")
+
+
+if __name__ == "__main__":
+    main()
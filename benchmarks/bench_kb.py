@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Benchmark knowledge base: throughput di ingest e latenza delle query con 100k chunk
+I documenti sono generati a blocchi (vocabolario con distribuzione di Zipf, come un testo reale)
+e passano da KnowledgeBase.ingest come uno stream: il picco di memoria non dipende dalla
+dimensione del documento. Poi misura top-k su query brevi (parole chiave) e su briefing lunghi.
+
+    python benchmarks/bench_kb.py [--chunks 100000 --docs 100 --vectors hash --queries 1000]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import tempfile
+
+# Nessuna API key: l'import di app.py non contatta i provider
+for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "GOOGLE_API_KEY"):
+    os.environ.pop(key, None)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+SYLLABLES = "ra ve lo ma ti co sa pe ri no ta mi gu be fo la se di".split()
+
+
+def vocabulary(size):
+    random.seed(0)
+    words = set()
+    while len(words) < size:
+        words.add("".join(random.choice(SYLLABLES) for _ in range(random.randint(2, 4))))
+    # Rango di Zipf casuale: le parole frequenti non sono contigue nell'ordine alfabetico del vocabolario
+    words = sorted(words)
+    random.shuffle(words)
+    weights = [1 / (rank + 1) for rank in range(size)]
+    return words, weights
+
+
+def document_blocks(words, weights, chars, block_words=2000):
+    """Testo del documento a blocchi: frasi da 8-20 parole, un paragrafo ogni 6 frasi"""
+    produced = 0
+    sentence = 0
+    while produced < chars:
+        parts = []
+        for word in random.choices(words, weights, k=block_words):
+            parts.append(word)
+            if random.random() < 1 / 14:
+                sentence += 1
+                parts[-1] += ".\n\n" if sentence % 6 == 0 else "."
+        block = " ".join(parts) + " "
+        produced += len(block)
+        yield block
+
+
+def percentile(samples, pct):
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+def timed_queries(kb, queries, k):
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        kb.search(query, k)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return percentile(samples, 50) * 1000, percentile(samples, 99) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=100000, help="chunk totali (circa)")
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--vectors", choices=("off", "hash"), default="off")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=app.KB_TOP_K)
+    args = parser.parse_args()
+
+    words, weights = vocabulary(args.vocabulary)
+    path = os.path.join(tempfile.mkdtemp(prefix="ayrohub-bench-"), "kb.sqlite3")
+    vectors = app.VectorIndex(args.vectors, app.KB_VECTOR_DIM) if args.vectors != "off" else None
+    kb = app.KnowledgeBase(path, app.KB_CHUNK_CHARS, app.KB_CHUNK_OVERLAP, vectors)
+    # Passo effettivo tra un chunk e il successivo (la sovrapposizione si ripete)
+    step = app.KB_CHUNK_CHARS * 0.85 - min(app.KB_CHUNK_OVERLAP, app.KB_CHUNK_CHARS // 4)
+    doc_chars = int(args.chunks / args.docs * step)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    chunks = chars = 0
+    for index in range(args.docs):
+        document = kb.ingest(f"doc-{index}.txt", document_blocks(words, weights, doc_chars))
+        chunks += document["chunks"]
+        chars += document["chars"]
+    elapsed = time.perf_counter() - started
+    rss_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+    print(f"ingest  {chunks} chunks, {chars / 1e6:.0f}MB text in {elapsed:.1f}s: {chunks / elapsed:.0f} chunks/s, "
+          f"{chars / 1e6 / elapsed:.1f}MB/s (vectors={args.vectors}); "
+          f"peak RSS +{rss_growth:.0f}MB for {doc_chars / 1e6:.1f}MB documents")
+
+    random.seed(1)
+    keywords = [" ".join(random.choices(words, weights, k=random.randint(2, 4))) for _ in range(args.queries)]
+    rare = [" ".join(random.sample(words[1000:], 3)) for _ in range(args.queries)]
+    # Briefing lungo: testo comune più qualche termine specifico (nomi, prodotti)
+    briefings = [" ".join(random.choices(words, weights, k=300) + random.sample(words[1000:], 3))
+                 for _ in range(args.queries // 4 or 1)]
+    # Prima ricerca: carica l'indice vettoriale (una volta per worker)
+    started = time.perf_counter()
+    kb.search(keywords[0], args.k)
+    print(f"warmup  first search {(time.perf_counter() - started) * 1000:.1f}ms"
+          + (f" (loads {vectors.stats()['bytes'] / 1e6:.0f}MB of vectors)" if vectors else ""))
+    for label, queries in (("keyword", keywords), ("rare", rare), ("briefing", briefings)):
+        p50, p99 = timed_queries(kb, queries, args.k)
+        print(f"query   {label:<8} top-{args.k} p50={p50:.2f}ms p99={p99:.2f}ms ({len(queries)} queries)")
+    print(f"db      {os.path.getsize(path) / 1e6:.0f}MB {path}")
+
+
+if __name__ == "__main__":
+    main()
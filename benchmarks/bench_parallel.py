@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Benchmark fan-out multi-agente: sequenziale vs process_agents_parallel
+Usa agenti stub con latenza fissa, nessuna chiamata ai provider reali.
+
+    python benchmarks/bench_parallel.py [--rounds 5]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+# Nessuna API key: l'import di app.py non contatta i provider
+for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "GOOGLE_API_KEY"):
+    os.environ.pop(key, None)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+# Latenze tipiche osservate (secondi), scalate per tenere il benchmark breve
+STUB_DELAYS = {"LANA": 0.40, "CLAUDE": 0.50, "GEMINI": 0.30, "PICASSO": 1.20}
+
+
+def make_stub(delay):
+    def stub(agent, message):
+        time.sleep(delay)
+        return f"{agent.name}: {message}"
+    return stub
+
+
+def run_sequential(message):
+    return [agent.run(message) for agent in app.select_agents()]
+
+
+def run_parallel(message):
+    return list(app.process_agents_parallel(message).values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    # Stessi agenti del registry, con la chiamata al provider sostituita dallo stub
+    for agent in app.select_agents():
+        agent.call = make_stub(STUB_DELAYS[agent.name])
+    app.provider_active.update(dict.fromkeys(app.provider_active, True))
+
+    timings = {}
+    for label, runner in (("sequential", run_sequential), ("parallel", run_parallel)):
+        samples = []
+        for i in range(args.rounds):
+            start = time.perf_counter()
+            results = runner(f"briefing {i}")
+            samples.append(time.perf_counter() - start)
+            assert [r.split(":")[0] for r in results] == list(STUB_DELAYS), results
+        timings[label] = sum(samples) / len(samples)
+        print(f"{label:<11} avg {timings[label]:.3f}s over {args.rounds} rounds")
+
+    print(f"speedup     {timings['sequential'] / timings['parallel']:.2f}x "
+          f"(sum of delays {sum(STUB_DELAYS.values()):.2f}s, slowest {max(STUB_DELAYS.values()):.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Benchmark startup: tempo import-to-first-request con STARTUP_MODE eager vs lazy
+Ogni misura è un processo nuovo che importa app.py e serve GET /health,
+con i provider stub a latenza fissa al posto delle API reali.
+
+    python benchmarks/bench_startup.py --rounds 3 --latency 0.5
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_providers import start_stub, provider_env  # noqa: E402
+
+MEASURE = """
+import time, json
+start = time.perf_counter()
+import app
+status = app.app.test_client().get('/health').status_code
+print(json.dumps({"status": status, "seconds": time.perf_counter() - start}))
+"""
+
+
+def measure(mode, stub_port):
+    env = dict(os.environ, **provider_env(stub_port), STARTUP_MODE=mode)
+    out = subprocess.run([sys.executable, "-c", MEASURE], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    assert result["status"] == 200, result
+    return result["seconds"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    server, _ = start_stub(latency=args.latency)
+    timings = {}
+    for mode in ("eager", "lazy"):
+        samples = [measure(mode, server.server_port) for _ in range(args.rounds)]
+        timings[mode] = sum(samples) / len(samples)
+        print(f"{mode:<6} import-to-first-request avg {timings[mode]:.3f}s "
+              f"(min {min(samples):.3f}s, {args.rounds} rounds, provider latency {args.latency}s)")
+    print(f"saved  {timings['eager'] - timings['lazy']:.3f}s per worker boot")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
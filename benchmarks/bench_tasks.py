@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Benchmark email -> task: sincronizzazione di una casella e query sui task con 100k+ email salvate
+Le email passano da process_emails a lotti (estrazione con le regole locali, nessun provider),
+come una sincronizzazione n8n; poi misura le liste di task più usate (aperti, per scadenza,
+per assegnatario) sulla prima pagina e dopo qualche pagina di cursore, e i comandi Telegram
+/status (solo contatori) e /tasks.
+
+    python benchmarks/bench_tasks.py [--emails 100000 --batch 1000 --queries 1000]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import date, timedelta
+
+# Nessuna API key: l'import di app.py non contatta i provider
+for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "GOOGLE_API_KEY"):
+    os.environ.pop(key, None)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+PEOPLE = "marco giulia luca sara paolo elena davide chiara".split()
+ACTIONS = ["Puoi preparare il report {n}", "Invia il preventivo {n}", "Verifica il contratto {n}",
+           "Aggiorna il listino {n}", "Organizza la call {n}"]
+
+
+def mailbox(count, start):
+    """Email con 1-3 richieste ciascuna, scadenze entro 60 giorni e assegnatari"""
+    for index in range(count):
+        n = start + index
+        lines = []
+        for _ in range(random.randint(1, 3)):
+            due = date(2026, 10, 1) + timedelta(days=random.randrange(60))
+            lines.append(f"{random.choice(ACTIONS).format(n=n)} entro il {due:%d/%m/%Y} @{random.choice(PEOPLE)}.")
+        yield {"message_id": f"<{n}@bench>", "subject": f"Richiesta {n}", "from": "cliente@example.com",
+               "content": "Ciao,\n\n" + "\n".join(lines) + "\n\nGrazie", "date": "2026-10-01T09:00:00"}
+
+
+def percentile(samples, pct):
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+def timed(queries, run):
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        run(query)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return percentile(samples, 50) * 1000, percentile(samples, 99) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=1000, help="email per richiesta di sincronizzazione")
+    parser.add_argument("--single", type=int, default=2000, help="email inviate una per richiesta (confronto)")
+    parser.add_argument("--queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    app.task_store = app.TaskStore(os.path.join(tempfile.mkdtemp(prefix="ayrohub-bench-"), "tasks.sqlite3"))
+    path = app.task_store.path
+
+    started = time.perf_counter()
+    tasks = 0
+    for start in range(0, args.emails, args.batch):
+        summary = app.process_emails(list(mailbox(min(args.batch, args.emails - start), start)), "bench", "rules")
+        tasks += summary["tasks_created"]
+    elapsed = time.perf_counter() - started
+    print(f"sync    {args.emails} emails ({tasks} tasks) in batches of {args.batch}: {elapsed:.1f}s, "
+          f"{args.emails / elapsed:.0f} emails/s")
+
+    started = time.perf_counter()
+    for payload in mailbox(args.single, args.emails):
+        app.process_emails([payload], "bench", "rules")
+    elapsed = time.perf_counter() - started
+    print(f"single  {args.single} emails one per request: {args.single / elapsed:.0f} emails/s")
+
+    started = time.perf_counter()
+    summary = app.process_emails(list(mailbox(args.batch, 0)), "bench", "rules")
+    print(f"resync  {args.batch} already-seen emails: {(time.perf_counter() - started) * 1000:.1f}ms, "
+          f"{summary['duplicates']} duplicates, {summary['tasks_created']} tasks")
+
+    store = app.task_store
+    days = [(date(2026, 10, 1) + timedelta(days=random.randrange(55))).isoformat() for _ in range(args.queries)]
+    people = [random.choice(PEOPLE) for _ in range(args.queries)]
+    deep = store.tasks(limit=200)[1]
+    for _ in range(9):
+        deep = store.tasks(limit=200, cursor=deep)[1]
+    cases = (
+        ("open", [None] * args.queries, lambda _: store.tasks(limit=50)),
+        ("open+10p", [None] * args.queries, lambda _: store.tasks(limit=50, cursor=deep)),
+        ("due-week", days, lambda day: store.tasks(due_after=day, due_before=(date.fromisoformat(day)
+                                                                             + timedelta(days=7)).isoformat())),
+        ("assignee", people, lambda person: store.tasks(assignee=person, limit=50)),
+        ("assignee-due", people, lambda person: store.tasks(assignee=person, order="due", limit=50)),
+        ("/status", [None] * args.queries, lambda _: app.telegram_status()),
+        ("/tasks", people, lambda person: app.telegram_tasks(person)),
+    )
+    for label, queries, run in cases:
+        p50, p99 = timed(queries, run)
+        print(f"query   {label:<12} p50={p50:.2f}ms p99={p99:.2f}ms")
+    print(f"db      {os.path.getsize(path) / 1e6:.0f}MB {path} ({store.stats()['open_tasks']} open tasks)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness offline: l'app contro i provider stub, a RPS costante
+Per ogni scenario (/test, /n8n-webhook, /n8n-webhook/batch, /demo/*) invia richieste a ritmo fisso
+(open loop: la latenza parte dall'istante programmato, quindi include anche
+l'attesa lato client quando il server non regge), poi riporta throughput,
+p50/p95/p99 e CPU/memoria di ogni worker. Il JSON è confrontabile tra versioni.
+
+    python benchmarks/harness.py --rps 20 --duration 15 --json results.json
+    python benchmarks/harness.py --mode asgi --error-rate 0.05 --compare results.json
+    python benchmarks/harness.py --mode profile --scenarios test --rps 15 --compare dev.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import ROOT, SERVER_COMMANDS, percentile, request, start_server, stop_server  # noqa: E402
+
+BATCH_SIZE = 10
+
+SCENARIOS = {
+    "test": ("/test", lambda i: {"message": f"harness briefing {i}"}),
+    "n8n": ("/n8n-webhook", lambda i: {"source": "harness", "action": "process", "content": f"harness content {i}"}),
+    "demo_email": ("/demo/email", lambda i: {"content": f"Email harness {i}: preparare la proposta entro venerdì"}),
+    "demo_file": ("/demo/file", lambda i: {"filename": f"doc-{i}.pdf", "content": f"Contenuto harness {i}"}),
+    "demo_telegram": ("/demo/telegram", lambda i: {"command": "/status"}),
+    # Un batch da BATCH_SIZE elementi per richiesta: confrontare con n8n a RPS * BATCH_SIZE
+    "n8n_batch": ("/n8n-webhook/batch", lambda i: {"items": [
+        {"source": "harness", "action": "process", "content": f"harness batch {i} item {j}"} for j in range(BATCH_SIZE)
+    ]}),
+}
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def proc_stat(pid):
+    """(ppid, secondi CPU, RSS in byte) da /proc, None se il processo non c'è più"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Il nome del processo può contenere spazi: i campi partono dopo l'ultima ')'
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return int(fields[1]), (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, int(fields[21]) * PAGE_SIZE
+
+
+def worker_pids(server_pid):
+    """Worker del server: i figli del master (gunicorn, uvicorn --workers) o il processo stesso"""
+    children = []
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            stat = proc_stat(int(name))
+            if stat and stat[0] == server_pid:
+                children.append(int(name))
+    return sorted(children) or [server_pid]
+
+
+class ResourceSampler:
+    """Campiona CPU e RSS dei worker durante uno scenario"""
+
+    def __init__(self, server_pid, interval=0.25):
+        self.server_pid = server_pid
+        self.interval = interval
+        self.workers = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        for pid in worker_pids(self.server_pid):
+            stat = proc_stat(pid)
+            if stat is None:
+                continue
+            _, cpu, rss = stat
+            worker = self.workers.setdefault(pid, {"cpu_start": cpu, "cpu_end": cpu, "rss_peak": rss})
+            worker["cpu_end"] = cpu
+            worker["rss_peak"] = max(worker["rss_peak"], rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._start = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        self.wall = time.perf_counter() - self._start
+
+    def report(self):
+        return [{
+            "pid": pid,
+            "cpu_s": round(worker["cpu_end"] - worker["cpu_start"], 3),
+            "cpu_pct": round((worker["cpu_end"] - worker["cpu_start"]) / self.wall * 100, 1),
+            "rss_peak_mb": round(worker["rss_peak"] / 1024 / 1024, 1),
+        } for pid, worker in sorted(self.workers.items())]
+
+
+def run_rate(port, path, payload, rps, duration, max_in_flight, timeout):
+    """Richieste a ritmo fisso per `duration` secondi, ritorna [(status, latenza, byte)]"""
+    total = max(int(rps * duration), 1)
+    results = [None] * total
+
+    def fire(i, scheduled):
+        status, _, size = request(port, "POST", path, payload(i), timeout=timeout)
+        results[i] = (status, time.perf_counter() - scheduled, size)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        for i in range(total):
+            scheduled = start + i / rps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(fire, i, scheduled)
+    return results, time.perf_counter() - start
+
+
+def summarize(results, wall, rps):
+    latencies = [elapsed for status, elapsed, _ in results if status == 200]
+    ms = lambda pct: round(percentile(latencies, pct) * 1000, 1) if latencies else None  # noqa: E731
+    return {
+        "requests": len(results),
+        "ok": len(latencies),
+        "errors": len(results) - len(latencies),
+        "target_rps": rps,
+        "achieved_rps": round(len(latencies) / wall, 2),
+        "wall_s": round(wall, 3),
+        "p50_ms": ms(50),
+        "p95_ms": ms(95),
+        "p99_ms": ms(99),
+        "max_ms": round(max(latencies) * 1000, 1) if latencies else None,
+        "avg_bytes": round(sum(size for status, _, size in results if status == 200) / len(latencies))
+                     if latencies else None,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline_path):
+    """Stampa le differenze rispetto a un report precedente"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nvs {baseline_path} ({baseline['meta'].get('label') or baseline['meta'].get('revision')})")
+    for name, current in report["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if previous is None:
+            continue
+        deltas = []
+        for key in ("achieved_rps", "p50_ms", "p95_ms", "p99_ms"):
+            if current[key] is not None and previous[key]:
+                deltas.append(f"{key}={current[key]} ({(current[key] / previous[key] - 1) * 100:+.1f}%)")
+        print(f"  {name:<14} " + " ".join(deltas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=sorted(SERVER_COMMANDS), default="sync")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--rps", type=float, default=10, help="richieste al secondo per scenario")
+    parser.add_argument("--duration", type=float, default=10, help="secondi per scenario")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="richieste aperte lato client")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--latency", type=float, default=0.5, help="latenza provider stub (s)")
+    parser.add_argument("--image-latency", type=float, default=None)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--payload-size", type=int, default=800, help="caratteri per risposta testuale stub")
+    parser.add_argument("--port", type=int, default=8950)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="variabili d'ambiente extra per l'app (ripetibile)")
+    parser.add_argument("--label", help="etichetta della versione nel report")
+    parser.add_argument("--json", dest="json_path", help="scrive il report in JSON")
+    parser.add_argument("--compare", help="report JSON precedente da confrontare")
+    args = parser.parse_args()
+
+    stub_port = args.port + 1
+    stub_args = ["--port", str(stub_port), "--latency", str(args.latency), "--error-rate", str(args.error_rate),
+                 "--payload-size", str(args.payload_size)]
+    if args.image_latency is not None:
+        stub_args += ["--image-latency", str(args.image_latency)]
+    stub = subprocess.Popen([sys.executable, os.path.join(ROOT, "benchmarks", "stub_providers.py")] + stub_args,
+                            stdout=subprocess.DEVNULL)
+    time.sleep(0.5)
+
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    report = {
+        "meta": {
+            "label": args.label,
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "mode": args.mode,
+            "workers": args.workers,
+            "rps": args.rps,
+            "duration_s": args.duration,
+            "stub": {"latency": args.latency, "image_latency": args.image_latency,
+                     "error_rate": args.error_rate, "payload_size": args.payload_size},
+            "env": extra_env,
+        },
+        "scenarios": {},
+    }
+
+    try:
+        server = start_server(args.mode, args.port, args.workers, stub_port, extra_env)
+        try:
+            for name in args.scenarios.split(","):
+                path, payload = SCENARIOS[name]
+                with ResourceSampler(server.pid) as sampler:
+                    results, wall = run_rate(args.port, path, payload, args.rps, args.duration,
+                                             args.max_in_flight, args.timeout)
+                r = report["scenarios"][name] = dict(summarize(results, wall, args.rps), workers=sampler.report())
+                cpu = " ".join(f"{w['cpu_pct']}%/{w['rss_peak_mb']}MB" for w in r["workers"])
+                print(f"{name:<14} rps={r['achieved_rps']:<7} p50={r['p50_ms']}ms p95={r['p95_ms']}ms "
+                      f"p99={r['p99_ms']}ms errors={r['errors']} workers[cpu/rss]={cpu}")
+        finally:
+            stop_server(server)
+    finally:
+        stub.terminate()
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
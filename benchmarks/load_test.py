@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Load test: modalità sync (gunicorn, worker sync) vs modalità ASGI (uvicorn)
+Tutte le modalità parlano con i provider stub locali (benchmarks/stub_providers.py).
+Durante il carico su /test un probe separato misura la latenza di /health.
+"dev" è app.run (python app.py), "profile" il profilo di produzione gunicorn.conf.py
+(worker e thread dalla CPU e da AGENT_IO_RATIO, --workers ignorato), "profile-async" lo
+stesso profilo con GUNICORN_WORKER_CLASS=async. Risultati registrati in benchmarks/results/.
+
+    python benchmarks/load_test.py --requests 200 --concurrency 50 --workers 2
+    python benchmarks/load_test.py --modes dev,profile,profile-async --workers 1
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_providers import provider_env  # noqa: E402
+
+SERVER_COMMANDS = {
+    "sync": lambda port, workers: [
+        sys.executable, "-m", "gunicorn", "-k", "sync", "-w", str(workers), "-b", f"127.0.0.1:{port}",
+        "--timeout", "120", "--log-level", "warning", "app:app"],
+    "asgi": lambda port, workers: [
+        sys.executable, "-m", "uvicorn", "--workers", str(workers), "--host", "127.0.0.1",
+        "--port", str(port), "--log-level", "warning", "asgi:application"],
+    "dev": lambda port, workers: [
+        sys.executable, "-c", f"import app; app.app.run(host='127.0.0.1', port={port}, debug=False)"],
+    "profile": lambda port, workers: [
+        sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-b", f"127.0.0.1:{port}",
+        "--log-level", "warning"],
+    "profile-async": lambda port, workers: SERVER_COMMANDS["profile"](port, workers),
+}
+
+MODE_ENV = {"profile-async": {"GUNICORN_WORKER_CLASS": "async"}}
+
+
+def percentile(samples, pct):
+    """Percentile per nearest-rank"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def request(port, method, path, payload=None, timeout=120):
+    """Esegue una richiesta HTTP, ritorna (status, secondi, byte)"""
+    body = json.dumps(payload).encode() if payload is not None else None
+    headers = {"Content-Type": "application/json"} if body else {}
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+        return response.status, time.perf_counter() - start, len(data)
+    except OSError:
+        return 0, time.perf_counter() - start, 0
+    finally:
+        conn.close()
+
+
+def wait_ready(port, timeout=60):
+    """Attende che /health risponda"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if request(port, "GET", "/health", timeout=2)[0] == 200:
+            return
+        time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} not ready after {timeout}s")
+
+
+def start_server(mode, port, workers, stub_port, extra_env=None, command=None):
+    """Avvia l'app in un processo separato puntata ai provider stub"""
+    env = dict(os.environ, **provider_env(stub_port), **MODE_ENV.get(mode, {}), **(extra_env or {}))
+    argv = command or SERVER_COMMANDS[mode](port, workers)
+    process = subprocess.Popen(argv, cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(port)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def run_load(port, path, payload, total, concurrency, probe_path="/health"):
+    """Spara `total` richieste con `concurrency` client, misurando anche il probe"""
+    probe_samples, stop = [], threading.Event()
+
+    def probe():
+        while not stop.is_set():
+            status, elapsed, _ = request(port, "GET", probe_path, timeout=60)
+            if status == 200:
+                probe_samples.append(elapsed)
+            stop.wait(0.1)
+
+    prober = threading.Thread(target=probe, daemon=True)
+    prober.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda i: request(port, "POST", path, payload(i)), range(total)))
+    wall = time.perf_counter() - start
+
+    stop.set()
+    prober.join()
+
+    latencies = [elapsed for status, elapsed, _ in results if status == 200]
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "ok": len(latencies),
+        "errors": total - len(latencies),
+        "wall_s": round(wall, 3),
+        "rps": round(len(latencies) / wall, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+        "probe_p99_ms": round(percentile(probe_samples, 99) * 1000, 1) if probe_samples else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="sync,asgi")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--port", type=int, default=8950)
+    parser.add_argument("--json", dest="json_path", help="scrive i risultati in JSON")
+    args = parser.parse_args()
+
+    stub_port = args.port + 1
+    stub = subprocess.Popen([sys.executable, os.path.join(ROOT, "benchmarks", "stub_providers.py"),
+                             "--port", str(stub_port), "--latency", str(args.latency)],
+                            stdout=subprocess.DEVNULL)
+    time.sleep(0.5)
+
+    report = {}
+    try:
+        for mode in args.modes.split(","):
+            server = start_server(mode, args.port, args.workers, stub_port)
+            try:
+                report[mode] = run_load(args.port, "/test", lambda i: {"message": f"load briefing {i}"},
+                                        args.requests, args.concurrency)
+            finally:
+                stop_server(server)
+            r = report[mode]
+            print(f"{mode:<13} rps={r['rps']:<8} p50={r['p50_ms']}ms p99={r['p99_ms']}ms "
+                  f"health_p99={r['probe_p99_ms']}ms errors={r['errors']}")
+    finally:
+        stub.terminate()
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
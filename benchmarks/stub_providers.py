@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Provider stub locali per benchmark offline (nessun costo API)
+Emula gli endpoint usati da app.py:
+
+    POST /v1/chat/completions                      OpenAI (LANA)
+    POST /v1/images/generations                    OpenAI (PICASSO)
+    POST /v1/embeddings                            OpenAI (knowledge base, KB_VECTORS=openai)
+    POST /v1/messages                              Anthropic (CLAUDE)
+    POST /v1beta/models/<model>:generateContent    Google (GEMINI, transport REST)
+    GET  /v1/models, /v1beta/models/<model>        probe di startup
+    GET  /_stats                                   connessioni accettate e immagini generate
+
+    python benchmarks/stub_providers.py --port 8900 --latency 0.5
+
+Per puntare l'app allo stub vedi `provider_env()`.
+"""
+
+import os
+import ssl
+import json
+import time
+import zlib
+import base64
+import struct
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def embedding(text, dimensions):
+    """Vettore deterministico (parole hashate): testi con parole in comune risultano simili"""
+    vector = [0.0] * dimensions
+    for word in text.lower().split():
+        vector[zlib.crc32(word.encode()) % dimensions] += 1.0
+    norm = sum(value * value for value in vector) ** 0.5 or 1.0
+    return [value / norm for value in vector]
+
+
+def tiny_png():
+    """PNG 1x1 valido, restituito dalle generazioni immagine"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(b"\x00\xff\x99\x00")) + chunk(b"IEND", b""))
+
+
+PNG = tiny_png()
+
+
+class StubConfig:
+    """Parametri dello stub, modificabili a runtime"""
+
+    def __init__(self, latency=0.5, image_latency=None, error_rate=0.0, payload_size=800,
+                 rate_limit_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.image_latency = latency * 3 if image_latency is None else image_latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.payload_size = payload_size
+        self.connections = 0
+        self.images = 0
+        self._lock = threading.Lock()
+
+    def count_image(self):
+        with self._lock:
+            self.images += 1
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def text(self):
+        words = "AYROMEX strategia execution copy visual team briefing".split()
+        out, size = [], 0
+        while size < self.payload_size:
+            word = random.choice(words)
+            out.append(word)
+            size += len(word) + 1
+        return " ".join(out)
+
+
+def make_handler(config):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Header e body partono in due write: senza TCP_NODELAY il delayed ACK aggiunge ~40ms
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def setup(self):
+            # Un handler per connessione: conta le connessioni aperte dai client
+            config.count_connection()
+            super().setup()
+
+        def send_json(self, payload, status=200, headers=None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            # Probe di startup: lista modelli OpenAI, metadati modello Gemini
+            path = self.path.split("?", 1)[0]
+            if path == "/_stats":
+                return self.send_json({"connections": config.connections, "images": config.images})
+            time.sleep(config.latency)
+            if path.endswith("/models"):
+                self.send_json({"object": "list", "data": [{"id": "gpt-3.5-turbo", "object": "model"}]})
+            elif "/models/" in path:
+                name = path.split("/models/", 1)[1]
+                self.send_json({"name": f"models/{name}", "baseModelId": name, "version": "001",
+                                "displayName": name, "inputTokenLimit": 1048576, "outputTokenLimit": 8192,
+                                "supportedGenerationMethods": ["generateContent"]})
+            else:
+                self.send_json({"error": {"message": f"unknown stub path {path}"}}, 404)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+
+            path = self.path.split("?", 1)[0]
+            is_image = path.endswith("/images/generations")
+            time.sleep(config.image_latency if is_image else config.latency)
+
+            if random.random() < config.rate_limit_rate:
+                return self.send_json({"error": {"message": "stub rate limit", "type": "rate_limit_error"}}, 429,
+                                      {"Retry-After": str(config.retry_after)})
+            if random.random() < config.error_rate:
+                return self.send_json({"error": {"message": "stub overloaded", "type": "server_error"}}, 503)
+
+            now = int(time.time())
+            if path.endswith("/chat/completions"):
+                self.send_json({
+                    "id": "chatcmpl-stub", "object": "chat.completion", "created": now,
+                    "model": "gpt-3.5-turbo",
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": config.text()}}],
+                    "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20},
+                })
+            elif is_image:
+                config.count_image()
+                try:
+                    b64 = json.loads(body or b"{}").get("response_format") == "b64_json"
+                except ValueError:
+                    b64 = False
+                image = {"b64_json": base64.b64encode(PNG).decode()} if b64 else {"url": f"https://stub.local/img/{now}.png"}
+                self.send_json({"created": now, "data": [image]})
+            elif path.endswith("/embeddings"):
+                request = json.loads(body or b"{}")
+                texts = request.get("input") or []
+                texts = [texts] if isinstance(texts, str) else texts
+                dimensions = request.get("dimensions") or 256
+                self.send_json({
+                    "object": "list", "model": request.get("model"),
+                    "data": [{"object": "embedding", "index": i, "embedding": embedding(text, dimensions)}
+                             for i, text in enumerate(texts)],
+                    "usage": {"prompt_tokens": 10, "total_tokens": 10},
+                })
+            elif path.endswith("/messages"):
+                self.send_json({
+                    "id": "msg_stub", "type": "message", "role": "assistant",
+                    "model": "claude-3-haiku-20240307", "stop_reason": "end_turn", "stop_sequence": None,
+                    "content": [{"type": "text", "text": config.text()}],
+                    "usage": {"input_tokens": 10, "output_tokens": 10},
+                })
+            elif path.endswith(":generateContent"):
+                self.send_json({
+                    "candidates": [{"index": 0, "finishReason": "STOP",
+                                    "content": {"role": "model", "parts": [{"text": config.text()}]}}],
+                })
+            else:
+                self.send_json({"error": {"message": f"unknown stub path {path}"}}, 404)
+
+    return StubHandler
+
+
+class StubServer(ThreadingHTTPServer):
+    # Backlog ampio: il default (5) scarta connessioni sotto carico e falsa le code
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Client che chiudono a metà richiesta (processi terminati, timeout) non sono errori dello stub
+        pass
+
+
+def self_signed_cert():
+    """Certificato self-signed per 127.0.0.1, ritorna (cert, key)"""
+    directory = tempfile.mkdtemp(prefix="ayrohub-stub-")
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+                    "-keyout", key, "-out", cert],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def start_stub(port=0, tls=False, **kwargs):
+    """Avvia lo stub su un thread, ritorna (server, config)
+
+    Con tls=True lo stub parla HTTPS con un certificato self-signed
+    (server.cert_file), così i benchmark includono il costo dell'handshake.
+    """
+    config = StubConfig(**kwargs)
+    server = StubServer(("127.0.0.1", port), make_handler(config))
+    server.cert_file = None
+    if tls:
+        server.cert_file, key_file = self_signed_cert()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(server.cert_file, key_file)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, config
+
+
+def provider_env(port, cert_file=None):
+    """Variabili d'ambiente che puntano app.py allo stub (HTTPS se cert_file)"""
+    base = f"{'https' if cert_file else 'http'}://127.0.0.1:{port}"
+    env = {
+        "OPENAI_API_KEY": "sk-stub",
+        "OPENAI_API_BASE": f"{base}/v1",
+        "ANTHROPIC_API_KEY": "sk-ant-stub",
+        "ANTHROPIC_BASE_URL": base,
+        "GOOGLE_API_KEY": "stub",
+        "GOOGLE_API_ENDPOINT": base,
+    }
+    if cert_file:
+        # requests (OpenAI, Google REST) e httpx (Anthropic) si fidano del certificato dello stub
+        env["REQUESTS_CA_BUNDLE"] = cert_file
+        env["SSL_CERT_FILE"] = cert_file
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--image-latency", type=float, default=None)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--payload-size", type=int, default=800)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="quota di risposte 429")
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--tls", action="store_true", help="HTTPS con certificato self-signed")
+    args = parser.parse_args()
+
+    server, _ = start_stub(args.port, tls=args.tls, latency=args.latency, image_latency=args.image_latency,
+                           error_rate=args.error_rate, payload_size=args.payload_size,
+                           rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after)
+    print(f"stub providers on port {server.server_port}")
+    for key, value in provider_env(server.server_port, server.cert_file).items():
+        print(f"export {key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+AYROHUB AI 2.0 - Profilo di produzione gunicorn
+gunicorn legge questo file da solo se avviato dalla root del repository:
+
+    gunicorn                                   # app:app, worker e thread scelti qui sotto
+    GUNICORN_WORKER_CLASS=async gunicorn       # asgi:application su UvicornWorker (richiede uvicorn)
+    WEB_CONCURRENCY=4 GUNICORN_THREADS=8 gunicorn
+
+Il master importa app.py una volta sola (preload_app): SDK, schemi SQLite,
+template della dashboard e primo giro di probe dei provider sono pronti prima
+del fork e tutti i worker li ereditano; gli hook os.register_at_fork di app.py
+riaprono connessioni, pool di thread e loop dei probe in ogni worker.
+"""
+
+import os
+import math
+import tempfile
+
+# Stessi default di app.py: i timeout di gunicorn seguono le deadline degli agenti
+AGENT_TIMEOUT = float(os.getenv('AGENT_TIMEOUT', '30'))
+PICASSO_TIMEOUT = float(os.getenv('PICASSO_TIMEOUT', '60'))
+PICASSO_MODE = os.getenv('PICASSO_MODE', 'background')
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', '60'))
+AGENT_POOL_SIZE = int(os.getenv('AGENT_POOL_SIZE', '16'))
+PROBE_TIMEOUT = float(os.getenv('PROBE_TIMEOUT', '10'))
+
+# Worker: "auto" sceglie tra sync e gthread dal mix di I/O degli agenti, oppure "sync", "gthread" o "async".
+# AGENT_IO_RATIO = quota del tempo di una richiesta passata ad attendere i provider (0-1); con i
+# provider reali (secondi di attesa, decine di ms di CPU) è sopra 0.97.
+# Sotto 0.5 le richieste sono dominate dalla CPU: worker sync, 2 x CPU + 1.
+# Sopra, ogni CPU regge 1 / (1 - ratio) richieste in volo: worker gthread con altrettanti thread.
+# Le chiamate agli agenti di un worker passano però da un pool di AGENT_POOL_SIZE thread, quindi
+# i worker sono tanti da coprire le richieste in volo di tutte le CPU con i loro pool (almeno 2);
+# i thread oltre il pool tengono libere /health e la dashboard mentre le richieste agenti attendono.
+# Il worker async (asgi.py, agenti come coroutine, un worker per CPU, richiede uvicorn) va scelto
+# esplicitamente con GUNICORN_WORKER_CLASS=async: "auto" non dipende da cosa è installato.
+# WEB_CONCURRENCY e GUNICORN_THREADS forzano numero di worker e thread per worker.
+GUNICORN_WORKER_CLASS = os.getenv('GUNICORN_WORKER_CLASS', 'auto')
+AGENT_IO_RATIO = min(float(os.getenv('AGENT_IO_RATIO', '0.97')), 0.99)
+CPUS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+IN_FLIGHT_PER_CPU = max(1, round(1 / (1 - AGENT_IO_RATIO)))
+
+def choose_worker_class():
+    """Classe di worker: forzata da GUNICORN_WORKER_CLASS o dedotta da AGENT_IO_RATIO (sync o gthread)"""
+    if GUNICORN_WORKER_CLASS != 'auto':
+        return GUNICORN_WORKER_CLASS
+    return 'sync' if AGENT_IO_RATIO < 0.5 else 'gthread'
+
+WORKER_MODE = choose_worker_class()
+
+if WORKER_MODE == 'sync':
+    worker_class = 'sync'
+    workers = int(os.getenv('WEB_CONCURRENCY', 2 * CPUS + 1))
+elif WORKER_MODE == 'gthread':
+    worker_class = 'gthread'
+    workers = int(os.getenv('WEB_CONCURRENCY', max(2, math.ceil(CPUS * IN_FLIGHT_PER_CPU / AGENT_POOL_SIZE))))
+    threads = int(os.getenv('GUNICORN_THREADS', IN_FLIGHT_PER_CPU))
+elif WORKER_MODE == 'async':
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    wsgi_app = 'asgi:application'
+    workers = int(os.getenv('WEB_CONCURRENCY', max(2, CPUS)))
+else:
+    raise ValueError(f"GUNICORN_WORKER_CLASS non valido: {GUNICORN_WORKER_CLASS} (auto, sync, gthread, async)")
+
+if WORKER_MODE != 'async':
+    wsgi_app = 'app:app'
+
+bind = os.getenv('GUNICORN_BIND', f"0.0.0.0:{os.getenv('PORT', '5000')}")
+preload_app = True
+
+# Timeout: la richiesta più lunga è il fan-out di /test (REQUEST_DEADLINE, o PICASSO inline), che
+# risponde da sé alla deadline con gli agenti in ritardo; gunicorn uccide un worker solo se resta
+# muto oltre la deadline + margine. Allo shutdown o reload i worker hanno fino alla deadline per
+# finire le richieste in volo. Con gthread/async il timeout riguarda solo il battito del worker, quindi
+# anche /n8n-webhook/batch (che può durare più di una deadline) non viene interrotto.
+DEADLINE = max(REQUEST_DEADLINE, AGENT_TIMEOUT, PICASSO_TIMEOUT if PICASSO_MODE == 'inline' else 0)
+timeout = int(os.getenv('GUNICORN_TIMEOUT', DEADLINE + 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', DEADLINE + 5))
+# Keep-alive più lungo del default (2s): n8n e i load balancer riusano le connessioni
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+
+# Metriche: una directory per master (come senza preload, dove i worker usano il pid del padre)
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), f'ayrohub-metrics-{os.getpid()}'))
+
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+accesslog = os.getenv('GUNICORN_ACCESS_LOG') or None
+
+def when_ready(server):
+    """Prima del fork: attende il primo giro di probe del master, così i worker lo ereditano"""
+    if server.cfg.preload_app:
+        import app
+        if app.probed_at is None and any(key for _, key, _ in app.PROVIDER_PROBES):
+            done = app.wait_provider_probes(PROBE_TIMEOUT)
+            server.log.info("Probe provider %s prima del fork", "completati" if done else "ancora in corso")
+    server.log.info("AYROHUB AI 2.0: %s worker %s%s, timeout %ss (graceful %ss)", workers, WORKER_MODE,
+                    f" x {threads} thread" if WORKER_MODE == 'gthread' else "", timeout, graceful_timeout)
@@ -0,0 +1,69 @@
+async function sendMessage() {
+    const msg = document.getElementById('message').value;
+    if (!msg) return alert('Inserisci un briefing per il team!');
+    const agents = Array.from(document.querySelectorAll('#agentPicker input:checked')).map(input => input.value);
+    if (!agents.length) return alert('Seleziona almeno un agente!');
+
+    document.getElementById('loading').style.display = 'block';
+
+    const timestamp = new Date().toLocaleString('it-IT');
+
+    document.getElementById('responseContent').innerHTML = `
+        <div style="background: rgba(255,255,255,0.1); padding: 20px; border-radius: 10px; margin-bottom: 25px; border-left: 4px solid #00d4ff;">
+            <strong>📝 Briefing:</strong> ${msg}<br>
+            <strong>⏰ Timestamp:</strong> ${timestamp}<br>
+            <strong>🚀 Version:</strong> AYROHUB AI 2.0 + PICASSO
+        </div>
+    ` + agents.map(agent => [agent, AGENT_CARDS[agent]]).map(([agent, title]) => `
+        <div class="agent">
+            <h3>${title}</h3>
+            <div id="agent-${agent}" style="white-space: pre-wrap; line-height: 1.6;">⏳ In elaborazione...</div>
+        </div>
+    `).join('') + `
+        <div id="teamDone" style="display: none; background: rgba(0,255,136,0.1); padding: 15px; border-radius: 10px; border-left: 4px solid #00ff88; text-align: center; margin-top: 20px;">
+            ✅ <strong>Processo AYROHUB AI 2.0 completato</strong>
+        </div>
+    `;
+    document.getElementById('results').style.display = 'block';
+    document.getElementById('results').scrollIntoView({ behavior: 'smooth' });
+
+    try {
+        // Ogni agente arriva come riga NDJSON appena risponde
+        const response = await fetch('/test/stream', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({message: msg, agents: agents})
+        });
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)));
+        }
+
+    } catch (error) {
+        document.getElementById('loading').style.display = 'none';
+        alert('Errore: ' + error.message);
+    }
+}
+
+function handleEvent(event) {
+    if (event.event === 'agent') {
+        document.getElementById('loading').style.display = 'none';
+        document.getElementById(`agent-${event.agent}`).innerHTML = event.response || 'Non disponibile';
+    } else if (event.event === 'image') {
+        // Immagine PICASSO generata in background dopo il segnaposto
+        document.getElementById(`agent-${event.agent}`).innerHTML = event.status === 'ready'
+            ? `<a href="${event.image_url}" target="_blank"><img src="${event.image_url}" alt="${event.agent}" style="max-width: 100%; border-radius: 10px;"></a>`
+            : '❌ Immagine non disponibile';
+    } else if (event.event === 'done') {
+        document.getElementById('loading').style.display = 'none';
+        document.getElementById('teamDone').style.display = 'block';
+    }
+}